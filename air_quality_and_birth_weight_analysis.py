@@ -1,879 +1,4173 @@
 # Written by Anthony Cessna and Aaron Hunsaker
 # November 2021
 
-import csv
-from collections import namedtuple
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import logging
-import plotly.express as px
 import os
 import argparse
-import numpy as np
-import pandas as pd
 import glob
+import hashlib
+import gzip
+import json
+import shutil
+import io
+import time
+import ctypes
+import cProfile
+import resource
+import sys
+import importlib
+from urllib.parse import parse_qsl, urlsplit
+from contextlib import contextmanager
+from datetime import datetime
 from dataclasses import dataclass
+from functools import cached_property, wraps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-class AirQuality_obj:
+class _LazyModule:
     """
-    A class that represents different aspects of air quality for one county in the USA
+    Stands in for a module until one of its attributes is used, then imports it and puts the module itself in
+    the globals of this file. Plotting loads only when a figure is made and the data libraries only when a stage
+    runs, so --help, argument errors and the other short runs skip their import time. A proxy copied elsewhere
+    by a star import keeps the module it imported and hands out its attributes
 
     Attributes
     ----------
-    state : str
-        The state the county is located in
-    county : str
-        The county being examined
-    year : int
-        The year being examined
-    good_days : int
-        The number of days in the year with AQI considered good
-    moderate_days : int
-        The number of days in the year with AQI considered moderate
-    unhealthy_days : int
-        The number of days in the year with AQI considered unhealthy
-    very_unhealthy_days : int
-        The number of days in the year with AQI considered very unhealthy
-    hazardous_days : int
-        The number of days in the year with AQI considered hazardous
-    max_aqi : int
-        The max AQI observed on any day of the year
+    name : str
+        Module imported on first use
+    alias : str
+        Global name the proxy is bound to and the module replaces
+    module : module or None
+        The module once imported
+    """
+
+    def __init__(self, name, alias):
+        """
+        Parameters
+        ----------
+        name : str
+            Module imported on first use
+        alias : str
+            Global name the proxy is bound to
+        """
+        self.name = name
+        self.alias = alias
+        self.module = None
+
+    def __getattr__(self, attribute):
+        """
+        Imports the module and returns its attribute, only called for attributes the proxy does not have
+
+        Parameters
+        ----------
+        attribute : str
+            Attribute of the module
+        """
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+            globals()[self.alias] = self.module
+            logging.debug(f"{self.name} imported on first use")
+
+        return getattr(self.module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self.name}>"
+
+# Heavy modules imported on first use
+px = _LazyModule("plotly.express", "px")
+np = _LazyModule("numpy", "np")
+pd = _LazyModule("pandas", "pd")
+asyncio = _LazyModule("asyncio", "asyncio")
+resource_tracker = _LazyModule("multiprocessing.resource_tracker", "resource_tracker")
+shared_memory = _LazyModule("multiprocessing.shared_memory", "shared_memory")
+
+# Columns of the EPA annual AQI by county files and their types, so each file is parsed once with explicit dtypes
+AQI_STRING_COLUMNS = ["State", "County"]
+AQI_NUMERIC_COLUMNS = ["Year", "Days with AQI", "Good Days", "Moderate Days", "Unhealthy for Sensitive Groups Days",
+                       "Unhealthy Days", "Very Unhealthy Days", "Hazardous Days", "Max AQI", "90th Percentile AQI",
+                       "Median AQI", "Days CO", "Days NO2", "Days Ozone", "Days SO2", "Days PM2.5", "Days PM10"]
+AQI_COLUMNS = AQI_STRING_COLUMNS + AQI_NUMERIC_COLUMNS
+AQI_DTYPES = {**{column: "category" for column in AQI_STRING_COLUMNS}, **{column: "int64" for column in AQI_NUMERIC_COLUMNS}}
+
+# Responses the analysis server keeps, the least recently used is dropped past this many
+SERVER_CACHE_SIZE = 256
+
+# Most replicates or permutations one server request may ask for, each request holds the worker thread
+SERVER_MAX_REPLICATES = 100000
+
+# Status lines of the analysis server responses
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+# Rows formatted at a time when a table is exported, so a national frame is never formatted whole in memory
+EXPORT_CHUNKSIZE = 100000
+
+# Compressions of the exported csv files and the extension each adds, zstd needs the zstandard package
+EXPORT_COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# gzip level of the exported csv files, the default of 9 is several times slower for a few percent smaller files
+EXPORT_GZIP_LEVEL = 6
+
+# Columns the exported tables can be partitioned on, one file is written per state or year
+EXPORT_PARTITIONS = ["state", "year"]
+
+# Columns that identify one row of the combined multi-year air quality data set
+AQI_KEY_COLUMNS = ["State", "County", "Year"]
+
+# Columns compared to rank air quality, most severe first, matching the AirQuality_obj comparison tuple
+AQI_SEVERITY_COLUMNS = ["Hazardous Days", "Very Unhealthy Days", "Unhealthy Days", "Moderate Days"]
+
+# Default weights given to the state mean of each kind of day when building the air quality score,
+# days of a bad air quality are weighted more
+AQI_SCORE_WEIGHTS = {"Hazardous Days": 20, "Very Unhealthy Days": 10, "Unhealthy Days": 5, "Moderate Days": 1}
+
+# Columns holding the state mean of each kind of day, and the weighted means kept alongside the score
+AQI_STATE_MEAN_COLUMNS = {"Hazardous Days": "mean_hazardous_days_by_state",
+                          "Very Unhealthy Days": "mean_very_unhealthy_days_by_state",
+                          "Unhealthy Days": "mean_unhealthy_days_by_state",
+                          "Moderate Days": "mean_moderate_days_by_state",
+                          "Good Days": "mean_good_days_by_state"}
+AQI_WEIGHTED_COLUMNS = {"Hazardous Days": "mean_hazardous_days_weighted",
+                        "Very Unhealthy Days": "mean_very_unhealthy_weighted",
+                        "Unhealthy Days": "mean_unhealthy_weighted"}
+
+# Numeric columns in the order AirQuality_obj takes them after state and county
+AQI_OBJ_COLUMNS = ["Year", "Good Days", "Moderate Days", "Unhealthy Days", "Very Unhealthy Days", "Hazardous Days",
+                   "Max AQI"]
+
+# Fills in the default weight of every kind of day not given, shared by the air quality stage and the refresh
+def _score_weights(weights):
+    """
+    Returns the complete set of air quality score weights
+
+    Parameters
+    ----------
+    weights : dict or None
+        Weights keyed by kind of day, kinds not given keep the AQI_SCORE_WEIGHTS weight
+    """
+    if weights is None:
+        return dict(AQI_SCORE_WEIGHTS)
+
+    unknown = set(weights) - set(AQI_SCORE_WEIGHTS)
+    if unknown:
+        raise ValueError(f"Weights given for columns that are not scored: {sorted(unknown)}")
+
+    return {**AQI_SCORE_WEIGHTS, **weights}
+
+# Reads one annual AQI file, kept at module level so it can be sent to a process pool
+def _read_air_quality_file(csv_file):
+    """
+    Reads one annual AQI by county csv file with the explicit column types
+
+    Parameters
+    ----------
+    csv_file : str
+        Path of the csv file to read
+    """
+    air_quality_df = pd.read_csv(csv_file, usecols=AQI_COLUMNS, dtype=AQI_DTYPES)
+    logging.debug(f"{len(air_quality_df)} rows read from {csv_file}")
+
+    return air_quality_df
+
+# Version of the frames written to the FrameCache, part of every cache key so a change in the frames misses old entries
+CACHE_FORMAT_VERSION = 7
+
+# Pounds in a gram, birth weights are reported in grams and analyzed in pounds
+GRAMS_PER_POUND = 453.592
+
+# County averages in the natality csv besides birth weight, and the names they are analyzed under
+BIRTH_MEASURE_COLUMNS = {"Ave_Age_of_Mother": "avg_age_of_mother",
+                         "Ave_OE_Gestational_Age_Wks": "avg_oe_gestational_age_wks",
+                         "Ave_LMP_Gestational_Age_Wks": "avg_lmp_gestational_age_wks",
+                         "Ave_Pre_pregnancy_BMI": "avg_pre_pregnancy_bmi",
+                         "Ave_Number_of_Prenatal_Wks": "avg_number_of_prenatal_wks"}
+
+# Columns of the natality csv used in the analysis and their types, the counts and averages are kept in 32 bits
+BIRTH_CSV_COLUMNS = ["Year", "County_of_Residence", "County_of_Residence_FIPS", "Births", "Ave_Birth_Weight_gms"] \
+                    + list(BIRTH_MEASURE_COLUMNS)
+BIRTH_CSV_DTYPES = {"Year": "category", "County_of_Residence": "category", "County_of_Residence_FIPS": "int64", "Births": "int32",
+                    "Ave_Birth_Weight_gms": "float64", **{column: "float32" for column in BIRTH_MEASURE_COLUMNS}}
+
+# Columns of the birth data frame, the BirthObject fields followed by the county FIPS code, births and other averages
+BIRTH_RECORD_COLUMNS = ["year", "county", "state", "average_birth_weight", "fips", "births"] \
+                       + list(BIRTH_MEASURE_COLUMNS.values())
+
+# County averages that are averaged over the births of each state, birth weight first
+BIRTH_WEIGHTED_MEASURES = ["average_birth_weight"] + list(BIRTH_MEASURE_COLUMNS.values())
+
+# Births weighted state mean and variance of each measure
+BIRTH_WEIGHTED_COLUMNS = [f"weighted_{measure}_by_state" for measure in BIRTH_WEIGHTED_MEASURES] \
+                         + [f"weighted_var_{measure}_by_state" for measure in BIRTH_WEIGHTED_MEASURES]
+
+# Running sums the births weighted means and variances are computed from, they add up across partial aggregates
+BIRTH_WEIGHTED_SUM_COLUMNS = ["births_by_state"] \
+                             + [f"births_weighted_sum_{measure}" for measure in BIRTH_WEIGHTED_MEASURES] \
+                             + [f"births_weighted_square_sum_{measure}" for measure in BIRTH_WEIGHTED_MEASURES]
+
+# State and year level birth weight columns, available whether the data is loaded whole or streamed
+BIRTH_STATE_COLUMNS = ["state", "year", "county_count", "birth_weight_sum", "avg_birth_weight_by_state",
+                       "min birth weight by state", "max birth weight by state",
+                       "county_in_state_lowest_birthweight_by_year", "county_in_state_highest_birthweight_by_year"] \
+                      + BIRTH_WEIGHTED_SUM_COLUMNS + BIRTH_WEIGHTED_COLUMNS
+
+# Frames the combined stage produces for each year, in the order _combine_year returns them
+COMBINED_FRAME_NAMES = ["merged_dataframe", "breakdown_dataframe", "unmatched_air_quality", "unmatched_birth"]
+
+# Row positions of the lowest and highest county of each state and year in the whole birth data set
+BIRTH_POSITION_COLUMNS = ["idx_county_with_lowest_birthweight", "idx_county_with_highest_birthweight"]
+
+# State columns broadcast onto every county row of the birth data frame, in the order BirthDataStats.pandas_df adds them
+BIRTH_COUNTY_STATE_COLUMNS = ["avg_birth_weight_by_state", "min birth weight by state", "idx_county_with_lowest_birthweight",
+                              "max birth weight by state", "idx_county_with_highest_birthweight", "min birth weight by county",
+                              "max birth weight by county", "county_in_state_lowest_birthweight_by_year",
+                              "county_in_state_highest_birthweight_by_year", "births_by_state"] + BIRTH_WEIGHTED_COLUMNS
+
+# Decimals the ABW and AQS are rounded to before they are placed in quadrants, and the decimals of the medians
+QUADRANT_VALUE_DECIMALS = 3
+QUADRANT_MEDIAN_DECIMALS = 2
+
+# Quadrant numbers and the chart titles they are drawn under, 0 is a state on a median
+QUADRANT_TITLES = {1: "Quadrant 1 High ABW & High AQS", 2: "Quadrant 2 Low ABW & High AQS",
+                   3: "Quadrant 3 Low ABW & Low AQS", 4: "Quadrant 4 High ABW & Low AQS", 0: "On a median"}
+
+# Quadrant of a state indexed by the sign of its ABW and AQS from the medians, each shifted up by one
+QUADRANT_BY_SIGN = [[3, 0, 2],
+                    [0, 0, 0],
+                    [4, 0, 1]]
+
+# Replicates drawn per batch when resampling, each batch is one index matrix and one task of the process pool
+RESAMPLING_BATCH_SIZE = 1000
+
+# Statistics every resampling replicate computes
+RESAMPLING_STATISTICS = ["pearson_r", "quadrant_2_4_share"]
+
+# Key columns of the birth weight indexes, the natality file pads its state abbreviations and reads years as strings
+def _birth_index_keys(birth_df):
+    """
+    Returns the year as int and the state abbreviation without its padding as categoricals, mapped once per
+    category rather than once per row
+
+    Parameters
+    ----------
+    birth_df : pandas dataframe
+        Birth data with categorical year and state columns
+    """
+    return [_map_categories(birth_df["year"], lambda years: years.astype(int)),
+            _map_categories(birth_df["state"], lambda states: states.str.strip())]
+
+# Transforms the distinct strings of a categorical once instead of every row
+def _map_categories(values, function):
+    """
+    Returns a categorical of function applied to each value, computed on the categories only. The categories
+    of the result are sorted so grouping on it orders the groups like grouping on the strings
+
+    Parameters
+    ----------
+    values : pandas series
+        Categorical strings
+    function : function
+        Maps a series of strings to a series of strings of the same length
+    """
+    mapped = function(pd.Series(values.cat.categories)).to_numpy(dtype=object)
+    categories = np.unique(mapped)
+    mapped_codes = categories.searchsorted(mapped)
+
+    codes = values.cat.codes.to_numpy()
+    return pd.Categorical.from_codes(np.where(codes < 0, -1, mapped_codes.take(codes)), categories)
+
+# Concatenates frames whose categorical columns may have different categories without decoding them
+def _concat_categorical(frames, ignore_index=True):
+    """
+    Returns the frames concatenated with every categorical column recoded to the sorted union of the categories,
+    pd.concat alone falls back to strings as soon as two frames have different categories
+
+    Parameters
+    ----------
+    frames : list of pandas dataframe
+        Frames with the same columns
+    ignore_index : bool
+        True numbers the rows of the result from 0, False keeps the index of each frame
+    """
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals([frame[column] for frame in frames], sort_categories=True).categories
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+
+    return pd.concat(frames, ignore_index=ignore_index)
+
+# Reads a chunk of the natality csv into the year, county, state and weight used in the analysis
+def _parse_birth_chunk(chunk):
+    """
+    Returns a data frame with the year, county, state, average birth weight in pounds, county FIPS code, births
+    and other county averages of each row in the chunk
+
+    Parameters
+    ----------
+    chunk : pandas dataframe
+        Rows read from the natality csv
+    """
+    county_state = chunk["County_of_Residence"]
+
+    return pd.DataFrame({"year": _map_categories(chunk["Year"], lambda years: years.str.partition("-")[0]),
+                         "county": _map_categories(county_state, lambda names: names.str.partition(",")[0]),
+                         "state": _map_categories(county_state, lambda names: names.str.partition(",")[2]),
+                         "average_birth_weight": np.round(chunk["Ave_Birth_Weight_gms"].to_numpy() / GRAMS_PER_POUND, 2),
+                         "fips": chunk["County_of_Residence_FIPS"].to_numpy(),
+                         "births": chunk["Births"].to_numpy(),
+                         **{name: chunk[column].to_numpy() for column, name in BIRTH_MEASURE_COLUMNS.items()}})
+
+# Sums the births, and the births weighted values and squared values of every measure, for each state and year
+def _births_weighted_sums(birth_df):
+    """
+    Returns the running sums behind the births weighted state means and variances, indexed by state and year.
+    The sums are taken in float64 even though the columns are stored in 32 bits
+
+    Parameters
+    ----------
+    birth_df : pandas dataframe
+        Parsed rows with state, year, births and the BIRTH_WEIGHTED_MEASURES columns
+    """
+    births = birth_df["births"].to_numpy(dtype=np.float64)
+    measures = birth_df[BIRTH_WEIGHTED_MEASURES].to_numpy(dtype=np.float64)
+    weighted = births[:, None] * measures
+
+    sums = np.column_stack([births, weighted, weighted * measures])
+    sums = pd.DataFrame(sums, columns=BIRTH_WEIGHTED_SUM_COLUMNS, index=birth_df.index)
+
+    return sums.groupby([birth_df["state"], birth_df["year"]], observed=True).sum()
+
+# Turns the births weighted running sums into state means and variances
+def _births_weighted_moments(sums):
+    """
+    Returns the births weighted mean and variance of every measure from the sums made by _births_weighted_sums,
+    the variance is the weighted mean of the squares less the square of the weighted mean
+
+    Parameters
+    ----------
+    sums : pandas dataframe
+        The BIRTH_WEIGHTED_SUM_COLUMNS of each state and year
+    """
+    births = sums["births_by_state"].to_numpy()[:, None]
+    sum_columns = [f"births_weighted_sum_{measure}" for measure in BIRTH_WEIGHTED_MEASURES]
+    square_columns = [f"births_weighted_square_sum_{measure}" for measure in BIRTH_WEIGHTED_MEASURES]
+
+    means = sums[sum_columns].to_numpy() / births
+    variances = np.maximum(sums[square_columns].to_numpy() / births - means ** 2, 0)
+
+    return pd.DataFrame(np.column_stack([means, variances]), columns=BIRTH_WEIGHTED_COLUMNS, index=sums.index)
+
+# Normalizes county names so the EPA and natality spellings of the same county compare equal
+def _county_key(names):
+    """
+    Returns the county names lower cased with the county type suffix removed and "Saint" spelled "st.", keeping
+    "city" so independent cities do not collide with the county of the same name.
+    eg: "St. Tammany Parish" and "Saint Tammany" both become "st. tammany", "Baltimore (City)" and "Baltimore city"
+    both become "baltimore city"
+
+    Parameters
+    ----------
+    names : pandas series of str
+        County names, a categorical is keyed once per distinct name
+    """
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        return pd.Series(_map_categories(names, _county_key), index=names.index)
+
+    key = names.str.lower().str.replace(r"[()]", "", regex=True).str.split().str.join(" ")
+    key = key.str.replace(r"^saint ", "st. ", regex=True).str.replace(r"^sainte ", "ste. ", regex=True) \
+             .str.replace(r"^st ", "st. ", regex=True)
+
+    return key.str.replace(r" (county|parish|city and borough|borough|census area|municipality)$", "", regex=True)
+
+# Summarizes the rows of one chunk into running aggregates for each state and year
+def _birth_chunk_aggregates(birth_df, offset=0):
+    """
+    Returns the county count, weight sum, min, max and the counties holding the min and max for each state and year,
+    with the row positions of those counties
+
+    Parameters
+    ----------
+    birth_df : pandas dataframe
+        Parsed rows with year, county, state and average_birth_weight columns
+    offset : int
+        Position of the first row of birth_df in the whole data set
+    """
+    birth_df = birth_df.reset_index(drop=True)
+    aggregates = birth_df.groupby(["state", "year"], observed=True)["average_birth_weight"].agg(["count", "sum", "min", "idxmin", "max", "idxmax"])
+
+    counties = birth_df["county"].to_numpy()
+    aggregates = pd.DataFrame({"county_count": aggregates["count"],
+                               "birth_weight_sum": aggregates["sum"],
+                               "min birth weight by state": aggregates["min"],
+                               "max birth weight by state": aggregates["max"],
+                               "county_in_state_lowest_birthweight_by_year": counties.take(aggregates["idxmin"]),
+                               "county_in_state_highest_birthweight_by_year": counties.take(aggregates["idxmax"]),
+                               "idx_county_with_lowest_birthweight": aggregates["idxmin"] + offset,
+                               "idx_county_with_highest_birthweight": aggregates["idxmax"] + offset})
+
+    aggregates = aggregates.join(_births_weighted_sums(birth_df))
+
+    return aggregates.reset_index()
+
+# Merges partial aggregates of the same states and years into one row per state and year
+def _merge_birth_aggregates(partial_aggregates, positions=False):
+    """
+    Combines partial state and year aggregates, earlier partials win ties on the min and max county like idxmin and idxmax
+
+    Parameters
+    ----------
+    partial_aggregates : list of pandas dataframe
+        Frames made by _birth_chunk_aggregates or by this function
+    positions : bool
+        Also keeps the row positions of the min and max county, every partial must then have them
+    """
+    combined = _concat_categorical(partial_aggregates)
+    grouped = combined.groupby(["state", "year"], observed=True)
+
+    lowest = combined.loc[grouped["min birth weight by state"].idxmin()].set_index(["state", "year"])
+    highest = combined.loc[grouped["max birth weight by state"].idxmax()].set_index(["state", "year"])
+
+    # pandas does not sort observed groups of several categorical keys, so the groups are sorted here
+    merged = pd.DataFrame({"county_count": grouped["county_count"].sum(),
+                           "birth_weight_sum": grouped["birth_weight_sum"].sum()}).sort_index()
+    merged["avg_birth_weight_by_state"] = merged["birth_weight_sum"] / merged["county_count"]
+    merged["min birth weight by state"] = lowest["min birth weight by state"]
+    merged["max birth weight by state"] = highest["max birth weight by state"]
+    merged["county_in_state_lowest_birthweight_by_year"] = lowest["county_in_state_lowest_birthweight_by_year"]
+    merged["county_in_state_highest_birthweight_by_year"] = highest["county_in_state_highest_birthweight_by_year"]
+    if positions:
+        merged["idx_county_with_lowest_birthweight"] = lowest["idx_county_with_lowest_birthweight"]
+        merged["idx_county_with_highest_birthweight"] = highest["idx_county_with_highest_birthweight"]
+
+    weighted_sums = grouped[BIRTH_WEIGHTED_SUM_COLUMNS].sum()
+    merged = merged.join(weighted_sums).join(_births_weighted_moments(weighted_sums))
+
+    return merged.reset_index()[BIRTH_STATE_COLUMNS + (BIRTH_POSITION_COLUMNS if positions else [])]
+
+# Broadcasts merged state aggregates onto the county rows, laid out like the data frame of BirthDataStats.pandas_df
+def _birth_county_frame(birth_df, aggregates):
+    """
+    Returns the county rows joined with the statistics of their state and year
+
+    Parameters
+    ----------
+    birth_df : pandas dataframe
+        Parsed rows with the BIRTH_RECORD_COLUMNS
+    aggregates : pandas dataframe
+        Aggregates of the same rows merged by _merge_birth_aggregates with their positions
+    """
+    state_stats = aggregates.set_index(["state", "year"])
+    state_stats["min birth weight by county"] = state_stats["min birth weight by state"]
+    state_stats["max birth weight by county"] = state_stats["max birth weight by state"]
+
+    return birth_df.join(state_stats[BIRTH_COUNTY_STATE_COLUMNS], on=["state", "year"])
+
+# Current resident memory of this process, the high water mark where /proc is not available
+def _current_rss_mb():
+    """
+    Returns the resident set size of this process in MB
+
+    Parameters
+    ----------
+    none
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+class StageProfiler:
+    """
+    Times the stages of a run: loading, aggregating, merging, building figures and exporting. The duration of
+    every stage is always logged at DEBUG. Once enabled it also records the rows, memory delta and optionally a
+    cProfile dump of every stage, and writes them as a JSON report
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether stages are recorded
+    profile_directory : str or None
+        Directory the cProfile dump of each stage is written to, None profiles nothing
+    stages : list of dict
+        The recorded stages in the order they finished
+
+    Methods
+    -------
+    enable(profile_directory)
+        Starts recording stages
+    stage(name)
+        Context manager timing one stage
+    report()
+        Returns the recorded stages and run totals
+    write_report(filename)
+        Writes the report as JSON
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_directory = None
+        self.stages = []
+        self._profiling = False
+        self._start = time.perf_counter()
+        self._started = datetime.now()
+
+    def enable(self, profile_directory=None):
+        """
+        Starts recording stages
+
+        Parameters
+        ----------
+        profile_directory : str or None
+            Directory the cProfile dump of each stage is written to, None profiles nothing
+        """
+        self.enabled = True
+        self.profile_directory = profile_directory
+        self.stages = []
+        self._start = time.perf_counter()
+        self._started = datetime.now()
+
+        if profile_directory:
+            os.makedirs(profile_directory, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the code in the with block as one stage. The block may set "rows" on the yielded dictionary
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, "<data set>.<step>"
+        """
+        record = {"stage": name, "rows": None}
+
+        # A stage inside another profiled stage is timed but not profiled, only one profiler runs at a time
+        profiler = None
+        if self.enabled and self.profile_directory and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+
+        rss_before = _current_rss_mb() if self.enabled else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                self._profiling = False
+            record["seconds"] = time.perf_counter() - start
+            logging.debug(f"{name} took {record['seconds']:.3f}s" + (f" for {record['rows']} rows" if record["rows"] is not None else ""))
+
+            if self.enabled:
+                record["memory_delta_mb"] = _current_rss_mb() - rss_before
+                if profiler:
+                    record["profile"] = os.path.join(self.profile_directory, f"{name}.prof")
+                    profiler.dump_stats(record["profile"])
+                self.stages.append(record)
+
+    def report(self):
+        """
+        Returns a dictionary with the recorded stages, the total wall time and the peak memory of the run
+
+        Parameters
+        ----------
+        None
+        """
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return {"started": self._started.isoformat(timespec="seconds"), "command": sys.argv,
+                "total_seconds": time.perf_counter() - self._start,
+                "peak_rss_mb": peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10),
+                "stages": self.stages}
+
+    def write_report(self, filename):
+        """
+        Writes the report as JSON
+
+        Parameters
+        ----------
+        filename : str
+            File the report is written to
+        """
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info(f"profile of {len(self.stages)} stages written to {filename}")
+
+# The profiler shared by every stage of a run, main enables it with --profile
+PROFILER = StageProfiler()
+
+# Times a whole method as one stage of PROFILER
+def _profiled(name, rows=None):
+    """
+    Returns a decorator timing every call of the method as the stage name
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    rows : function or None
+        Returns the row count of the stage from the value the method returns, None records no rows
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(name) as stage:
+                value = method(*args, **kwargs)
+                if rows:
+                    stage["rows"] = rows(value)
+                return value
+        return wrapper
+    return decorator
+
+# Writes one figure to a file, kept at module level so it can be sent to a process pool
+def _write_figure(fig, filename):
+    """
+    Writes a figure with kaleido and returns the file name with the seconds the export took
+
+    Parameters
+    ----------
+    fig : plotly figure
+        Figure to write
+    filename : str
+        File the figure is written to, the format comes from the extension
+    """
+    start = time.perf_counter()
+    fig.write_image(filename)
+
+    return filename, time.perf_counter() - start
+
+# Writes a figure right away, or queues it on the exporter so it is rendered with the other figures
+def _export_figure(fig, filename, exporter=None):
+    """
+    Writes a figure to a file, or adds it to an exporter that writes all its figures concurrently
+
+    Parameters
+    ----------
+    fig : plotly figure
+        Figure to write
+    filename : str
+        File the figure is written to
+    exporter : FigureExporter or None
+        Exporter to queue the figure on, None writes it now
+    """
+    if exporter is None:
+        filename, seconds = _write_figure(fig, filename)
+        logging.debug(f"{filename} written in {seconds:.2f}s")
+    else:
+        exporter.add(fig, filename)
+
+class FigureExporter:
+    """
+    Collects the figures of a run and renders them concurrently across a process pool, each kaleido
+    export is slow and independent of the others
+
+    Attributes
+    ----------
+    workers : int or None
+        Number of processes rendering figures, None uses one per cpu
+    figures : list of tuple
+        The queued figures and the files they are written to
+
+    Methods
+    -------
+    add(fig, filename)
+        Queues a figure to be written
+    export()
+        Writes every queued figure and returns the seconds each one took
+    """
+
+    def __init__(self, workers=None):
+        """
+        Parameters
+        ----------
+        workers : int or None
+            Number of processes rendering figures, None uses one per cpu
+        """
+        self.workers = workers
+        self.figures = []
+
+    def add(self, fig, filename):
+        """
+        Queues a figure to be written
+
+        Parameters
+        ----------
+        fig : plotly figure
+            Figure to write
+        filename : str
+            File the figure is written to
+        """
+        self.figures.append((fig, filename))
+
+    @_profiled("export.figures", rows=len)
+    def export(self):
+        """
+        Writes every queued figure, in parallel when there is more than one worker and figure, and returns a
+        dictionary of the seconds each file took
+
+        Parameters
+        ----------
+        None
+        """
+        if not self.figures:
+            return {}
+
+        start = time.perf_counter()
+        figures, filenames = [fig for fig, _ in self.figures], [filename for _, filename in self.figures]
+
+        if len(self.figures) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                timings = dict(executor.map(_write_figure, figures, filenames))
+        else:
+            timings = dict(map(_write_figure, figures, filenames))
+
+        for filename, seconds in timings.items():
+            logging.info(f"{filename} written in {seconds:.2f}s")
+        logging.info(f"{len(timings)} figures exported in {time.perf_counter() - start:.2f}s")
+
+        self.figures = []
+        return timings
+
+# Opens an exported csv file for writing text, compressed as asked
+def _open_export(filename, compression=None):
+    """
+    Returns a text file handle writing to filename through the compression
+
+    Parameters
+    ----------
+    filename : str
+        File written
+    compression : str or None
+        "gzip", "zstd" or None for plain text
+    """
+    if compression == "gzip":
+        return gzip.open(filename, "wt", compresslevel=EXPORT_GZIP_LEVEL, newline="")
+    if compression == "zstd":
+        import zstandard
+        return zstandard.open(filename, "wt", newline="")
+
+    return open(filename, "w", newline="")
+
+# Writes one table a chunk at a time, kept at module level so it can be sent to a process pool
+def _write_table(frame, filename, file_format="csv", compression=None, chunksize=EXPORT_CHUNKSIZE):
+    """
+    Writes a data frame to a csv or parquet file chunksize rows at a time and returns the file name with the
+    seconds the export took. The index is written, as DataFrame.to_csv does
+
+    Parameters
+    ----------
+    frame : pandas dataframe
+        Table to write
+    filename : str
+        File the table is written to
+    file_format : str
+        "csv" or "parquet"
+    compression : str or None
+        "gzip", "zstd" or None, parquet files compress their pages with the codec and default to snappy
+    chunksize : int
+        Rows formatted at a time
+    """
+    start = time.perf_counter()
+
+    # An empty frame still writes its header
+    chunk_starts = range(0, max(len(frame), 1), chunksize)
+
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk_start in chunk_starts:
+                table = pa.Table.from_pandas(frame.iloc[chunk_start:chunk_start + chunksize], preserve_index=True)
+                if writer is None:
+                    writer = pq.ParquetWriter(filename, table.schema, compression=compression or "snappy")
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with _open_export(filename, compression) as f:
+            for chunk_start in chunk_starts:
+                frame.iloc[chunk_start:chunk_start + chunksize].to_csv(f, header=chunk_start == 0)
+
+    return filename, time.perf_counter() - start
+
+# Writes a table right away, or queues it on the exporter so it is written with the other tables
+def _export_table(frame, filename, exporter=None):
+    """
+    Writes a data frame to a csv file, or adds it to an exporter that writes all its tables concurrently
+
+    Parameters
+    ----------
+    frame : pandas dataframe
+        Table to write
+    filename : str
+        Csv file the table is written to, the exporter may change its extension or partition it
+    exporter : TableExporter or None
+        Exporter to queue the table on, None writes it now
+    """
+    if exporter is None:
+        filename, seconds = _write_table(frame, filename)
+        logging.debug(f"{filename} written in {seconds:.2f}s")
+    else:
+        exporter.add(frame, filename)
+
+class TableExporter:
+    """
+    Collects the tables of a run and writes them concurrently across a process pool, each compressed and
+    optionally partitioned into one file per state or year
+
+    Attributes
+    ----------
+    workers : int or None
+        Number of processes writing tables, None uses one per cpu
+    file_format : str
+        "csv" or "parquet"
+    compression : str or None
+        "gzip", "zstd" or None
+    partition : str or None
+        "state" or "year" to write one file per value into a directory named after the table, None writes one file
+    chunksize : int
+        Rows formatted at a time
+    tables : list of tuple
+        The queued tables and the files they are written to
+
+    Methods
+    -------
+    filename(filename, value=None)
+        Returns the file a table, or one partition of it, is written to
+    add(frame, filename)
+        Queues a table to be written
+    export()
+        Writes every queued table and returns the seconds each file took
+    """
+
+    def __init__(self, workers=None, file_format="csv", compression=None, partition=None, chunksize=EXPORT_CHUNKSIZE):
+        """
+        Parameters
+        ----------
+        workers : int or None
+            Number of processes writing tables, None uses one per cpu
+        file_format : str
+            "csv" or "parquet"
+        compression : str or None
+            "gzip", "zstd" or None
+        partition : str or None
+            "state", "year" or None
+        chunksize : int
+            Rows formatted at a time
+        """
+        if file_format not in ["csv", "parquet"]:
+            raise ValueError(f"Tables cannot be exported as {file_format}")
+        if compression not in EXPORT_COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, choose one of {[c for c in EXPORT_COMPRESSIONS if c]}")
+        if partition is not None and partition not in EXPORT_PARTITIONS:
+            raise ValueError(f"Tables cannot be partitioned on {partition}, choose one of {EXPORT_PARTITIONS}")
+
+        # Fails before any table is computed rather than after, parquet compresses zstd itself
+        if compression == "zstd" and file_format == "csv":
+            import zstandard
+
+        self.workers = workers
+        self.file_format = file_format
+        self.compression = compression
+        self.partition = partition
+        self.chunksize = chunksize
+        self.tables = []
+
+    def filename(self, filename, value=None):
+        """
+        Returns the file a table is written to, a partition of it goes in a directory named after the table
+
+        Parameters
+        ----------
+        filename : str
+            Csv file the table would be written to without the exporter
+        value : str or None
+            Partition value, None for the whole table
+        """
+        stem = os.path.splitext(filename)[0]
+        extension = ".parquet" if self.file_format == "parquet" else ".csv" + EXPORT_COMPRESSIONS[self.compression]
+
+        if value is None:
+            return stem + extension
+        return os.path.join(stem, f"{self.partition}={str(value).strip()}{extension}")
+
+    def add(self, frame, filename):
+        """
+        Queues a table to be written, split into one file per value of the partition column
+
+        Parameters
+        ----------
+        frame : pandas dataframe
+            Table to write
+        filename : str
+            Csv file the table would be written to without the exporter
+        """
+        if self.partition is None:
+            self.tables.append((frame, self.filename(filename)))
+            return
+
+        # The air quality tables name their columns State and Year, the birth tables state and year
+        column = next((column for column in frame.columns if str(column).lower() == self.partition), None)
+        if column is None:
+            raise ValueError(f"{filename} has no {self.partition} column to partition on")
+
+        os.makedirs(os.path.splitext(filename)[0], exist_ok=True)
+        for value, partition in frame.groupby(column, observed=True, sort=True):
+            self.tables.append((partition, self.filename(filename, value)))
+
+    @_profiled("export.tables", rows=len)
+    def export(self):
+        """
+        Writes every queued table, in parallel when there is more than one worker and file, and returns a
+        dictionary of the seconds each file took
+
+        Parameters
+        ----------
+        None
+        """
+        if not self.tables:
+            return {}
+
+        start = time.perf_counter()
+        frames, filenames = [frame for frame, _ in self.tables], [filename for _, filename in self.tables]
+        options = [self.file_format] * len(frames), [self.compression] * len(frames), [self.chunksize] * len(frames)
+
+        if len(self.tables) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                timings = dict(executor.map(_write_table, frames, filenames, *options))
+        else:
+            timings = dict(map(_write_table, frames, filenames, *options))
+
+        for filename, seconds in timings.items():
+            logging.debug(f"{filename} written in {seconds:.2f}s, {os.path.getsize(filename)} bytes")
+        logging.info(f"{len(timings)} tables exported in {time.perf_counter() - start:.2f}s")
+
+        self.tables = []
+        return timings
+
+# Finds the yearly air quality files, the air quality stage and the parallel ingest look for the same files
+def _find_air_quality_files():
+    """
+    Returns the sorted list of annual_aqi_by_county_*.csv files in the working directory
+
+    Parameters
+    ----------
+    none
+    """
+    csv_files = sorted(glob.glob("annual_aqi_by_county_*.csv"))
+    logging.debug(f"Dataset files found by find_csv_files method:{csv_files}")
+
+    if not csv_files:
+        raise FileNotFoundError("No annual_aqi_by_county_*.csv files found")
+
+    return csv_files
+
+# Reads every yearly air quality file in this process into one raw data frame
+def _read_air_quality_files(csv_files):
+    """
+    Returns the raw air quality data frame of the csv files
+
+    Parameters
+    ----------
+    csv_files : list
+        Yearly air quality csv files
+    """
+    return _concat_categorical([_read_air_quality_file(csv_file) for csv_file in csv_files])
+
+# Reads the natality csv whole into the parsed birth data frame
+def _read_birth_file():
+    """
+    Returns the birth_data.csv rows parsed by _parse_birth_chunk
+
+    Parameters
+    ----------
+    none
+    """
+    return _parse_birth_chunk(pd.read_csv("birth_data.csv", usecols=BIRTH_CSV_COLUMNS, dtype=BIRTH_CSV_DTYPES))
+
+class _SharedBuffer():
+    """
+    Exposes a whole shared memory block to numpy. Every array viewing the block keeps this object as its base,
+    so the block stays mapped exactly as long as some view of it exists
+
+    Attributes
+    ----------
+    block : SharedMemory
+        The mapped block
+    """
+
+    def __init__(self, block):
+        self.block = block
+
+        # The address is read through a short lived ctypes export, numpy then views the memory without exporting it
+        pointer = ctypes.c_char.from_buffer(block.buf)
+        address = ctypes.addressof(pointer)
+        del pointer
+
+        self.__array_interface__ = {"shape": (block.size,), "typestr": "|u1", "data": (address, False), "version": 3}
+
+# Copies the columns of a frame into one shared memory block, kept at module level so a process pool worker can call it
+def _share_frame(data_frame):
+    """
+    Returns a small picklable handle to the frame's columns in a new shared memory block. Numeric columns are
+    copied as they are, string and categorical columns as their categorical codes with the categories in the
+    handle. The block is handed over to the process that attaches it, which unlinks it
+
+    Parameters
+    ----------
+    data_frame : pandas dataframe
+        Frame to share
+    """
+    arrays, columns, strings, offset = [], [], {}, 0
+    for column in data_frame.columns:
+        values = data_frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+            values = pd.Categorical(values)
+            values, strings[column] = values.codes, values.categories.to_numpy(dtype=object)
+        else:
+            values = values.to_numpy()
+
+        # every column starts on an 8 byte boundary
+        offset = -(-offset // 8) * 8
+        arrays.append((offset, values))
+        columns.append((column, values.dtype.str, offset))
+        offset += values.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for start, values in arrays:
+        block.buf[start:start + values.nbytes] = values.tobytes()
+
+    # The attaching process owns the block from here, this process must not unlink it when it exits
+    resource_tracker.unregister(block._name, "shared_memory")
+    block.close()
+
+    return {"name": block.name, "rows": len(data_frame), "columns": columns, "strings": strings}
+
+# Views a frame shared by _share_frame without copying its numeric columns
+def _attach_frame(handle):
+    """
+    Returns the data frame of a handle made by _share_frame. Numeric columns are zero-copy views of the shared
+    block and string columns are categoricals over the shared codes. The block name is unlinked right away,
+    the memory is released once the last view is gone
+
+    Parameters
+    ----------
+    handle : dict
+        Handle returned by _share_frame
+    """
+    block = shared_memory.SharedMemory(name=handle["name"])
+    block.unlink()
+    buffer = np.asarray(_SharedBuffer(block))
+
+    rows = handle["rows"]
+    columns = {}
+    for column, dtype, offset in handle["columns"]:
+        dtype = np.dtype(dtype)
+        values = buffer[offset:offset + rows * dtype.itemsize].view(dtype)
+        columns[column] = pd.Categorical.from_codes(values, handle["strings"][column]) if column in handle["strings"] else values
+
+    return pd.DataFrame(columns, copy=False)
+
+# Parses every yearly air quality file in a worker and shares the result
+def _share_air_quality_files(csv_files):
+    """
+    Returns a _share_frame handle to the raw air quality data frame of the csv files
+
+    Parameters
+    ----------
+    csv_files : list
+        Yearly air quality csv files
+    """
+    return _share_frame(_read_air_quality_files(csv_files))
+
+# Parses the natality csv in a worker and shares the result
+def _share_birth_file():
+    """
+    Returns a _share_frame handle to the parsed birth data frame
+
+    Parameters
+    ----------
+    none
+    """
+    return _share_frame(_read_birth_file())
+
+# Merges one year of air quality and birth data, kept at module level so years can be sent to a process pool
+def _combine_year(air_quality_df, birth_df, fips_crosswalk):
+    """
+    Joins the air quality counties of one year with the birth data of the same year on their FIPS codes, and
+    returns the merged data frame, its quadrant breakdown, and the air quality and birth rows with no match
+
+    Parameters
+    ----------
+    air_quality_df : pandas dataframe
+        One year of the Import_AirQuality_Data data frame
+    birth_df : pandas dataframe
+        The same year of the BirthDataStats data frame
+    fips_crosswalk : pandas series
+        FIPS codes indexed by state abbreviation and normalized county name
+    """
+    birth_df = birth_df.drop_duplicates(subset=["county", "state"])
+    birth_df = birth_df.assign(Year=birth_df["year"].astype(np.int64))
+
+    # Looks up the FIPS code of every air quality county by state and normalized name
+    county_keys = pd.MultiIndex.from_arrays([air_quality_df["state_abbrev"], _county_key(air_quality_df["County"])])
+    air_quality_fips = fips_crosswalk.reindex(county_keys).to_numpy(dtype=np.float64)
+    no_fips = np.isnan(air_quality_fips)
+
+    # Joins on integer county and year keys so each year of air quality is matched with births from the same year
+    matched_df = air_quality_df[~no_fips].assign(fips=air_quality_fips[~no_fips].astype(np.int64))
+    air_quality_keys = matched_df["fips"].to_numpy() * 10000 + matched_df["Year"].to_numpy()
+    birth_keys = birth_df["fips"].to_numpy() * 10000 + birth_df["Year"].to_numpy()
+
+    unmatched_air_quality = pd.concat([air_quality_df[no_fips],
+                                       matched_df[~np.isin(air_quality_keys, birth_keys)].drop(columns="fips")])
+    unmatched_birth = birth_df[~np.isin(birth_keys, air_quality_keys)]
+
+    merged_df = pd.merge(matched_df, birth_df, on=["fips", "Year"])
+
+    return merged_df, _quadrant_breakdown(merged_df), unmatched_air_quality, unmatched_birth
+
+# Stacks the combined frames of each year into the long format frames with one block of rows per year
+def _concat_combined(yearly_frames):
+    """
+    Returns the merged, breakdown and unmatched data frames of every year concatenated by name
+
+    Parameters
+    ----------
+    yearly_frames : list of dict
+        The frames of each year by name, in year order
+    """
+    combined_frames = {name: pd.concat([frames[name] for frames in yearly_frames], ignore_index=True)
+                       if yearly_frames else pd.DataFrame() for name in COMBINED_FRAME_NAMES}
+
+    logging.info(f"{len(combined_frames['merged_dataframe'])} counties matched, "
+                 f"{len(combined_frames['unmatched_air_quality'])} air quality rows and "
+                 f"{len(combined_frames['unmatched_birth'])} birth rows had no match")
+
+    return combined_frames
+
+# Breaks down the states straight from the state aggregates, used when the birth csv was streamed
+def _streamed_breakdown(air_quality_df, state_df, years):
+    """
+    Returns the quadrant breakdown of every year from the air quality scores and the births state aggregates,
+    joined on state abbreviation and year. Without county rows there is no county merge, so every state in both
+    data sets is broken down rather than only the states with a matched county
+
+    Parameters
+    ----------
+    air_quality_df : pandas dataframe
+        The Import_AirQuality_Data data frame
+    state_df : pandas dataframe
+        The BirthDataStats state aggregates
+    years : list of int
+        Years to break down
+    """
+    states = air_quality_df.loc[air_quality_df["Year"].isin(years), ["State", "Year", "state_abbrev", "air_quality_score"]]
+    states = states.drop_duplicates(subset=["State", "Year"]).assign(state_abbrev=lambda frame: frame["state_abbrev"].astype(str))
+
+    birth_keys = _birth_index_keys(state_df)
+    births = pd.DataFrame({"Year": np.asarray(birth_keys[0], dtype=np.int64), "state_abbrev": np.asarray(birth_keys[1], dtype=str),
+                           "avg_birth_weight_by_state": state_df["avg_birth_weight_by_state"].to_numpy()})
+
+    joined = states.merge(births, on=["Year", "state_abbrev"])
+    breakdowns = [_quadrant_breakdown(joined[joined["Year"] == year]) for year in years]
+
+    return pd.concat(breakdowns, ignore_index=True) if breakdowns else pd.DataFrame()
+
+# Parquet keeps the quadrant numbers but not their categories, loaded breakdowns get them back
+def _restore_quadrants(frames):
+    """
+    Returns the combined frames with the quadrant column of the breakdown categorical again, categories in
+    QUADRANT_TITLES order
+
+    Parameters
+    ----------
+    frames : dict of pandas dataframe
+        Combined frames by name, as loaded from a FrameCache
+    """
+    breakdown = frames.get("breakdown_dataframe")
+    if breakdown is not None and "quadrant" in breakdown:
+        frames["breakdown_dataframe"] = breakdown.assign(quadrant=pd.Categorical(breakdown["quadrant"].astype(np.int64),
+                                                                                 categories=list(QUADRANT_TITLES)))
+
+    return frames
+
+# Places every state of one year in a quadrant by its air quality score and average birth weight
+def _quadrant_breakdown(merged_df):
+    """
+    Returns one row per state with its air quality score (AQS), average birth weight (ABW) and quadrant.
+    The boundaries are the medians of ABW and AQS: quadrant 1 high ABW and high AQS, quadrant 2 low ABW and
+    high AQS, quadrant 3 low ABW and low AQS, quadrant 4 high ABW and low AQS, and 0 for a state on a median
+
+    Parameters
+    ----------
+    merged_df : pandas dataframe
+        One year of the merged air quality and birth data
+    """
+    breakdown = merged_df[["State", "Year", "air_quality_score", "avg_birth_weight_by_state"]].drop_duplicates()
+    breakdown["avg_birth_weight_by_state"] = breakdown["avg_birth_weight_by_state"].round(QUADRANT_VALUE_DECIMALS)
+    breakdown["air_quality_score"] = breakdown["air_quality_score"].round(QUADRANT_VALUE_DECIMALS)
+
+    # setting median values for quadrant boundaries, rounded the way _quadrant_sides rounds the resampled medians
+    median_bw = np.round(np.median(breakdown["avg_birth_weight_by_state"].to_numpy()), QUADRANT_MEDIAN_DECIMALS)
+    median_aqs = np.round(np.median(breakdown["air_quality_score"].to_numpy()), QUADRANT_MEDIAN_DECIMALS)
+
+    breakdown["quadrant"] = _quadrant_labels(breakdown["avg_birth_weight_by_state"].to_numpy(),
+                                             breakdown["air_quality_score"].to_numpy(), median_bw, median_aqs)
+
+    return breakdown.reset_index(drop=True)
+
+# Labels every state with its quadrant in one pass over the ABW and AQS arrays
+def _quadrant_labels(bw, aqs, median_bw, median_aqs):
+    """
+    Returns a categorical of quadrant numbers, looked up in QUADRANT_BY_SIGN from the sign of each state's
+    ABW and AQS relative to the medians
+
+    Parameters
+    ----------
+    bw : numpy array
+        Average birth weight by state
+    aqs : numpy array
+        Air quality score by state
+    median_bw : float
+        ABW quadrant boundary
+    median_aqs : float
+        AQS quadrant boundary
+    """
+    quadrants = np.array(QUADRANT_BY_SIGN)[np.sign(bw - median_bw).astype(np.int64) + 1,
+                                                   np.sign(aqs - median_aqs).astype(np.int64) + 1]
+
+    return pd.Categorical(quadrants, categories=list(QUADRANT_TITLES))
+
+# Pearson and Spearman correlation of two arrays with permutation test p-values
+def _correlation_tests(x, y, permutations, rng):
+    """
+    Returns the Pearson r and Spearman rho of x and y and their two sided permutation test p-values.
+    Every permutation is a row of one index matrix, so the null correlations of both tests come from a single
+    batched product of the permuted, standardized values
+
+    Parameters
+    ----------
+    x : numpy array
+        First variable
+    y : numpy array
+        Second variable, the one permuted
+    permutations : int
+        Number of permutations in the null distribution
+    rng : numpy Generator
+        Random generator the permutations are drawn from
+    """
+    values = np.stack([np.stack([x, y]), np.stack([pd.Series(x).rank().to_numpy(), pd.Series(y).rank().to_numpy()])])
+    values = values - values.mean(axis=2, keepdims=True)
+    values = values / np.sqrt((values ** 2).sum(axis=2, keepdims=True))
+
+    # values[test, variable, state], a correlation is the dot product of the two standardized variables
+    observed = (values[:, 0] * values[:, 1]).sum(axis=1)
+
+    order = rng.random((permutations, len(x))).argsort(axis=1)
+    null = np.einsum("tn,tpn->tp", values[:, 0], values[:, 1][:, order])
+    p_values = (1 + (np.abs(null) >= np.abs(observed)[:, None] - 1e-12).sum(axis=1)) / (permutations + 1)
+
+    return observed[0], p_values[0], observed[1], p_values[1]
+
+# Counts the states in each quadrant and tests the correlation of ABW and AQS for every year of a breakdown
+def _quadrant_statistics(breakdown_df, permutations=1000, seed=None):
+    """
+    Returns one row per year with the number of states, the states in each quadrant, and the Pearson and
+    Spearman correlation of air quality score and average birth weight with their permutation p-values
+
+    Parameters
+    ----------
+    breakdown_df : pandas dataframe
+        Quadrant breakdown of one or more years, as made by _quadrant_breakdown
+    permutations : int
+        Number of permutations in each test
+    seed : int or None
+        Seed of the permutations, None draws fresh ones
+    """
+    rng = np.random.default_rng(seed)
+
+    # Every quadrant gets a column in QUADRANT_TITLES order, even when no state is in it
+    counts = pd.crosstab(breakdown_df["Year"], breakdown_df["quadrant"]).reindex(columns=list(QUADRANT_TITLES), fill_value=0)
+    counts.columns = [f"quadrant_{quadrant}" for quadrant in counts.columns]
+
+    tests = []
+    for year, year_df in breakdown_df.groupby("Year"):
+        tests.append((year, len(year_df), *_correlation_tests(year_df["avg_birth_weight_by_state"].to_numpy(),
+                                                               year_df["air_quality_score"].to_numpy(),
+                                                               permutations, rng)))
+    tests = pd.DataFrame(tests, columns=["Year", "states", "pearson_r", "pearson_p", "spearman_rho", "spearman_p"])
+
+    return tests.join(counts, on="Year")
+
+# Pearson correlation of every row of x with the same row of y
+def _row_correlations(x, y):
+    """
+    Returns the Pearson correlation of each pair of rows, nan for a row with no spread
+
+    Parameters
+    ----------
+    x : numpy array
+        One sample per row
+    y : numpy array
+        Paired sample per row, the same shape as x
+    """
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (x * y).sum(axis=1) / np.sqrt((x ** 2).sum(axis=1) * (y ** 2).sum(axis=1))
+
+# Share of every row that falls in quadrant 2 or 4 around the row's own medians
+def _quadrant_sides(values):
+    """
+    Returns for each row the sign of every value from the row median, with the values and median rounded like
+    _quadrant_breakdown rounds them so the sides match the published quadrants
+
+    Parameters
+    ----------
+    values : numpy array
+        One sample per row
+    """
+    values = np.round(values, QUADRANT_VALUE_DECIMALS)
+    medians = np.round(np.median(values, axis=1, keepdims=True), QUADRANT_MEDIAN_DECIMALS)
+
+    return np.sign(values - medians)
+
+def _opposite_quadrant_shares(x, y):
+    """
+    Returns for each row the share of points with x and y on opposite sides of their medians, that is low ABW
+    and high AQS (quadrant 2) or high ABW and low AQS (quadrant 4)
+
+    Parameters
+    ----------
+    x : numpy array
+        Average birth weight, one sample per row
+    y : numpy array
+        Air quality score, paired sample per row
+    """
+    return (_quadrant_sides(x) * _quadrant_sides(y) == -1).mean(axis=1)
+
+# Draws one batch of replicates, kept at module level so batches can be sent to a process pool
+def _resample_batch(bw, aqs, method, replicates, seed):
+    """
+    Returns a replicates by RESAMPLING_STATISTICS array. A bootstrap batch draws every row of its index matrix
+    with replacement, a permutation batch shuffles AQS against ABW
+
+    Parameters
+    ----------
+    bw : numpy array
+        Average birth weight of every state or county
+    aqs : numpy array
+        Air quality score of the same states or counties
+    method : str
+        Either "bootstrap" or "permutation"
+    replicates : int
+        Number of replicates in the batch
+    seed : numpy SeedSequence
+        Seed of the batch
+    """
+    rng = np.random.default_rng(seed)
+
+    if method == "bootstrap":
+        rows = rng.integers(0, len(bw), size=(replicates, len(bw)))
+        x, y = bw[rows], aqs[rows]
+    else:
+        rows = rng.random((replicates, len(bw))).argsort(axis=1)
+        x, y = np.broadcast_to(bw, rows.shape), aqs[rows]
+
+    return np.column_stack([_row_correlations(x, y), _opposite_quadrant_shares(x, y)])
+
+class AirQuality_obj:
+    """
+    A class that represents different aspects of air quality for one county in the USA
+
+    Attributes
+    ----------
+    state : str
+        The state the county is located in
+    county : str
+        The county being examined
+    year : int
+        The year being examined
+    good_days : int
+        The number of days in the year with AQI considered good
+    moderate_days : int
+        The number of days in the year with AQI considered moderate
+    unhealthy_days : int
+        The number of days in the year with AQI considered unhealthy
+    very_unhealthy_days : int
+        The number of days in the year with AQI considered very unhealthy
+    hazardous_days : int
+        The number of days in the year with AQI considered hazardous
+    max_aqi : int
+        The max AQI observed on any day of the year
+
+    """
+
+    # Slots drop the per-instance __dict__, the objects are only ever built as row views of a RecordStore
+    __slots__ = ("state", "county", "year", "good_days", "moderate_days", "unhealthy_days",
+                 "very_unhealthy_days", "hazardous_days", "max_aqi")
+
+    def __init__(self, state, county, year, good_days, moderate_days, unhealthy_days,
+                very_unhealthy_days, hazardous_days, max_aqi):
+        """
+        Parameters
+        ----------
+        state : str
+            The state the county is located in
+        county : str
+            The county being examined
+        year : int
+            The year being examined
+        good_days : int
+            The number of days in the year with AQI considered good
+        moderate_days : int
+            The number of days in the year with AQI considered moderate
+        unhealthy_days : int
+            The number of days in the year with AQI considered unhealthy
+        very_unhealthy_days : int
+            The number of days in the year with AQI considered very unhealthy
+        hazardous_days : int
+            The number of days in the year with AQI considered hazardous
+        max_aqi : int
+            The max AQI observed on any day of the year
+        """
+        self.state = str(state)
+        self.county = str(county)
+        self.year = int(year)
+        self.good_days = int(good_days)
+        self.moderate_days = int(moderate_days)
+        self.unhealthy_days = int(unhealthy_days)
+        self.very_unhealthy_days = int(very_unhealthy_days)
+        self.hazardous_days = int(hazardous_days)
+        self.max_aqi = int(max_aqi)
+
+
+    # String representation of the object, human friendly display
+    def __str__(self):
+        string = f"{str(self.state)}     {str(self.county)}     {str(self.year)} \n\nGood days: {str(self.good_days)}\n"\
+                 f"Moderate days: {str(self.moderate_days)}\nUnhealthy days: {str(self.unhealthy_days)}\n"\
+                 f"Very unhealthy days: {str(self.very_unhealthy_days)}\nHazardous days: {str(self.hazardous_days)}\n"\
+                 f"Max AQI: {str(self.max_aqi)}"
+
+        return string
+
+    # String representation of the object
+    def __repr__(self):
+        return "AirQuality_obj(" + str(self.state) + ", " + str(self.county) + ", " + str(self.year) + ", " + str(self.good_days) \
+                + ", " + str(self.moderate_days) + ", " + str(self.unhealthy_days) + ", " + str(self.very_unhealthy_days) + ", " \
+                + str(self.hazardous_days) + ", " + str(self.max_aqi) + ")"
+
+    # Enables use of less than operator for two AirQuality_obj objects
+    def __lt__(self, other):
+        """
+        Enables use of the less than operator to determine which object has worse air quality
+
+        Parameters
+        ----------
+        other : AirQuality-obj
+            Object to compare to
+        """
+        if type(self) is type(other):
+
+            self_tuple = (self.hazardous_days, self.very_unhealthy_days, self.unhealthy_days, self.moderate_days)
+            other_tuple = (other.hazardous_days, other.very_unhealthy_days, other.unhealthy_days, other.moderate_days)
+
+            return self_tuple < other_tuple
+        elif other is None:
+            return False
+        else:
+            return NotImplemented
+
+    # Enables use of greater than operator for two AirQuality_obj objects
+    def __gt__(self, other):
+        """
+        Enables use of the greater than operator to determine which object has worse air quality
+
+        Parameters
+        ----------
+        other : AirQuality-obj
+            Object to compare to
+        """
+        if type(self) is type(other):
+
+            self_tuple = (self.hazardous_days, self.very_unhealthy_days, self.unhealthy_days, self.moderate_days)
+            other_tuple = (other.hazardous_days, other.very_unhealthy_days, other.unhealthy_days, other.moderate_days)
+
+            return self_tuple > other_tuple
+        
+        elif other is None:
+            return True
+        else:
+            return NotImplemented
+
+class RecordStore:
+    """
+    A struct-of-arrays container that holds a whole data set column by column in numpy arrays and hands out
+    one record object per row on demand, instead of keeping a Python object alive for every row
+
+    Attributes
+    ----------
+    record_type : class
+        The class built for each row, its constructor takes the fields in column order
+    columns : dict of np.array
+        The numeric columns, keyed by field name
+    string_columns : dict of tuple
+        The string columns as integer codes and the array of distinct strings the codes point into
+
+    Methods
+    -------
+    column(name)
+        Returns a whole column as a numpy array
+    to_dataframe()
+        Returns the store as a pandas data frame with one column per field
+    """
+
+    def __init__(self, record_type, columns, record_fields=None):
+        """
+        Parameters
+        ----------
+        record_type : class
+            The class built for each row, its constructor takes the fields in column order
+        columns : dict
+            Field name to column values, in the order the record_type constructor takes them. Object and
+            categorical columns are stored as integer codes into a sorted dictionary of distinct strings
+        record_fields : list of str or None
+            The columns passed to the record_type constructor, None passes every column
+        """
+        self.record_type = record_type
+        self.fields = list(columns)
+        self.record_fields = list(record_fields) if record_fields is not None else self.fields
+        self.columns = {}
+        self.string_columns = {}
+
+        for name, values in columns.items():
+            if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+                # A categorical already holds its codes, only other string columns are encoded here
+                values = pd.Categorical(values)
+                self.string_columns[name] = (values.codes.astype(np.int32), values.categories.to_numpy(dtype=object))
+            else:
+                self.columns[name] = np.asarray(values)
+
+        self._length = len(next(iter(columns.values()))) if columns else 0
+
+    def __len__(self):
+        return self._length
+
+    # Builds the record object for one row, or a list of them for a slice
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+
+        return self.record_type(*[self.column(name)[index].item() if name in self.columns
+                                  else self.string_columns[name][1][self.string_columns[name][0][index]]
+                                  for name in self.record_fields])
+
+    def __iter__(self):
+        values = [self.column(name).tolist() for name in self.record_fields]
+        return (self.record_type(*row) for row in zip(*values))
+
+    def column(self, name):
+        """
+        Returns a whole column as a numpy array, string columns are decoded from their codes
+
+        Parameters
+        ----------
+        name : str
+            Field name of the column
+        """
+        if name in self.string_columns:
+            codes, uniques = self.string_columns[name]
+            return uniques.take(codes)
+
+        return self.columns[name]
+
+    def to_dataframe(self):
+        """
+        Returns the store as a pandas data frame with one column per field, string columns are categoricals
+        over the same codes
+
+        Parameters
+        ----------
+        None
+        """
+        return pd.DataFrame({name: pd.Categorical.from_codes(*self.string_columns[name]) if name in self.string_columns
+                             else self.columns[name] for name in self.fields})
+
+# Resolves the year asked for against the years a data set holds
+def _checked_year(year, years, data_set):
+    """
+    Returns the year as an int, the latest year when None, and raises a ValueError naming the years held when
+    the year is not one of them
+
+    Parameters
+    ----------
+    year : int, str or None
+        Year asked for
+    years : list of int
+        Sorted years the data set holds
+    data_set : str
+        Name of the data set used in the error
+    """
+    if not len(years):
+        raise ValueError(f"The {data_set} holds no year")
+    if year is None:
+        return years[-1]
+    if int(year) not in years:
+        raise ValueError(f"{year} is not a year of the {data_set}, the years available are {list(years)}")
+
+    return int(year)
+
+class FrameIndex:
+    """
+    A hash index of the rows of a data frame by a key of one or more columns. Lookups go through a dictionary
+    of row positions instead of comparing whole columns, and a lookup by the first columns of the key only
+    answers from a dictionary built once per key length
+
+    Attributes
+    ----------
+    data_frame : pandas dataframe
+        The indexed data frame
+    levels : list of list
+        The sorted distinct values of each column of the key
+
+    Methods
+    -------
+    positions(*key)
+        Returns the positions of the rows matching a key or the first columns of one
+    rows(*key)
+        Returns the rows matching a key or the first columns of one
+    record(*key)
+        Returns the first row matching a key as a dictionary
+    """
+
+    def __init__(self, data_frame, keys):
+        """
+        Parameters
+        ----------
+        data_frame : pandas dataframe
+            The data frame to index
+        keys : list
+            The key, each a column name or an array the length of the data frame
+        """
+        self.data_frame = data_frame
+        self._length = len(keys)
+
+        positions = data_frame.groupby(keys, observed=True, sort=False).indices if len(data_frame) else {}
+        self._positions = {self._length: {key if self._length > 1 else (key,): rows for key, rows in positions.items()}}
+        self.levels = [sorted({key[level] for key in self._positions[self._length]}) for level in range(self._length)]
+        self._columns = None
+
+        logging.debug(f"{len(positions)} keys indexed over {len(data_frame)} rows")
+
+    def __contains__(self, key):
+        return len(self.positions(*key)) > 0
+
+    def _prefix_positions(self, length):
+        """
+        Returns the dictionary of row positions by the first length columns of the key, built on first use
+
+        Parameters
+        ----------
+        length : int
+            Number of key columns
+        """
+        if length not in self._positions:
+            groups = defaultdict(list)
+            for key, rows in self._positions[self._length].items():
+                groups[key[:length]].append(rows)
+            self._positions[length] = {key: np.sort(np.concatenate(rows)) for key, rows in groups.items()}
+
+        return self._positions[length]
+
+    def positions(self, *key):
+        """
+        Returns the ascending positions of the rows matching the key, empty when nothing matches
+
+        Parameters
+        ----------
+        key : values
+            The whole key, or its first columns to match every row starting with them
+        """
+        if len(key) > self._length:
+            raise ValueError(f"key {key} is longer than the {self._length} indexed columns")
+
+        return self._prefix_positions(len(key)).get(key, np.empty(0, dtype=np.intp))
+
+    def rows(self, *key):
+        """
+        Returns the rows matching the key in the order of the data frame
+
+        Parameters
+        ----------
+        key : values
+            The whole key, or its first columns to match every row starting with them
+        """
+        return self.data_frame.take(self.positions(*key))
+
+    def record(self, *key):
+        """
+        Returns the first row matching the key as a dictionary of column name to value
+
+        Parameters
+        ----------
+        key : values
+            The whole key, or its first columns
+        """
+        positions = self.positions(*key)
+        if not len(positions):
+            raise ValueError(f"No rows for {key}")
+
+        # Each column is converted to numpy once, a record is then read without building a data frame row
+        if self._columns is None:
+            self._columns = {column: self.data_frame[column].to_numpy() for column in self.data_frame.columns}
+
+        return {column: values[positions[0]] for column, values in self._columns.items()}
+
+# Hashes the content of a file, or only its first length bytes
+def _file_digest(path, length=None):
+    """
+    Returns the sha256 hex digest of a file
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    length : int or None
+        Number of bytes hashed from the start of the file, None hashes all of it
+    """
+    digest = hashlib.sha256()
+    remaining = length
+
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            block = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    return digest.hexdigest()
+
+# Fingerprints taken in this process by absolute path, so each source file is hashed at most once per run
+_FILE_FINGERPRINTS = {}
+
+# Fingerprints a file from its stat, only reading it when no fingerprint with the same stat is known
+def _file_fingerprint(path, *fingerprints):
+    """
+    Returns the size, modification time and sha256 digest of a file. The digest of a fingerprint taken earlier
+    in this process, or given in fingerprints, is reused while the size and modification time are unchanged
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    fingerprints : dict
+        Known fingerprints by absolute path, from an earlier run or a snapshot manifest
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    for entry in [_FILE_FINGERPRINTS.get(path)] + [known.get(path) for known in fingerprints]:
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            break
+    else:
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": _file_digest(path)}
+        logging.debug(f"{path} fingerprinted")
+
+    _FILE_FINGERPRINTS[path] = entry
+    return entry
+
+# Manifest entry of a file, shared by the snapshots and the incremental refresh
+def _file_entry(path):
+    """
+    Returns the size, modification time and sha256 digest of a file, from the same fingerprint the frame
+    cache keys on
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    """
+    return dict(_file_fingerprint(path))
+
+# Checks a file against its manifest entry with a stat, and only reads it when the stat moved
+def _file_changed(path, entry):
+    """
+    Returns whether a file differs from its manifest entry, only hashing it when its size or modification
+    time moved
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    entry : dict or None
+        Manifest entry of the file, None when it was never processed
+    """
+    if entry is None:
+        return True
+
+    stat = os.stat(path)
+    if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+        return False
+
+    return _file_fingerprint(path)["digest"] != entry["digest"]
+
+# Fingerprints source files and parameters for the frame cache
+def _source_key(source_files, fingerprints=(), **parameters):
+    """
+    Returns a key that changes whenever a source file or a parameter changes
+
+    Parameters
+    ----------
+    source_files : list of str
+        Paths of the files the frames are derived from
+    fingerprints : list of dict
+        Known fingerprints by absolute path, a file whose stat still matches one of them is not hashed again
+    parameters : dict
+        Any other values the frames depend on
+    """
+    digest = hashlib.sha256()
+
+    for source_file in sorted(source_files):
+        entry = _file_fingerprint(source_file, *fingerprints)
+        digest.update(f"{source_file}:{entry['mtime_ns']}:{entry['size']}:{entry['digest']}".encode())
+
+    digest.update(json.dumps({"format": CACHE_FORMAT_VERSION, **parameters}, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()[:16]
+
+class FrameCache:
+    """
+    An on-disk cache of derived data frames stored as parquet files. Entries are keyed on the content hash,
+    modification time and size of the source files plus any parameters, so a changed input or parameter
+    misses the cache and the stale entry is replaced. The fingerprints of the source files are kept in
+    fingerprints.json, a later run only stats the files and hashes the ones whose stat moved
+
+    Attributes
+    ----------
+    directory : str
+        Directory holding one sub directory of parquet files per cached stage
+
+    Methods
+    -------
+    key(source_files, fingerprints=(), **parameters)
+        Returns the cache key for a set of source files and parameters
+    load(stage, key)
+        Returns the cached frames of a stage, or None on a miss
+    store(stage, key, frames)
+        Writes the frames of a stage, replacing any older entry of that stage
+    """
+
+    def __init__(self, directory=".aq_cache"):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory holding the cached frames
+        """
+        self.directory = directory
+
+    # Fingerprints written by earlier runs, read once
+    @cached_property
+    def _fingerprints(self):
+        try:
+            with open(os.path.join(self.directory, "fingerprints.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def key(self, source_files, fingerprints=(), **parameters):
+        """
+        Returns a key that changes whenever a source file or a parameter changes, and records the fingerprints
+        of the source files for later runs
+
+        Parameters
+        ----------
+        source_files : list of str
+            Paths of the files the frames are derived from
+        fingerprints : list of dict
+            Other known fingerprints by absolute path, such as those of a snapshot manifest
+        parameters : dict
+            Any other values the frames depend on
+        """
+        key = _source_key(source_files, [self._fingerprints, *fingerprints], **parameters)
+
+        fingerprints = {os.path.abspath(path): _file_fingerprint(path) for path in source_files}
+        if any(self._fingerprints.get(path) != entry for path, entry in fingerprints.items()):
+            self._fingerprints.update(fingerprints)
+            filename = os.path.join(self.directory, "fingerprints.json")
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(filename + ".partial", "w") as f:
+                    json.dump(self._fingerprints, f)
+                os.replace(filename + ".partial", filename)
+            except OSError as e:
+                logging.warning(f"fingerprints could not be written to {filename}: {e}")
+
+        return key
+
+    def load(self, stage, key):
+        """
+        Returns a dictionary of the cached frames of a stage by name, or None when the key is not cached
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage the frames belong to
+        key : str
+            Key returned by the key method
+        """
+        entry = os.path.join(self.directory, f"{stage}-{key}")
+
+        if not os.path.isdir(entry):
+            logging.debug(f"cache miss for {stage}")
+            return None
+
+        try:
+            with PROFILER.stage(f"{stage}.cache_load"):
+                frames = {name[:-len(".parquet")]: pd.read_parquet(os.path.join(entry, name))
+                          for name in os.listdir(entry) if name.endswith(".parquet")}
+        except (ImportError, OSError, ValueError) as e:
+            logging.warning(f"cache entry for {stage} could not be read: {e}")
+            return None
+
+        logging.debug(f"cache hit for {stage}")
+        return frames
+
+    def store(self, stage, key, frames):
+        """
+        Writes the frames of a stage and removes any older entry of the same stage
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage the frames belong to
+        key : str
+            Key returned by the key method
+        frames : dict of pandas dataframe
+            The frames to cache by name
+        """
+        entry = os.path.join(self.directory, f"{stage}-{key}")
+        partial_entry = entry + ".partial"
+
+        try:
+            os.makedirs(partial_entry, exist_ok=True)
+            for name, frame in frames.items():
+                frame.to_parquet(os.path.join(partial_entry, f"{name}.parquet"))
+        except (ImportError, OSError, ValueError) as e:
+            logging.warning(f"frames for {stage} could not be cached: {e}")
+            shutil.rmtree(partial_entry, ignore_errors=True)
+            return
+
+        # Replaces older entries of the stage, written to a temporary name first so a crash never leaves half an entry
+        for old_entry in glob.glob(os.path.join(self.directory, f"{stage}-*")):
+            if old_entry != partial_entry:
+                shutil.rmtree(old_entry, ignore_errors=True)
+        os.rename(partial_entry, entry)
+        logging.debug(f"frames for {stage} cached in {entry}")
+
+class Snapshot:
+    """
+    A binary snapshot of the parsed data sets. Every numeric column is one .npy file and every string column
+    is one .npy file of categorical codes into a string dictionary, so a snapshot opens with np.load(mmap_mode="r")
+    without parsing anything and concurrent processes share the same pages. A snapshot records the size,
+    modification time and digest of the csv files it was made from and is ignored once they change. Opening it
+    only stats the csv files, they are hashed when a stat moved
+
+    Attributes
+    ----------
+    directory : str
+        Directory holding one sub directory per data set
+
+    Methods
+    -------
+    write(name, data_frame, source_files)
+        Writes the snapshot of a parsed data set
+    read(name, source_files)
+        Returns the memory mapped data set, or None when there is no current snapshot
+    fingerprints(name)
+        Returns the fingerprints of the csv files recorded in the manifest of a data set
+    """
+
+    def __init__(self, directory=".aq_snapshot"):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory holding the snapshots
+        """
+        self.directory = directory
+
+    def write(self, name, data_frame, source_files):
+        """
+        Writes every column of a parsed data set and a manifest of the columns, replacing any older snapshot of it
+
+        Parameters
+        ----------
+        name : str
+            Name of the data set
+        data_frame : pandas dataframe
+            The parsed data set
+        source_files : list of str
+            Paths of the csv files the data set was parsed from
+        """
+        entry = os.path.join(self.directory, name)
+        partial_entry = entry + ".partial"
+        shutil.rmtree(partial_entry, ignore_errors=True)
+        os.makedirs(partial_entry)
+
+        columns, strings = [], {}
+        for index, column in enumerate(data_frame.columns):
+            values = data_frame[column]
+            if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+                values = pd.Categorical(values)
+                values, strings[column] = values.codes, values.categories.tolist()
+            else:
+                values = values.to_numpy()
+
+            np.save(os.path.join(partial_entry, f"{index:03d}.npy"), values)
+            columns.append(column)
+
+        with open(os.path.join(partial_entry, "strings.json"), "w") as f:
+            json.dump(strings, f)
+        with open(os.path.join(partial_entry, "manifest.json"), "w") as f:
+            json.dump({"format": CACHE_FORMAT_VERSION, "files": {path: _file_entry(path) for path in source_files},
+                       "rows": len(data_frame), "columns": columns}, f)
+
+        # Written under a temporary name first so a crash never leaves half a snapshot
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(partial_entry, entry)
+        logging.info(f"{len(data_frame)} rows of {name} written to the snapshot in {entry}")
+
+    def read(self, name, source_files):
+        """
+        Returns the data set with its numeric columns memory mapped read only, or None when there is no snapshot
+        of it or the csv files changed since it was written
+
+        Parameters
+        ----------
+        name : str
+            Name of the data set
+        source_files : list of str
+            Paths of the csv files the data set is parsed from
+        """
+        entry = os.path.join(self.directory, name)
+
+        try:
+            with open(os.path.join(entry, "manifest.json")) as f:
+                manifest = json.load(f)
+            with open(os.path.join(entry, "strings.json")) as f:
+                strings = json.load(f)
+        except (OSError, ValueError):
+            logging.debug(f"no snapshot of {name}")
+            return None
+
+        files = manifest.get("files", {})
+        if manifest.get("format") != CACHE_FORMAT_VERSION or set(files) != set(source_files) \
+                or any(_file_changed(path, files[path]) for path in source_files):
+            logging.warning(f"snapshot of {name} is older than its csv files and is ignored")
+            return None
+
+        with PROFILER.stage(f"{name}.snapshot_read") as stage:
+            columns = {}
+            for index, column in enumerate(manifest["columns"]):
+                values = np.load(os.path.join(entry, f"{index:03d}.npy"), mmap_mode="r")
+                columns[column] = pd.Categorical.from_codes(values, strings[column]) if column in strings else values
+            stage["rows"] = manifest["rows"]
+
+        logging.debug(f"{manifest['rows']} rows of {name} opened from the snapshot")
+        return pd.DataFrame(columns, copy=False)
+
+    def fingerprints(self, name):
+        """
+        Returns the fingerprints of the csv files a data set was written from by absolute path, so the frame
+        cache keys on them without hashing the files again, or an empty dict when there is no snapshot of it
+
+        Parameters
+        ----------
+        name : str
+            Name of the data set
+        """
+        try:
+            with open(os.path.join(self.directory, name, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if manifest.get("format") != CACHE_FORMAT_VERSION:
+            return {}
+
+        return {os.path.abspath(path): entry for path, entry in manifest.get("files", {}).items()}
+
+class Import_AirQuality_Data:
+    """
+    A class that loads in a whole air quality dataset in a year by county
+
+    Every annual_aqi_by_county_*.csv file in the directory is loaded, one year per file, and the years are
+    combined into one data set. The numpy array, indexed data frame, object list, county rankings and best
+    and worst data frame are built the first time they are used
+
+    Attributes
+    ----------
+    workers : int or None
+        Number of processes used to read the yearly files, None uses one per cpu
+    weights : dict
+        Weight given to the state mean of each kind of day in the air quality score
+    cache : FrameCache or None
+        Cache of the parsed and derived frames
+    csv_files : list of str
+        The yearly csv files loaded
+    raw_dataframe : pandas dataframe
+        The parsed csv files, every other structure is derived from it
+    numpy_arrays : np.array
+        A numpy array that holds all the numerical data 
+    dataframe  : pandas dataframe
+        A data frame containing all the info from the original csv, and calculated columns for visualizations
+    indexed_dataframe : pandas dataframe
+        The same data frame indexed by State, County and Year
+    county_index : FrameIndex
+        Hash index of the data frame rows by Year, State and County
+    state_dataframe : pandas dataframe
+        The state means of each kind of day for every state and year
+    obj_list : RecordStore of AirQuality_obj
+        A column store handing out the objects representing a row of data
+
+    Methods
+    -------
+    _find_csv_files()
+        Finds the yearly csv files in the working directory
+    _read_csv_files()
+        Parses the csv data once into a typed data frame
+    _numpy_array(raw_dataframe)
+        Creates numpy array of the data
+    _pandas_data_frame(raw_dataframe)
+        Creates pandas data frame of the data
+    _state_scores(weights)
+        Weights the state means into an air quality score for every state and year
+    rescore(weights)
+        Recomputes the air quality score with different weights without re-reading the data
+    _load_data_object_list(raw_dataframe)
+        Creates the RecordStore of AirQuality_obj
+    chloropleth_usa_map(column)
+        Creates a chloropleth graphic assigning the value in column to its relevent state
+    _build_county_rankings(raw_dataframe)
+        Ranks the counties of every state, and of every state and year, by air quality once at load
+    ranked_counties_in_state(state, k, worst, year)
+        Returns the k counties with the worst or best air quality in a given state
+    worst_air_quality_in_state(state, year)
+        Returns the name of the county with the worst air quality in a given state
+    best_air_quality_in_state(state, year)
+        Returns the name of the county with the worst air quality in a given state
+    county_air_quality(state, county, year)
+        Returns the air quality of one county in a year
+    state_air_quality(state, year)
+        Returns the state means and air quality score of one state in a year
+    """
+
+    def __init__(self, workers=None, weights=None, cache=None, raw_dataframe=None, snapshot=None):
+        """
+        Parameters
+        ----------
+        workers : int or None
+            Number of processes used to read the yearly files, None uses one per cpu
+        weights : dict or None
+            Weights for the air quality score keyed by kind of day, kinds not given keep the AQI_SCORE_WEIGHTS weight
+        cache : FrameCache or None
+            Cache of the parsed and derived frames, None always reads the csv files
+        raw_dataframe : pandas dataframe or None
+            The csv files already parsed, by a parallel ingest, the files are then neither read nor looked up in the cache
+        snapshot : Snapshot or None
+            Snapshot the parsed csv files are opened from on a cache miss, None or a stale snapshot reads the files
+        """
+        self.workers = workers
+        self.weights = self._check_weights(weights)
+        self.cache = cache
+        self.csv_files = self._find_csv_files()
+
+        # The snapshot manifest already fingerprints the csv files, so a cold cache does not hash them again
+        fingerprints = [snapshot.fingerprints("air_quality")] if snapshot else []
+        cache_key = cache.key(self.csv_files, fingerprints, weights=self.weights) if cache else None
+        cached = cache.load("air_quality", cache_key) if cache and raw_dataframe is None else None
+
+        if cached:
+            self.raw_dataframe = cached["raw_dataframe"]
+            self.dataframe = cached["dataframe"]
+            self.state_dataframe = cached["state_dataframe"]
+        else:
+            if raw_dataframe is None and snapshot:
+                raw_dataframe = snapshot.read("air_quality", self.csv_files)
+
+            self.raw_dataframe = self._read_csv_files() if raw_dataframe is None else raw_dataframe
+            self.dataframe = self._pandas_data_frame(self.raw_dataframe)
+
+            if cache:
+                cache.store("air_quality", cache_key, {"raw_dataframe": self.raw_dataframe, "dataframe": self.dataframe,
+                                                       "state_dataframe": self.state_dataframe})
+
+        logging.debug("Import_AirQuality_Data object successfully initialized")
+
+    # The structures below are derived on first use and kept, so commands that never touch them never build them
+    @cached_property
+    def numpy_arrays(self):
+        return self._numpy_array(self.raw_dataframe)
+
+    @cached_property
+    def indexed_dataframe(self):
+        return self.dataframe.set_index(AQI_KEY_COLUMNS).sort_index()
+
+    # Year first so the rows of a year, or of a state in a year, are lookups by the start of the key
+    @cached_property
+    def county_index(self):
+        return FrameIndex(self.dataframe, ["Year", "State", "County"])
+
+    @cached_property
+    def obj_list(self):
+        return self._load_data_object_list(self.raw_dataframe)
+
+    @cached_property
+    def _county_rankings(self):
+        return self._build_county_rankings(self.raw_dataframe)
+
+    @cached_property
+    def best_worst_dataframe(self):
+        cache_key = self.cache.key(self.csv_files) if self.cache else None
+        cached = self.cache.load("air_quality_extremes", cache_key) if self.cache else None
+
+        if cached:
+            return cached["best_worst_dataframe"]
+
+        best_worst_dataframe = self.extreme_values_data_frame()
+        if self.cache:
+            self.cache.store("air_quality_extremes", cache_key, {"best_worst_dataframe": best_worst_dataframe})
+
+        return best_worst_dataframe
+
+    # Finds the yearly air quality files in the working directory
+    def _find_csv_files(self):
+        """
+        Returns the sorted list of annual_aqi_by_county_*.csv files in the working directory
+
+        Parameters
+        ----------
+        none
+        """
+        # Gets list of csv files in directory
+        return _find_air_quality_files()
+
+    # The method _read_csv_files parses the air quality data set once, every other structure is derived from it
+    @_profiled("air_quality.load", rows=len)
+    def _read_csv_files(self):
+        """
+        Reads every yearly air quality file into a single typed, columnar data frame. The numpy array, the pandas
+        data frame and the AirQuality_obj list are all built from this one parse
+
+        Parameters
+        ----------
+        none
+        """
+
+        csv_files = self.csv_files
+
+        # Years are independent of each other so they are parsed in parallel when there is more than one
+        if len(csv_files) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                yearly_dataframes = list(executor.map(_read_air_quality_file, csv_files))
+        else:
+            yearly_dataframes = [_read_air_quality_file(csv_file) for csv_file in csv_files]
+
+        raw_dataframe = _concat_categorical(yearly_dataframes)
+        logging.debug(f"Years loaded by read_csv_files method: {sorted(raw_dataframe['Year'].unique())}")
+
+        return raw_dataframe
+
+    # The method numpy_array creates a numpy array of the numerical data in the air_quality data set for analysis
+    def _numpy_array(self, raw_dataframe):
+        """
+        Creates numpy array of the numerical data found in the air quality data set
+
+        Parameters
+        ----------
+        raw_dataframe : pandas dataframe
+            The parsed air quality data set
+        """
+
+        # Selecting several columns copies them into one new int64 array, it is only built when asked for
+        numpy_arrays = raw_dataframe[AQI_NUMERIC_COLUMNS].to_numpy()
+        logging.debug("numpy array created")
+
+        return numpy_arrays
+
+    # The method _pandas_data_frame reads in Airquality data and turns it into a dataframe for visualization
+    @_profiled("air_quality.aggregate", rows=len)
+    def _pandas_data_frame(self, raw_dataframe):
+        """
+        Makes a pandas dataframe from the data and calculates summary statistics on the state level then creates an air quality
+        by state score to be used in plotting
+
+        Parameters
+        ----------
+        raw_dataframe : pandas dataframe
+            The parsed air quality data set
+        """
+        # Dictionary that matches the state name to their abbreviation, to be used for mapping
+        us_state_to_abbrev = {
+            "Alabama": "AL",
+            "Alaska": "AK",
+            "Arizona": "AZ",
+            "Arkansas": "AR",
+            "California": "CA",
+            "Colorado": "CO",
+            "Connecticut": "CT",
+            "Delaware": "DE",
+            "Florida": "FL",
+            "Georgia": "GA",
+            "Hawaii": "HI",
+            "Idaho": "ID",
+            "Illinois": "IL",
+            "Indiana": "IN",
+            "Iowa": "IA",
+            "Kansas": "KS",
+            "Kentucky": "KY",
+            "Louisiana": "LA",
+            "Maine": "ME",
+            "Maryland": "MD",
+            "Massachusetts": "MA",
+            "Michigan": "MI",
+            "Minnesota": "MN",
+            "Mississippi": "MS",
+            "Missouri": "MO",
+            "Montana": "MT",
+            "Nebraska": "NE",
+            "Nevada": "NV",
+            "New Hampshire": "NH",
+            "New Jersey": "NJ",
+            "New Mexico": "NM",
+            "New York": "NY",
+            "North Carolina": "NC",
+            "North Dakota": "ND",
+            "Ohio": "OH",
+            "Oklahoma": "OK",
+            "Oregon": "OR",
+            "Pennsylvania": "PA",
+            "Rhode Island": "RI",
+            "South Carolina": "SC",
+            "South Dakota": "SD",
+            "Tennessee": "TN",
+            "Texas": "TX",
+            "Utah": "UT",
+            "Vermont": "VT",
+            "Virginia": "VA",
+            "Washington": "WA",
+            "West Virginia": "WV",
+            "Wisconsin": "WI",
+            "Wyoming": "WY",
+            "District of Columbia": "DC",
+            "American Samoa": "AS",
+            "Guam": "GU",
+            "Northern Mariana Islands": "MP",
+            "Puerto Rico": "PR",
+            "United States Minor Outlying Islands": "UM",
+            "U.S. Virgin Islands": "VI",
+        }
+
+        # Creates column listing the state abbreviation, and removes rows that do not match a US state
+        state_abbrev = raw_dataframe["State"].map(us_state_to_abbrev).astype("category")
+        air_quality_df = raw_dataframe[state_abbrev.notna()].assign(state_abbrev=state_abbrev)
+
+        # Averages the number of days with a given air quality by county in one grouped pass, to get state averages for each year
+        self.state_dataframe = air_quality_df.groupby(["State", "Year"], observed=True)[list(AQI_STATE_MEAN_COLUMNS)].mean() \
+                                             .rename(columns=AQI_STATE_MEAN_COLUMNS).sort_index()
+
+        # Broadcasts the state level columns back onto every county of the state
+        air_quality_df = air_quality_df.join(self.state_dataframe, on=["State", "Year"]) \
+                                       .join(self._state_scores(self.weights), on=["State", "Year"])
+
+        return air_quality_df
+
+    # Checks a set of score weights and fills in the default weight of any kind of day not given
+    def _check_weights(self, weights):
+        """
+        Returns the complete set of air quality score weights
+
+        Parameters
+        ----------
+        weights : dict or None
+            Weights keyed by kind of day, kinds not given keep the AQI_SCORE_WEIGHTS weight
+        """
+        return _score_weights(weights)
+
+    # The method _state_scores weights the state means into an air quality score metric for the whole state
+    def _state_scores(self, weights):
+        """
+        Returns a data frame with the weighted state means and the air quality score for every state and year
+
+        Parameters
+        ----------
+        weights : dict
+            Weight for each kind of day in AQI_SCORE_WEIGHTS
+        """
+        state_means = self.state_dataframe[[AQI_STATE_MEAN_COLUMNS[column] for column in AQI_SCORE_WEIGHTS]]
+        weight_vector = np.array([weights[column] for column in AQI_SCORE_WEIGHTS], dtype=np.float64)
+
+        state_scores = pd.DataFrame(index=self.state_dataframe.index)
+        for column, weighted_column in AQI_WEIGHTED_COLUMNS.items():
+            state_scores[weighted_column] = self.state_dataframe[AQI_STATE_MEAN_COLUMNS[column]] * weights[column]
+
+        state_scores["air_quality_score"] = state_means.to_numpy() @ weight_vector
+
+        return state_scores
+
+    # Method scores the states again with new weights, reusing the state means already computed
+    def rescore(self, weights):
+        """
+        Recomputes the air quality score with a different set of weights without re-reading the data
+
+        Parameters
+        ----------
+        weights : dict
+            Weights keyed by kind of day, kinds not given keep the AQI_SCORE_WEIGHTS weight
+        """
+        self.weights = self._check_weights(weights)
+        state_scores = self._state_scores(self.weights)
+
+        self.dataframe = self.dataframe.drop(columns=state_scores.columns).join(state_scores, on=["State", "Year"])
+        self.__dict__.pop("indexed_dataframe", None) # Rebuilt from the rescored data frame on next use
+        self.__dict__.pop("county_index", None)
+        logging.debug(f"Air quality score recomputed with weights: {self.weights}")
+
+    # Method outputs data frame to csv file
+    @_profiled("export.air_quality_csv")
+    def air_quality_csv(self, exporter=None):
+        """
+        Out puts a csvfile of the Dataframe stored in the object
+
+        Parameters
+        ----------
+        exporter : TableExporter or None
+            Exporter the table is queued on, None writes it now
+        """
+        # Exports a csv of the dataframe
+        _export_table(self.dataframe, "Air_Quality_by_county.csv", exporter)
+        logging.debug("Pandas dataframe created, and csv file created")
+
+    # This method creates a chloropleth map giving values to states based on any column of data
+    @_profiled("figure.chloropleth_usa_map")
+    def chloropleth_usa_map(self, column, output, exporter=None):
+        """
+        Creates a US map graphic coloring the states by a metric specified in the column parameter
+
+        Parameters
+        ----------
+        column : str
+            Data to be used to color the states in the map
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figure and "figure" only returns it
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
+        """
+
+        if output not in ["pdf", "web", "figure"]:
+            raise TypeError("Argument must be either pdf, web or figure")
+
+        # Maps the most recent year loaded, keeping one row for each state so every state lines up with its own value
+        latest_year = self.county_index.rows(self.county_index.levels[0][-1])
+        state_rows = latest_year.drop_duplicates(subset="state_abbrev")
+
+        states = state_rows["state_abbrev"]
+        values = state_rows[column]
+       
+        # Creates map graphic
+        fig = px.choropleth(locations=states, locationmode="USA-states", color=values, 
+                scope="usa", title="Air Quality by State", labels={"color": "Air Quality Score", "locations" : "State"})
+        
+        if output == "web":
+
+            fig.show()
+            logging.debug(f"chloropleth map output to web, created using column: {column}")
+
+        elif output == "pdf":
+            _export_figure(fig, "Air_Quality_in_US_by_State.pdf", exporter)
+            logging.debug(f"chloropleth map output to pdf, created using column: {column}")
+
+        return fig
+
+    # This method loads the data into a column store that hands out an AirQuality_obj for each row
+    def _load_data_object_list(self, raw_dataframe):
+        """
+        Loads data into a RecordStore of AirQuality_obj
+
+        Parameters
+        ----------
+        raw_dataframe : pandas dataframe
+            The parsed air quality data set
+        """
+        # A single column of the parsed frame is a view of its int64 block, or of the snapshot pages, never a copy
+        columns = {"state": raw_dataframe["State"], "county": raw_dataframe["County"]}
+        for field, column in zip(AirQuality_obj.__slots__[2:], AQI_OBJ_COLUMNS):
+            columns[field] = raw_dataframe[column]
+
+        return RecordStore(AirQuality_obj, columns)
+
+    # This method sorts every state's counties by air quality once, so best and worst lookups never rescan the data
+    def _build_county_rankings(self, raw_dataframe):
+        """
+        Ranks the counties of every state, and of every state and year, from worst to best air quality and from
+        best to worst air quality. Bad air quality defined as most Hazardous days, then most Very Unhealthy days etc...
+        Ties keep the order of the data set
+
+        Parameters
+        ----------
+        raw_dataframe : pandas dataframe
+            The parsed air quality data set
+        """
+        self._counties = raw_dataframe["County"].to_numpy()
+        severity = raw_dataframe[AQI_SEVERITY_COLUMNS].to_numpy()
+
+        # np.lexsort sorts by its last key first, so the group is the primary key and the most severe column the next
+        worst_keys = [-severity[:, column] for column in reversed(range(severity.shape[1]))]
+        best_keys = [severity[:, column] for column in reversed(range(severity.shape[1]))]
+
+        county_rankings = {}
+        for group_columns in (["State"], ["State", "Year"]):
+            codes, groups = pd.factorize(pd.MultiIndex.from_frame(raw_dataframe[group_columns]))
+
+            worst_order = np.lexsort(worst_keys + [codes])
+            best_order = np.lexsort(best_keys + [codes])
+
+            # Both orders are grouped the same way, so the group boundaries are shared
+            boundaries = np.flatnonzero(np.diff(codes[best_order])) + 1
+            for worst_positions, best_positions in zip(np.split(worst_order, boundaries), np.split(best_order, boundaries)):
+                group = groups[codes[best_positions[0]]]
+                key = group[0] if len(group_columns) == 1 else group
+                county_rankings[key] = (worst_positions, best_positions)
+
+        logging.debug(f"County air quality rankings built for {len(county_rankings)} states and state years")
+
+        return county_rankings
+
+    # Method returns the k counties in the given state with the worst, or best, air quality
+    def ranked_counties_in_state(self, state, k=None, worst=True, year=None):
+        """
+        Returns the names of the k counties in the given state with the worst air quality, worst first,
+        or with the best air quality, best first
+
+        Parameters
+        ----------
+        state : str
+            State to check air quality
+        k : int or None
+            Number of counties to return, None returns every county in the state
+        worst : bool
+            True ranks from worst air quality, False ranks from best air quality
+        year : int or None
+            Year to rank, None ranks every year loaded together
+        """
+        key = state if year is None else (state, year)
+
+        if key not in self._county_rankings:
+            raise ValueError("Not a valid state in argument")
+
+        worst_positions, best_positions = self._county_rankings[key]
+        positions = worst_positions if worst else best_positions
+
+        return self._counties[positions[:k]].tolist()
+
+    # Method return the name of the county in the given state with the worst air quality
+    # Bad air quality defined as most Hazardous days, then most Very Unhealthy days etc...
+    def worst_air_quality_in_state(self, state, year=None):
+        """
+        Returns the name of the county in the given state with the worst air quality
+        Bad air quality defined as most Hazardous days, then most Very Unhealthy days etc...
+
+        Parameters
+        ----------
+        state : str
+            State to check air quality
+        year : int or None
+            Year to check, None checks every year loaded
+        """
+        logging.debug(f"worst_air_quality_in_state method called for state: {state}")
+
+        return self.ranked_counties_in_state(state, k=1, worst=True, year=year)[0]
+
+    # Method return the name of the county in the given state with the best air quality
+    # Good air quality defined as least Hazardous days, then least Very Unhealthy days etc...
+    def best_air_quality_in_state(self, state, year=None):
+        """
+        Returns the name of the county in the given state with the best air quality
+        Good air quality defined as least Hazardous days, then least Very Unhealthy days etc...
+
+        Parameters
+        ----------
+        state : str
+            State to check air quality
+        year : int or None
+            Year to check, None checks every year loaded
+        """
+        logging.debug(f"best_air_quality_in_state method called for state: {state}")
+
+        return self.ranked_counties_in_state(state, k=1, worst=False, year=year)[0]
+
+    # Method returns every column of one county in one year from the hash index
+    def county_air_quality(self, state, county, year=None):
+        """
+        Returns the row of a county as a dictionary of column name to value
+
+        Parameters
+        ----------
+        state : str
+            State of the county
+        county : str
+            Name of the county
+        year : int or None
+            Year to look up, None looks up the latest year loaded
+        """
+        year = _checked_year(year, self.county_index.levels[0], "air quality data")
+
+        return self.county_index.record(year, state, county)
+
+    # Method returns the state level columns of one state in one year from the hash index
+    def state_air_quality(self, state, year=None):
+        """
+        Returns the state means of each kind of day and the air quality score of a state as a dictionary, with
+        the number of counties reporting in "counties"
+
+        Parameters
+        ----------
+        state : str
+            State to look up
+        year : int or None
+            Year to look up, None looks up the latest year loaded
+        """
+        year = _checked_year(year, self.county_index.levels[0], "air quality data")
+        record = self.county_index.record(year, state)
+
+        # The state columns are the ones derived after parsing, they are the same on every county of the state
+        state_record = {"State": state, "Year": year, "counties": len(self.county_index.positions(year, state))}
+        state_record.update({column: value for column, value in record.items() if column not in AQI_COLUMNS})
+
+        return state_record
+
+    # This method creates a data frame that contains the counties in every state with the best and worst air quality
+    # and then also lists those counties max AQI experienced in a year
+    def extreme_values_data_frame(self):
+        """
+        Returns a pandas DataFrame that contains the counties in every state with the best and worst air quality
+        and then also lists those counties max AQI experienced in a year
+        """
+        
+        df = self.dataframe
+
+        new_df = pd.DataFrame()
+
+        state_list = []
+        county_list = []
+        aqi_list = []
+
+        # The rankings hold row positions, so the Max AQI is read from the very row that ranked best or worst
+        # rather than from the first county of the same name anywhere in the data set
+        max_aqi = self.raw_dataframe["Max AQI"].to_numpy()
+
+        for state in df["State"].unique():
+            worst_positions, best_positions = self._county_rankings[state]
+            best = self._counties[best_positions[0]]
+            worst = self._counties[worst_positions[0]]
+            best_aqi = max_aqi[best_positions[0]]
+            worst_aqi = max_aqi[worst_positions[0]]
+
+            state_list.append(state)
+            state_list.append(state)
+            county_list.append(best)
+            county_list.append(worst)
+            aqi_list.append(best_aqi)
+            aqi_list.append(worst_aqi)
+
+        new_df["State"] = state_list
+        new_df["County"] = county_list
+        new_df["Max_AQI"] = aqi_list
+        return new_df
+
+    # This Method creates a sunburst graphic which displays counties in state with best and worst air quality and specifies maxc AQI values
+    @_profiled("figure.extreme_aqi_values_sunburst")
+    def extreme_aqi_values_sunburst(self, output, exporter=None):
+        """
+        Creates a sunburst graphic which displays counties in state with best and worst air quality and specifies maxc AQI values
+
+        Parameters
+        ----------
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figure and "figure" only returns it
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
+        """
+
+        if output not in ["pdf", "web", "figure"]:
+            raise TypeError("Argument must be either pdf, web or figure")
+
+        fig = px.sunburst(self.best_worst_dataframe, path=["State", "County"], values="Max_AQI", title="Air Quality by State", 
+                                labels={"labels": "County", "Max_AQI" : "Max AQI", "parent" : "State"})
+
+        if output == "web":
+
+            fig.show()
+            logging.debug("Starburst map output to web")
+
+        elif output == "pdf":
+            _export_figure(fig, "Best_and_Worst_AQI_by_State.pdf", exporter)
+            logging.debug("Starburst map output to pdf")
+
+        return fig
+
+@dataclass(eq=True,order=True)
+class BirthObject():
+    """
+    BirthObject is a data class that is configured to handle __eq__(),__lt__(),
+    __gt__(), __sort__(),__hash __() and  __init__() implicitly
+    or with configs in the decorater.
+
+    It basically takes all the functionality in the AutoMPG()
+    class but only needs like 6 lines of code
+    pretty sweet
+
+    The slots keep each object small, they are handed out as row views of a RecordStore
+    """
+    __slots__ = ("year", "county", "state", "average_birth_weight")
+
+    year: str
+    county: str
+    state: str
+    average_birth_weight: float
+
+class BirthDataStats():
+    """ 
+    data stats class that loasds data and creats visualizations for analyizing birth weigh
+    data by state, and county
+
+    With a chunksize the csv is streamed in chunks of that many rows and only the state and year
+    aggregates are kept, so memory stays bounded by the number of states and years. In that mode
+    data and df are None and only state_df is available
+
+    With a FrameCache the derived frames are read from the cache when birth_data.csv has not changed,
+    a birth_df already parsed by a parallel ingest is used as it is, and otherwise a current Snapshot
+    is opened instead of parsing the csv
+    """
+
+    def __init__(self, chunksize=None, cache=None, birth_df=None, snapshot=None):
+        self.chunksize = chunksize
+        self.snapshot = snapshot
+
+        # A streamed run keeps its own entry, so it never evicts the county rows of a full run or the other way round
+        stage = "birth_weight" if chunksize is None else "birth_weight_streamed"
+        fingerprints = [snapshot.fingerprints("birth_weight")] if snapshot else []
+        cache_key = cache.key(["birth_data.csv"], fingerprints, chunksize=chunksize) if cache else None
+        cached = cache.load(stage, cache_key) if cache and birth_df is None else None
+
+        if chunksize is None:
+            if cached:
+                self.df = cached["df"]
+                self.state_df = cached["state_df"]
+            else:
+                self.birth_data(birth_df)
+                self.df = self.pandas_df()
+        else:
+            self.df = None
+            self.state_df = cached["state_df"] if cached else self.stream_state_aggregates(chunksize)
+
+        if cache and not cached:
+            frames = {"state_df": self.state_df} if self.df is None else {"df": self.df, "state_df": self.state_df}
+            cache.store(stage, cache_key, frames)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    # The county rows, which a streamed csv does not keep
+    def _county_rows(self):
+        """
+        Returns the county data frame, or raises a ValueError when the csv was streamed and only the state
+        aggregates were kept
+
+        Parameters
+        ----------
+        None
+        """
+        if self.df is None:
+            raise ValueError(f"County rows are not kept when birth_data.csv is streamed with a chunksize of {self.chunksize}, "
+                             "only the state aggregates in state_df are available")
+
+        return self.df
+
+    # When the data frame comes from the cache the records are only rebuilt from it if they are iterated
+    @cached_property
+    def data(self):
+        county_rows = self._county_rows()
+        return RecordStore(BirthObject, {column: county_rows[column] for column in BIRTH_RECORD_COLUMNS},
+                           record_fields=BirthObject.__slots__)
+
+
+    # Pairs every natality county name with its FIPS code, the AQI files only carry county names
+    @cached_property
+    def fips_crosswalk(self):
+        """
+        A series of county FIPS codes indexed by state abbreviation and normalized county name, built from the
+        County_of_Residence and County_of_Residence_FIPS pairs of the natality data
+        """
+        counties = self._county_rows().drop_duplicates(subset="fips")
+        index = pd.MultiIndex.from_arrays([counties["state"].str.strip(), _county_key(counties["county"])],
+                                          names=["state_abbrev", "county_key"])
+
+        return pd.Series(counties["fips"].to_numpy(), index=index, name="fips")
+
+    # Hash index of the county rows by year, state and county, with int years and unpadded state abbreviations
+    # so the keys look like the keys of the other data sets
+    @cached_property
+    def county_index(self):
+        county_rows = self._county_rows()
+        return FrameIndex(county_rows, _birth_index_keys(county_rows) + ["county"])
+
+    # Hash index of the state rows by year and state, also available when the csv was streamed
+    @cached_property
+    def state_index(self):
+        return FrameIndex(self.state_df, _birth_index_keys(self.state_df))
+
+    # Method returns every column of one county in one year from the hash index
+    def county_birth_weight(self, state, county, year=None):
+        """
+        Returns the row of a county as a dictionary of column name to value
+
+        Parameters
+        ----------
+        state : str
+            State abbreviation of the county
+        county : str
+            Name of the county as the natality data spells it, "Baldwin County"
+        year : int or None
+            Year to look up, None looks up the latest year loaded
+        """
+        year = _checked_year(year, self.state_index.levels[0], "birth data")
+
+        return self.county_index.record(year, state, county)
+
+    # Method returns the state statistics of one state in one year from the hash index
+    def state_birth_weight(self, state, year=None):
+        """
+        Returns the statistics of a state as a dictionary of column name to value
+
+        Parameters
+        ----------
+        state : str
+            State abbreviation
+        year : int or None
+            Year to look up, None looks up the latest year loaded
+        """
+        year = _checked_year(year, self.state_index.levels[0], "birth data")
+
+        return self.state_index.record(year, state)
+
+    # Method returns the k counties of a state with the lowest, or highest, average birth weight
+    def ranked_counties_in_state(self, state, k=None, worst=True, year=None):
+        """
+        Returns the names of the k counties in the given state with the lowest average birth weight, lowest first,
+        or with the highest average birth weight, highest first. Ties keep the order of the data set. The flag
+        matches Import_AirQuality_Data.ranked_counties_in_state, a low birth weight is the worst
+
+        Parameters
+        ----------
+        state : str
+            State abbreviation
+        k : int or None
+            Number of counties to return, None returns every county in the state
+        worst : bool
+            True ranks from the lowest birth weight, False from the highest
+        year : int or None
+            Year to rank, None ranks the latest year loaded
+        """
+        year = _checked_year(year, self.state_index.levels[0], "birth data")
+        positions = self.county_index.positions(year, state)
+
+        if not len(positions):
+            raise ValueError("Not a valid state in argument")
+
+        # Only the rows of the state are sorted, the index already found them
+        county_rows = self._county_rows()
+        weights = county_rows["average_birth_weight"].to_numpy()[positions]
+        order = np.argsort(weights if worst else -weights, kind="stable")
+
+        return county_rows["county"].to_numpy()[positions[order[:k]]].tolist()
+
+    def birth_data(self, birth_df=None):
+        """
+        Creates the RecordStore of BirthObjects 
+
+        Parameters
+        ----------
+        birth_df : pandas dataframe or None
+            The csv already parsed, by a parallel ingest, None opens the snapshot or reads birth_data.csv
+        """
+        if birth_df is None and self.snapshot:
+            birth_df = self.snapshot.read("birth_weight", ["birth_data.csv"])
+        with PROFILER.stage("birth_weight.load") as stage:
+            if birth_df is None:
+                birth_df = _read_birth_file()
+
+            self.data = RecordStore(BirthObject, {column: birth_df[column] for column in BIRTH_RECORD_COLUMNS},
+                                    record_fields=BirthObject.__slots__)
+            stage["rows"] = len(self.data)
+        logging.debug(f"{len(self.data)} birth records loaded")
+
+    @_profiled("birth_weight.stream", rows=len)
+    def stream_state_aggregates(self, chunksize):
+        """
+        Reads the csv in chunks and keeps running count, sum, min and max birth weight with the min and max
+        county for each state and year, so only one chunk is held in memory at a time
+
+        Parameters
+        ----------
+        chunksize : int
+            Number of csv rows read per chunk
+        """
+        state_df = None
+        chunk_count = 0
+
+        for chunk in pd.read_csv("birth_data.csv", usecols=BIRTH_CSV_COLUMNS, dtype=BIRTH_CSV_DTYPES, chunksize=chunksize):
+            partial = _birth_chunk_aggregates(_parse_birth_chunk(chunk))
+            state_df = _merge_birth_aggregates([partial] if state_df is None else [state_df, partial])
+            chunk_count += 1
+
+        logging.debug(f"birth data streamed in {chunk_count} chunks of {chunksize} rows")
+
+        return state_df
+
+    @_profiled("birth_weight.aggregate", rows=len)
+    def pandas_df(self):
+        """
+        Makes a pandas dataframe from the data and calculates summary statistics 
+
+        Parameters
+        ----------
+        None
+        """
+        data_frame = self.data.to_dataframe()
+
+        # Computes every state statistic for each year in one grouped pass
+        state_stats = data_frame.groupby(["state", "year"], observed=True)["average_birth_weight"].agg(["count", "sum", "mean", "min", "idxmin", "max", "idxmax"]).sort_index()
+        state_stats.columns = ["county_count", "birth_weight_sum", "avg_birth_weight_by_state", "min birth weight by state",
+                               "idx_county_with_lowest_birthweight", "max birth weight by state", "idx_county_with_highest_birthweight"]
+
+        state_stats["min birth weight by county"] = state_stats["min birth weight by state"]
+        state_stats["max birth weight by county"] = state_stats["max birth weight by state"]
+
+        # Resolves the row of the lowest and highest county to its name once per state and year
+        counties = data_frame["county"].to_numpy()
+        state_stats["county_in_state_lowest_birthweight_by_year"] = counties.take(state_stats["idx_county_with_lowest_birthweight"])
+        state_stats["county_in_state_highest_birthweight_by_year"] = counties.take(state_stats["idx_county_with_highest_birthweight"])
+
+        # Weights every county by its births for the births weighted means and variances
+        weighted_sums = _births_weighted_sums(data_frame)
+        state_stats = state_stats.join(weighted_sums).join(_births_weighted_moments(weighted_sums))
+
+        self.state_df = state_stats.reset_index()[BIRTH_STATE_COLUMNS]
+
+        # Broadcasts the state statistics back onto every county of the state, the running sums are only kept in state_df
+        running_sums = ["county_count", "birth_weight_sum"] + BIRTH_WEIGHTED_SUM_COLUMNS[1:]
+        data_frame = data_frame.join(state_stats.drop(columns=running_sums), on=["state", "year"])
+
+        return data_frame
+
+
+    @_profiled("export.birth_csv")
+    def birth_csv(self, exporter=None):
+        """
+        Out puts a csvfile of the Dataframe stored in the object
+
+        Parameters
+        ----------
+        exporter : TableExporter or None
+            Exporter the table is queued on, None writes it now
+        """
+        # Exports a csv of the dataframe, only the state aggregates exist when the data was streamed
+        if self.df is None:
+            logging.warning("birth_data.csv was streamed without its county rows, "
+                            "the state aggregates are written to Birth_data_by_state.csv instead of Birth_data_by_county.csv")
+            _export_table(self.state_df, "Birth_data_by_state.csv", exporter)
+        else:
+            _export_table(self.df, "Birth_data_by_county.csv", exporter)
+        logging.debug("Pandas dataframe created, and csv file created")
+
+    @_profiled("figure.yearly_bw_state")
+    def yearly_bw_state(self,output, exporter=None):
+        """
+        Creates a scatter plot breaking down average birthweight byt state
+
+        Parameters
+        ----------
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figure and "figure" only returns it
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
+        """
+        tst = self.state_df
+        fig = px.scatter(tst, x = "state", y = "avg_birth_weight_by_state", color ="year",
+            title = "2016-2018 Breakdown of Average Birthweight by State", labels={
+                "year" : "Year", "avg_birth_weight_by_state" : "Average Birth Weight (lbs)",
+                "state" : "State"
+            }) 
+       
+        if output == "web":
 
-    """
+            fig.show()
+            logging.debug("yearly birth weight by state scatter plot to web")
 
-    def __init__(self, state, county, year, good_days, moderate_days, unhealthy_days,
-                very_unhealthy_days, hazardous_days, max_aqi):
+        elif output == "pdf":
+            _export_figure(fig, "yearly_bw_state.pdf", exporter)
+            logging.debug("scatter chart output to pdf")
+
+        return fig
+
+
+    @_profiled("figure.lowest_weight_in_state")
+    def lowest_weight_in_state(self,output, year=None, exporter=None):
         """
+        Outputs plot displaying the counties in the state with the minimum average birthweight
+
         Parameters
         ----------
-        state : str
-            The state the county is located in
-        county : str
-            The county being examined
-        year : int
-            The year being examined
-        good_days : int
-            The number of days in the year with AQI considered good
-        moderate_days : int
-            The number of days in the year with AQI considered moderate
-        unhealthy_days : int
-            The number of days in the year with AQI considered unhealthy
-        very_unhealthy_days : int
-            The number of days in the year with AQI considered very unhealthy
-        hazardous_days : int
-            The number of days in the year with AQI considered hazardous
-        max_aqi : int
-            The max AQI observed on any day of the year
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figure and "figure" only returns it
+        year : int, str or None
+            Year to chart, None charts the latest year
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
         """
-        self.state = str(state)
-        self.county = str(county)
-        self.year = int(year)
-        self.good_days = int(good_days)
-        self.moderate_days = int(moderate_days)
-        self.unhealthy_days = int(unhealthy_days)
-        self.very_unhealthy_days = int(very_unhealthy_days)
-        self.hazardous_days = int(hazardous_days)
-        self.max_aqi = int(max_aqi)
-
+        year = _checked_year(year, self.state_index.levels[0], "birth data")
+        temp_year = self.state_index.rows(year)
+        temp_drop = temp_year.drop_duplicates(subset="state")
+        
+        fig = px.bar(temp_drop, x = "state", y ="min birth weight by state", title= "County with the Lowest Birth Weight in State", barmode='group',
+                        log_y=True, text="county_in_state_lowest_birthweight_by_year", labels={
+                            "average_birth_weight" : "Average Birth Weight in County (lbs)",
+                            "state" : "State"
+                        })
+       
+        if output == "web":
 
-    # String representation of the object, human friendly display
-    def __str__(self):
-        string = f"{str(self.state)}     {str(self.county)}     {str(self.year)} \n\nGood days: {str(self.good_days)}\n"\
-                 f"Moderate days: {str(self.moderate_days)}\nUnhealthy days: {str(self.unhealthy_days)}\n"\
-                 f"Very unhealthy days: {str(self.very_unhealthy_days)}\nHazardous days: {str(self.hazardous_days)}\n"\
-                 f"Max AQI: {str(self.max_aqi)}"
+            fig.show()
+            logging.debug("Lowest birth weight in state bar chart to web")
 
-        return string
+        elif output == "pdf":
+            _export_figure(fig, "lowest_weight_in_state.pdf", exporter)
+            logging.debug("Lowest weight in state bar chart output to pdf")
 
-    # String representation of the object
-    def __repr__(self):
-        return "AirQuality_obj(" + str(self.state) + ", " + str(self.county) + ", " + str(self.year) + ", " + str(self.good_days) \
-                + ", " + str(self.moderate_days) + ", " + str(self.unhealthy_days) + ", " + str(self.very_unhealthy_days) + ", " \
-                + str(self.hazardous_days) + ", " + str(self.max_aqi) + ")"
+        return fig
 
-    # Enables use of less than operator for two AirQuality_obj objects
-    def __lt__(self, other):
+    @_profiled("figure.highest_weight_in_state")
+    def highest_weight_in_state(self,output, year=None, exporter=None):
         """
-        Enables use of the less than operator to determine which object has worse air quality
+        Outputs bar chart displaying the county in a state with the highest birthweight
 
         Parameters
         ----------
-        other : AirQuality-obj
-            Object to compare to
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figure and "figure" only returns it
+        year : int, str or None
+            Year to chart, None charts the latest year
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
         """
-        if type(self) is type(other):
+        year = _checked_year(year, self.state_index.levels[0], "birth data")
+        temp_year = self.state_index.rows(year)
+        temp_drop = temp_year.drop_duplicates(subset="state")
+        
+        fig = px.bar(temp_drop, x = "state", y ="max birth weight by state", title= "County with the Highest Birth Weight in State", barmode='group',
+                        log_y=True, text="county_in_state_highest_birthweight_by_year", labels={
+                            "average_birth_weight" : "Average Birth Weight in County (lbs)",
+                            "state" : "State"
+                        })
 
-            self_tuple = (self.hazardous_days, self.very_unhealthy_days, self.unhealthy_days, self.moderate_days)
-            other_tuple = (other.hazardous_days, other.very_unhealthy_days, other.unhealthy_days, other.moderate_days)
+        if output == "web":
 
-            return self_tuple < other_tuple
-        elif other is None:
-            return False
+            fig.show()
+            logging.debug("Highest birth weight in state bar chart to web")
+
+        elif output == "pdf":
+            _export_figure(fig, "highest_weight_in_state.pdf", exporter)
+            logging.debug("Highest weight in state bar chart output to pdf")
+
+        return fig
+
+class BirthWeight_and_AirQuality():
+    """
+    Combines the air quality and birth weight data sets for every year found in both, and breaks the states of
+    each year into quadrants by air quality score and average birth weight. Years are merged in parallel and the
+    results are kept in long format with one Year column
+
+    Attributes
+    ----------
+    years : list of int
+        The years combined, every year present in both data sets unless given
+    workers : int or None
+        Number of processes the years are combined in, None uses one per cpu
+    merged_dataframe : pandas dataframe
+        The air quality counties joined with the birth data of the same county and year
+    breakdown_dataframe : pandas dataframe
+        One row per state and year with its air quality score, average birth weight and quadrant
+    unmatched_air_quality : pandas dataframe
+        Air quality rows with no birth data for the same county and year
+    unmatched_birth : pandas dataframe
+        Birth rows with no air quality data for the same county and year
+    county_index : FrameIndex
+        Hash index of the merged rows by Year, State and County
+    state_index : FrameIndex
+        Hash index of the breakdown rows by Year and State
+    """
+
+    def __init__(self, air_quality_obj, birth_obj, cache=None, years=None, workers=None):
+        self.air_quality_obj = air_quality_obj
+        self.birth_obj = birth_obj
+        self.cache = cache
+        self.workers = workers
+
+        # The state aggregates hold every year loaded, whether or not the county rows were kept
+        if years is None:
+            birth_years = {int(year) for year in self.birth_obj.state_df["year"].unique()}
+            years = birth_years & set(self.air_quality_obj.dataframe["Year"].unique().tolist())
+        self.years = sorted(years)
+
+    # The years are combined the first time any of the combined data frames is used
+    @cached_property
+    def _combined_frames(self):
+        streamed = self.birth_obj.df is None
+        cache_key = self.cache.key(self.air_quality_obj.csv_files + ["birth_data.csv"], weights=self.air_quality_obj.weights,
+                                   years=self.years, streamed=streamed) if self.cache else None
+        stage = "combined_streamed" if streamed else "combined"
+        cached = self.cache.load(stage, cache_key) if self.cache else None
+
+        if cached:
+            return _restore_quadrants(cached)
+
+        # A streamed birth csv has no county rows to merge, only the states are broken down
+        if streamed:
+            combined_frames = {"breakdown_dataframe": _streamed_breakdown(self.air_quality_obj.dataframe, self.birth_obj.state_df,
+                                                                          self.years)}
         else:
-            return NotImplemented
+            combined_frames = self._combine_years()
+        if self.cache:
+            self.cache.store(stage, cache_key, combined_frames)
 
-    # Enables use of greater than operator for two AirQuality_obj objects
-    def __gt__(self, other):
+        return combined_frames
+
+    # The county level frames, which are not merged when the birth csv was streamed
+    def _county_frame(self, name):
         """
-        Enables use of the greater than operator to determine which object has worse air quality
+        Returns one of the merged or unmatched data frames, or raises a ValueError when the birth csv was streamed
 
         Parameters
         ----------
-        other : AirQuality-obj
-            Object to compare to
+        name : str
+            Name of the frame
         """
-        if type(self) is type(other):
+        if name not in self._combined_frames:
+            raise ValueError(f"{name} needs the birth county rows, which are not kept when birth_data.csv is streamed "
+                             "with a chunksize, only breakdown_dataframe is available")
 
-            self_tuple = (self.hazardous_days, self.very_unhealthy_days, self.unhealthy_days, self.moderate_days)
-            other_tuple = (other.hazardous_days, other.very_unhealthy_days, other.unhealthy_days, other.moderate_days)
+        return self._combined_frames[name]
 
-            return self_tuple > other_tuple
-        
-        elif other is None:
-            return True
-        else:
-            return NotImplemented
+    @property
+    def merged_dataframe(self):
+        return self._county_frame("merged_dataframe")
 
-class Import_AirQuality_Data:
-    """
-    A class that loads in a whole air quality dataset in a year by county
+    @property
+    def breakdown_dataframe(self):
+        return self._combined_frames["breakdown_dataframe"]
 
-    Attributes
-    ----------
-    numpy_arrays : np.array
-        A numpy array that holds all the numerical data 
-    dataframe  : pandas dataframe
-        A data frame containing all the info from the original csv, and calculated columns for visualizations
-    obj_list : list of AirQuality_obj
-        A list of all the objects representing a row of data
+    @property
+    def unmatched_air_quality(self):
+        return self._county_frame("unmatched_air_quality")
 
-    Methods
-    -------
-    _numpy_array()
-        Creates numpy array of the data
-    _pandas_data_frame()
-        Creates pandas data frame of the data
-    _load_data_object_list()
-        Creates list of AirQuality_obj
-    chloropleth_usa_map(column)
-        Creates a chloropleth graphic assigning the value in column to its relevent state
-    worst_air_quality_in_state(state)
-        Returns the name of the county with the worst air quality in a given state
-    best_air_quality_in_state(state)
-        Returns the name of the county with the worst air quality in a given state
-    """
+    @property
+    def unmatched_birth(self):
+        return self._county_frame("unmatched_birth")
 
-    def __init__(self):
+    @cached_property
+    def county_index(self):
+        return FrameIndex(self.merged_dataframe, ["Year", "State", "County"])
+
+    @cached_property
+    def state_index(self):
+        return FrameIndex(self.breakdown_dataframe, ["Year", "State"])
+
+    # Resolves a year asked for against the years combined
+    def _year(self, year):
         """
+        Returns the year as an int, the latest year combined when None, and raises a ValueError naming the years
+        of each data set when no year is in both or the year is not combined
+
         Parameters
         ----------
-        none
+        year : int, str or None
+            Year asked for
         """
-        self.numpy_arrays = self._numpy_array()
-        self.dataframe = self._pandas_data_frame()
-        self.obj_list = self._load_data_object_list()
-        self.best_worst_dataframe = self.extreme_values_data_frame()
-        logging.debug("Import_AirQuality_Data object successfully initialized")
+        if not self.years:
+            air_quality_years = sorted(self.air_quality_obj.dataframe["Year"].unique().tolist())
+            birth_years = sorted({int(year) for year in self.birth_obj.state_df["year"].unique()})
+            raise ValueError(f"No year is in both data sets, the air quality years are {air_quality_years} "
+                             f"and the birth years are {birth_years}")
 
+        return _checked_year(year, self.years, "combined data")
 
-    # The method numpy_array creates a numpy array of the numerical data in the air_quality data set for analysis
-    def _numpy_array(self):
+    # Method returns the air quality and birth data of one county in one year from the hash index
+    def county_data(self, state, county, year=None):
         """
-        Creates numpy array of the numerical data found in the air quality data set
+        Returns the merged row of a county as a dictionary of column name to value
 
         Parameters
         ----------
-        none
+        state : str
+            State of the county as the air quality data spells it, "Alabama"
+        county : str
+            Name of the county as the air quality data spells it, "Baldwin"
+        year : int or None
+            Year to look up, None looks up the latest year combined
         """
+        return self.county_index.record(self._year(year), state, county)
 
-        # Gets list of csv files in directory
-        csv_files = glob.glob("annual_aqi_by_county_*.csv") # Finds dataset in directory
-        logging.debug(f"Dataset files found by numpy_array method:{csv_files}")
-
-        numpy_arrays = None
-
-        for csv_file in csv_files:
-            with open(csv_file) as csv_connection:
-
-                logging.debug("CSV file opened in numpy_array method")
-
-                count_rows = 0
-                csv_reader = csv.reader(csv_connection, delimiter=",")
-                
-                array = []
-                for row in csv_reader: 
-                    count_token = 1
-                    row_list = []
-                    if count_rows == 0: # Skips header row
-                        
-                        count_rows+=1
-                    else:
-                        
-                        for token in row:
-                            if count_token not in [1,2]: # Skips string data
-                                row_list.append(int(token))
-                            
-                            count_token += 1
-                        
-                        array.append(row_list)
-
-                numpy_arrays = np.array(array)
-                logging.debug("numpy array created")
+    # Method returns the air quality score, average birth weight and quadrant of one state from the hash index
+    def state_data(self, state, year=None):
+        """
+        Returns the breakdown row of a state as a dictionary of column name to value
 
-        return numpy_arrays
-                    
-    # The method _pandas_data_frame reads in Airquality data and turns it into a dataframe for visualization
-    def _pandas_data_frame(self):
+        Parameters
+        ----------
+        state : str
+            State as the air quality data spells it, "Alabama"
+        year : int or None
+            Year to look up, None looks up the latest year combined
         """
-        Makes a pandas dataframe from the data and calculates summary statistics on the state level then creates an air quality
-        by state score to be used in plotting
+        return self.state_index.record(self._year(year), state)
+
+    def _yearly_frames(self, years):
+        """
+        Merges and breaks down each of the years, in parallel when there is more than one, and returns the
+        merged, breakdown and unmatched data frames of each year by name, keyed by year
 
         Parameters
         ----------
-        None
+        years : list of int
+            Years to combine
         """
-        # Gets list of csv files in directory
-        csv_file = glob.glob("annual_aqi_by_county_*.csv")
-        logging.debug(f"Dataset files found by pandas_data_frame method:{csv_file}")
-        
-        # Dictionary that matches the state name to their abbreviation, to be used for mapping
-        us_state_to_abbrev = {
-            "Alabama": "AL",
-            "Alaska": "AK",
-            "Arizona": "AZ",
-            "Arkansas": "AR",
-            "California": "CA",
-            "Colorado": "CO",
-            "Connecticut": "CT",
-            "Delaware": "DE",
-            "Florida": "FL",
-            "Georgia": "GA",
-            "Hawaii": "HI",
-            "Idaho": "ID",
-            "Illinois": "IL",
-            "Indiana": "IN",
-            "Iowa": "IA",
-            "Kansas": "KS",
-            "Kentucky": "KY",
-            "Louisiana": "LA",
-            "Maine": "ME",
-            "Maryland": "MD",
-            "Massachusetts": "MA",
-            "Michigan": "MI",
-            "Minnesota": "MN",
-            "Mississippi": "MS",
-            "Missouri": "MO",
-            "Montana": "MT",
-            "Nebraska": "NE",
-            "Nevada": "NV",
-            "New Hampshire": "NH",
-            "New Jersey": "NJ",
-            "New Mexico": "NM",
-            "New York": "NY",
-            "North Carolina": "NC",
-            "North Dakota": "ND",
-            "Ohio": "OH",
-            "Oklahoma": "OK",
-            "Oregon": "OR",
-            "Pennsylvania": "PA",
-            "Rhode Island": "RI",
-            "South Carolina": "SC",
-            "South Dakota": "SD",
-            "Tennessee": "TN",
-            "Texas": "TX",
-            "Utah": "UT",
-            "Vermont": "VT",
-            "Virginia": "VA",
-            "Washington": "WA",
-            "West Virginia": "WV",
-            "Wisconsin": "WI",
-            "Wyoming": "WY",
-            "District of Columbia": "DC",
-            "American Samoa": "AS",
-            "Guam": "GU",
-            "Northern Mariana Islands": "MP",
-            "Puerto Rico": "PR",
-            "United States Minor Outlying Islands": "UM",
-            "U.S. Virgin Islands": "VI",
-        }
+        fips_crosswalk = self.birth_obj.fips_crosswalk
 
-        air_quality_df = pd.read_csv(csv_file[0])
-        logging.debug("data file successfully read into pandas_data_frame method")
+        air_quality_years = [self.air_quality_obj.county_index.rows(year) for year in years]
+        birth_years = [self.birth_obj.county_index.rows(year) for year in years]
+        crosswalks = [fips_crosswalk] * len(years)
 
-        # Creates column listing the state abbreviation, and removes rows that do not match a US state
-        air_quality_df["state_abbrev"] = air_quality_df["State"].map(us_state_to_abbrev)
-        air_quality_df = air_quality_df[air_quality_df["state_abbrev"].notna()]
-        
-        # Creates columns that averages the number of days with a given air quality by county, to get state averages
-        air_quality_df["mean_hazardous_days_by_state"] = air_quality_df.groupby("State")["Hazardous Days"].transform("mean")
-        air_quality_df["mean_very_unhealthy_days_by_state"] = air_quality_df.groupby("State")["Very Unhealthy Days"].transform("mean")
-        air_quality_df["mean_unhealthy_days_by_state"] = air_quality_df.groupby("State")["Unhealthy Days"].transform("mean")
-        air_quality_df["mean_moderate_days_by_state"] = air_quality_df.groupby("State")["Moderate Days"].transform("mean")
-        air_quality_df["mean_good_days_by_state"] = air_quality_df.groupby("State")["Good Days"].transform("mean")
+        if len(years) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                yearly_frames = list(executor.map(_combine_year, air_quality_years, birth_years, crosswalks))
+        else:
+            yearly_frames = list(map(_combine_year, air_quality_years, birth_years, crosswalks))
 
-        # Weights days of a bad air quality more to create an air quality score over thw whole state
-        air_quality_df["mean_hazardous_days_weighted"] = air_quality_df["mean_hazardous_days_by_state"].transform(lambda x: x*20)
-        air_quality_df["mean_very_unhealthy_weighted"] = air_quality_df["mean_very_unhealthy_days_by_state"].transform(lambda x: x*10)
-        air_quality_df["mean_unhealthy_weighted"] = air_quality_df["mean_unhealthy_days_by_state"].transform(lambda x: x*5)
+        return {year: dict(zip(COMBINED_FRAME_NAMES, frames)) for year, frames in zip(years, yearly_frames)}
 
-        # Creates an air quality score metric for the whole state
-        air_quality_score_list = []
-        for index, row in air_quality_df.iterrows():
-            air_quality_score_list.append(row["mean_hazardous_days_weighted"] + row["mean_very_unhealthy_weighted"] + row["mean_unhealthy_weighted"] + row["mean_moderate_days_by_state"])
+    @_profiled("combined.merge", rows=lambda frames: len(frames["merged_dataframe"]))
+    def _combine_years(self):
+        """
+        Merges and breaks down every year and returns the long format merged, breakdown and unmatched data frames
+        by name
 
-        air_quality_df["air_quality_score"] = air_quality_score_list
+        Parameters
+        ----------
+        None
+        """
+        combined_frames = _concat_combined(list(self._yearly_frames(self.years).values()))
+        logging.debug(f"Data sets succesfully merged for years: {self.years}")
 
-        return air_quality_df
+        return combined_frames
 
-    # Method outputs data frame to csv file
-    def air_quality_csv(self):
+    def combined_dataframe(self):
         """
-        Out puts a csvfile of the Dataframe stored in the object
+        Combines the airQuality and BirthWeight data sets into a pandas dataframe for further 
+        analysis, one block of rows for each year combined.
 
         Parameters
         ----------
         None
         """
-        # Exports a csv of the dataframe
-        self.dataframe.to_csv("Air_Quality_by_county.csv")
-        logging.debug("Pandas dataframe created, and csv file created")
+        return self._combine_years()["merged_dataframe"]
 
-    # This method creates a chloropleth map giving values to states based on any column of data
-    def chloropleth_usa_map(self, column, output):
+    @_profiled("export.combined_csv")
+    def combined_csv(self, exporter=None):
         """
-        Creates a US map graphic coloring the states by a metric specified in the column parameter
+        Out puts a csvfile of the Dataframe stored in the object
 
         Parameters
         ----------
-        column : str
-            Data to be used to color the states in the map
-        output : str
-            Output of the function either "pdf" or "web"
+        exporter : TableExporter or None
+            Exporter the table is queued on, None writes it now
         """
+        # Exports a csv of the dataframe
+        _export_table(self.merged_dataframe, "Combined.csv", exporter)
+        logging.debug("Pandas dataframe created, and csv file created") 
+     
+    @_profiled("statistics.quadrant_statistics", rows=len)
+    def quadrant_statistics(self, permutations=1000, seed=None):
+        """
+        Returns the quadrant counts and the Pearson and Spearman correlation of air quality score and average
+        birth weight, with permutation test p-values, for every year combined
 
-        if output not in ["pdf", "web"]:
-            raise TypeError("Argument must be either pdf or web")
-
-        states = self.dataframe["state_abbrev"].unique() # Subsets data to keep one row for each state
-        
-        values = self.dataframe[column].unique()
-       
-        # Creates map graphic
-        fig = px.choropleth(locations=states, locationmode="USA-states", color=values, 
-                scope="usa", title="Air Quality by State", labels={"color": "Air Quality Score", "locations" : "State"})
-        
-        if output == "web":
+        Parameters
+        ----------
+        permutations : int
+            Number of permutations in each test
+        seed : int or None
+            Seed of the permutations, None draws fresh ones
+        """
+        if permutations < 1:
+            raise ValueError(f"At least one permutation is drawn, {permutations} were asked for")
 
-            fig.show()
-            logging.debug(f"chloropleth map output to web, created using column: {column}")
+        statistics = _quadrant_statistics(self.breakdown_dataframe, permutations, seed)
+        logging.debug(f"quadrant statistics computed for {len(statistics)} years with {permutations} permutations")
 
-        elif output == "pdf":
-            fig.write_image("Air_Quality_in_US_by_State.pdf")
-            logging.debug(f"chloropleth map output to pdf, created using column: {column}")
+        return statistics
 
-    # This method loads each row into AirQuality_obj and creats a list of all the objects
-    def _load_data_object_list(self):
+    # Method returns the paired ABW and AQS arrays resampled at the level of states or counties
+    def _resampling_arrays(self, level, year):
         """
-        Loads data into AirQuality_obj list
+        Returns the average birth weight and air quality score arrays of one year
 
         Parameters
         ----------
-        none
+        level : str
+            "state" pairs the state ABW and AQS, "county" pairs each county's birth weight with its own score
+        year : int
+            Year resampled
         """
-        air_quality_obj_list = []
-        
-        # Gets list of csv files in directory
-        csv_file = glob.glob("*annual_aqi_by_county_*.csv")
-
-        with open(csv_file[0]) as csv_connection:
-            count_rows = 0
-            csv_reader = csv.reader(csv_connection, delimiter=",")
-
-            for row in csv_reader:
-                state = ""
-                county = ""
-                year = 0
-                good_days = 0
-                moderate_days = 0
-                unhealthy_days = 0
-                very_unhealthy_days = 0
-                hazardous_days = 0
-                max_aqi = 0
-
-                if count_rows == 0: # Skips header row
-                        
-                    count_rows+=1
-                else:
-                    count_token = 1
-                    for token in row:
-                        if count_token == 1:
-                            state = str(token)
-                        elif count_token == 2:
-                            county = str(token)
-                        elif count_token == 3:
-                            year = int(token)
-                        elif count_token == 5:
-                            good_days = int(token)
-                        elif count_token == 6:
-                            moderate_days = int(token)
-                        elif count_token == 8:
-                            unhealthy_days = int(token)
-                        elif count_token == 9:
-                            very_unhealthy_days = int(token)
-                        elif count_token == 10:
-                            hazardous_days = int(token)
-                        elif count_token == 11:
-                            max_aqi = int(token)
-                        elif count_token > 11:
-                            continue
-                        count_token += 1
-
-                # Adds object to list
-                air_quality_obj_list.append(AirQuality_obj(state, county, year, good_days,
-                                            moderate_days, unhealthy_days, very_unhealthy_days,
-                                            hazardous_days, max_aqi))
-
-        return air_quality_obj_list
+        if level == "state":
+            breakdown = self.state_index.rows(year)
+            return breakdown["avg_birth_weight_by_state"].to_numpy(), breakdown["air_quality_score"].to_numpy()
 
-    # Method return the name of the county in the given state with the worst air quality
-    # Bad air quality defined as most Hazardous days, then most Very Unhealthy days etc...
-    def worst_air_quality_in_state(self, state):
+        merged = self.county_index.rows(year)
+        weights = self.air_quality_obj.weights
+        weight_vector = np.array([weights[column] for column in AQI_SCORE_WEIGHTS], dtype=np.float64)
+
+        return merged["average_birth_weight"].to_numpy(), merged[list(AQI_SCORE_WEIGHTS)].to_numpy() @ weight_vector
+
+    @_profiled("statistics.significance")
+    def significance(self, method="bootstrap", replicates=10000, level="state", seed=None, workers=None, year=None):
         """
-        Returns the name of the county in the given state with the worst air quality
-        Bad air quality defined as most Hazardous days, then most Very Unhealthy days etc...
+        Resamples the correlation of air quality score and average birth weight and the share of quadrant 2 and 4.
+        Bootstrap replicates give percentile 95% confidence intervals, permutation replicates give p-values,
+        two sided for the correlation and one sided for the share. Replicates are drawn in batches of
+        RESAMPLING_BATCH_SIZE with one seed each, so a seed gives the same result with any number of workers
 
         Parameters
         ----------
-        state : str
-            State to check air quality
+        method : str
+            Either "bootstrap" or "permutation"
+        replicates : int
+            Number of replicates drawn
+        level : str
+            Either "state" or "county"
+        seed : int or None
+            Seed of the replicates, None draws fresh ones
+        workers : int or None
+            Processes drawing batches, 1 draws them in this process and None uses one per cpu
+        year : int or None
+            Year resampled, None resamples the latest year combined
         """
-        logging.debug(f"worst_air_quality_in_state method called for state: {state}")
-        worst_air_quality = ""
-        worst_air_obj = None
+        if method not in ["bootstrap", "permutation"]:
+            raise ValueError(f"Unknown resampling method: {method}")
+        if level not in ["state", "county"]:
+            raise ValueError(f"Unknown resampling level: {level}")
+        if replicates < 1:
+            raise ValueError(f"At least one replicate is drawn, {replicates} were asked for")
+        year = self._year(year)
+
+        start = time.perf_counter()
+        bw, aqs = self._resampling_arrays(level, year)
+        observed = np.array([_row_correlations(bw[None], aqs[None])[0], _opposite_quadrant_shares(bw[None], aqs[None])[0]])
+
+        sizes = [RESAMPLING_BATCH_SIZE] * (replicates // RESAMPLING_BATCH_SIZE)
+        if replicates % RESAMPLING_BATCH_SIZE:
+            sizes.append(replicates % RESAMPLING_BATCH_SIZE)
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        arguments = [[bw] * len(sizes), [aqs] * len(sizes), [method] * len(sizes), sizes, seeds]
+
+        if len(sizes) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                batches = list(executor.map(_resample_batch, *arguments))
+        else:
+            batches = list(map(_resample_batch, *arguments))
+        samples = np.concatenate(batches)
 
-        for obj in self.obj_list:
-            if worst_air_obj is None and obj.state == state:
-                worst_air_obj = obj
-            elif obj > worst_air_obj and obj.state == state:
-                 worst_air_obj = obj
+        summary = pd.DataFrame({"Year": year, "level": level, "method": method, "replicates": replicates,
+                                "observations": len(bw), "observed": observed,
+                                "replicate_mean": np.nanmean(samples, axis=0), "replicate_std": np.nanstd(samples, axis=0),
+                                "ci_low": np.nan, "ci_high": np.nan, "p_value": np.nan},
+                               index=pd.Index(RESAMPLING_STATISTICS, name="statistic"))
 
-        if worst_air_obj is None:
-            raise ValueError("Not a valid state in argument")
+        if method == "bootstrap":
+            summary["ci_low"], summary["ci_high"] = np.nanpercentile(samples, [2.5, 97.5], axis=0)
         else:
-            worst_air_quality = worst_air_obj.county
+            extreme = [np.abs(samples[:, 0]) >= abs(observed[0]) - 1e-12, samples[:, 1] >= observed[1] - 1e-12]
+            summary["p_value"] = [(1 + hits.sum()) / (replicates + 1) for hits in extreme]
 
-        return worst_air_quality
+        logging.info(f"{replicates} {method} replicates of {len(bw)} {level} rows drawn in {time.perf_counter() - start:.2f}s")
 
-    # Method return the name of the county in the given state with the best air quality
-    # Good air quality defined as least Hazardous days, then least Very Unhealthy days etc...
-    def best_air_quality_in_state(self, state):
+        return summary
+
+    @_profiled("export.significance_csv")
+    def significance_csv(self, **options):
         """
-        Returns the name of the county in the given state with the best air quality
-        Good air quality defined as least Hazardous days, then least Very Unhealthy days etc...
+        Out puts a csvfile of the significance summary
 
         Parameters
         ----------
-        state : str
-            State to check air quality
+        options : dict
+            Keyword arguments of significance
         """
-        logging.debug(f"best_air_quality_in_state method called for state: {state}")
-        best_air_quality = ""
-        best_air_obj = None
-
-        for obj in self.obj_list:
-            if best_air_obj is None and obj.state == state:
-                best_air_obj = obj
-            elif obj < best_air_obj and obj.state == state:
-                 best_air_obj = obj
+        summary = self.significance(**options)
+        for statistic, row in summary.iterrows():
+            if row["method"] == "bootstrap":
+                logging.info(f"{statistic}: observed {row['observed']:.3f}, 95% CI [{row['ci_low']:.3f}, {row['ci_high']:.3f}]")
+            else:
+                logging.info(f"{statistic}: observed {row['observed']:.3f}, p-value {row['p_value']:.4f}")
 
-        if best_air_obj is None:
-            raise ValueError("Not a valid state in argument")
-        else:
-            best_air_quality = best_air_obj.county
+        summary.to_csv("Significance.csv")
+        logging.debug("significance summary created, and csv file created")
 
-        return best_air_quality
+    @_profiled("figure.state_air_quality_bw_breakdown")
+    def state_air_quality_bw_breakdown(self,output, exporter=None, year=None):
 
-    # This method creates a data frame that contains the counties in every state with the best and worst air quality
-    # and then also lists those counties max AQI experienced in a year
-    def extreme_values_data_frame(self):
         """
-        Returns a pandas DataFrame that contains the counties in every state with the best and worst air quality
-        and then also lists those counties max AQI experienced in a year
+        this breaks stats into 4 bins based on median air quality and median average birth wieght by state
+        high ABW and high AQS quadratn 1, low ABW and high AQS, quadrant 2, low ABW and low ABW  quadrant 3, and high ABW and low AQS quadrant 4
+        The boudaries of the bins are the medians of ABW and AQs, we def find a a pattern where out of 48 states in our combined data set
+        we see 15 states in quadrant 2 (Low ABS High AQs) and 15 states in quadrant 4 (High ABS Low AQS).
+        The quadrants come from breakdown_dataframe, the charts only draw them.
+
+        Parameters
+        ----------
+        output : str
+            Output of the function either "pdf", "web" or "figure", every output returns the figures by name and "figure" only returns them
+        exporter : FigureExporter or None
+            Exporter the pdf is queued on, None writes it right away
+        year : int or None
+            Year to break down, None breaks down the latest year combined
         """
-        
-        df = self.dataframe
+        year = self._year(year)
 
-        new_df = pd.DataFrame()
+        breakdown = self.state_index.rows(year)
+        median_bw = breakdown["avg_birth_weight_by_state"].median()
+        median_aqs = breakdown["air_quality_score"].median()
+        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"}
 
-        state_list = []
-        county_list = []
-        aqi_list = []
+        #chart that shows break down of all four quadrant, then one chart per quadrant
+        figures = {"all_quadrants.pdf": (breakdown, "Air Quality Score(AQS) and Average Birth Weight (ABW) by State.", 2)}
+        for quadrant in [1, 2, 3, 4]:
+            figures[f"quadrant_{quadrant}.pdf"] = (breakdown[breakdown["quadrant"] == quadrant], QUADRANT_TITLES[quadrant], 5)
 
-        for state in df["State"].unique():
-            best = self.best_air_quality_in_state(state)
-            worst = self.worst_air_quality_in_state(state)
-            best_aqi = df.loc[df["County"] == best, 'Max AQI'].iloc[0]
-            worst_aqi = df.loc[df["County"] == worst, 'Max AQI'].iloc[0]
+        for filename, (quadrant_df, title, line_width) in figures.items():
+            fig = px.scatter(quadrant_df, x = "avg_birth_weight_by_state", y ="air_quality_score", color= "State", size = "avg_birth_weight_by_state",
+            title = f"{title} (median AQS = blue line, median ABW = red line)", labels = labels)
+            fig.add_vline(x= median_bw, line_width = line_width, line_dash = 'dash', line_color = "red")
+            fig.add_hline(y= median_aqs, line_width = line_width, line_dash = 'dash', line_color = "blue")
 
-            state_list.append(state)
-            state_list.append(state)
-            county_list.append(best)
-            county_list.append(worst)
-            aqi_list.append(best_aqi)
-            aqi_list.append(worst_aqi)
+            if output == "web":
+                fig.show()
+            elif output == "pdf":
+                _export_figure(fig, filename, exporter)
+            figures[filename] = fig
 
-        new_df["State"] = state_list
-        new_df["County"] = county_list
-        new_df["Max_AQI"] = aqi_list
-        return new_df
+        logging.debug(f"writng state AQS & ABW breakdown to {output}")
 
-    # This Method creates a sunburst graphic which displays counties in state with best and worst air quality and specifies maxc AQI values
-    def extreme_aqi_values_sunburst(self, output):
+        return {filename[:-len(".pdf")]: fig for filename, fig in figures.items()}
+
+class AnalysisStages():
+    """
+    Builds each analysis stage the first time it is used and shares it afterwards, so a command only pays
+    for the stages it needs. The combined stage depends on the air quality and birth weight stages,
+    which do not depend on anything
+
+    Attributes
+    ----------
+    cache : FrameCache or None
+        Cache handed to every stage
+    snapshot : Snapshot or None
+        Snapshot the air quality and birth weight stages open instead of parsing the csv files
+    chunksize : int or None
+        Rows of birth_data.csv streamed at a time, keeping only the state aggregates, None loads every county
+    air_quality : Import_AirQuality_Data
+        The air quality stage
+    birth_weight : BirthDataStats
+        The birth weight stage
+    combined : BirthWeight_and_AirQuality
+        The combined stage, built from the two stages above
+    """
+
+    def __init__(self, cache=None, snapshot=None, chunksize=None):
+        self.cache = cache
+        self.snapshot = snapshot
+        self.chunksize = chunksize
+
+    @_profiled("ingest")
+    def ingest(self):
         """
-        Creates a sunburst graphic which displays counties in state with best and worst air quality and specifies maxc AQI values
+        Parses the air quality files and the birth csv at the same time in two processes and builds both stages
+        from them, so ingest takes about as long as the slower parse. The parsed columns come back through shared
+        memory rather than as pickled data frames. The csv files are always read, the cache is only written.
+        A streamed birth csv is not ingested, the birth weight stage streams it when first used
 
         Parameters
         ----------
-        output : str
-            Output of the function either "pdf" or "web"
+        None
         """
+        start = time.perf_counter()
 
-        if output not in ["pdf", "web"]:
-            raise TypeError("Argument must be either pdf or web")
+        if self.chunksize:
+            self.air_quality = Import_AirQuality_Data(cache=self.cache, raw_dataframe=_read_air_quality_files(_find_air_quality_files()))
+            logging.info(f"birth_data.csv is streamed, only the air quality files were ingested in {time.perf_counter() - start:.2f}s")
+            return
 
-        fig = px.sunburst(self.best_worst_dataframe, path=["State", "County"], values="Max_AQI", title="Air Quality by State", 
-                                labels={"labels": "County", "Max_AQI" : "Max AQI", "parent" : "State"})
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            air_quality_handle = executor.submit(_share_air_quality_files, _find_air_quality_files())
+            birth_handle = executor.submit(_share_birth_file)
+            raw_dataframe = _attach_frame(air_quality_handle.result())
+            birth_df = _attach_frame(birth_handle.result())
 
-        if output == "web":
+        logging.info(f"{len(raw_dataframe)} air quality and {len(birth_df)} birth rows ingested in parallel "
+                     f"in {time.perf_counter() - start:.2f}s")
 
-            fig.show()
-            logging.debug("Starburst map output to web")
+        self.air_quality = Import_AirQuality_Data(cache=self.cache, raw_dataframe=raw_dataframe)
+        self.birth_weight = BirthDataStats(cache=self.cache, birth_df=birth_df)
 
-        elif output == "pdf":
-            fig.write_image("Best_and_Worst_AQI_by_State.pdf")
-            logging.debug("Starburst map output to pdf")
+    @cached_property
+    def air_quality(self):
+        return Import_AirQuality_Data(cache=self.cache, snapshot=self.snapshot)
 
-@dataclass(eq=True,order=True)
-class BirthObject():
-    """
-    BirthObject is a data class that is configured to handle __eq__(),__lt__(),
-    __gt__(), __sort__(),__hash __() and  __init__() implicitly
-    or with configs in the decorater.
+    @cached_property
+    def birth_weight(self):
+        return BirthDataStats(chunksize=self.chunksize, cache=self.cache, snapshot=self.snapshot)
 
-    It basically takes all the functionality in the AutoMPG()
-    class but only needs like 6 lines of code
-    pretty sweet
-    """
-    year: str
-    county: str
-    state: str
-    average_birth_weight: float
+    @cached_property
+    def combined(self):
+        return BirthWeight_and_AirQuality(self.air_quality, self.birth_weight, cache=self.cache)
 
-class BirthDataStats():
-    """ 
-    data stats class that loasds data and creats visualizations for analyizing birth weigh
-    data by state, and county
+class IncrementalRefresh():
     """
+    Keeps the FrameCache entries of the air quality, birth weight and combined stages current while only
+    reprocessing what changed since the last refresh, so a refresh costs time in proportion to the new data.
 
-    def __init__(self):
-        self.birth_data()
-        self.df = self.pandas_df()
+    Air quality files are parsed once each and kept as partitions, and the state means and scores are derived
+    per year, so a new or changed yearly file only recomputes the years it holds. Rows appended to
+    birth_data.csv are parsed alone and their state aggregates merged into the stored ones, anything else
+    that changes the file rebuilds it. The combined merge is only redone for years whose air quality or birth
+    data changed, or for every year when the FIPS crosswalk changed. The partitions and a manifest of the
+    processed files live in their own directory
 
-    def __iter__(self):
-        return iter(self.data)
+    Attributes
+    ----------
+    cache : FrameCache
+        Cache the frames of every stage are written to, the other commands read them from it
+    partitions : FrameCache
+        Cache of the per file, per year and birth partitions
+    weights : dict
+        Air quality score weights
+    workers : int or None
+        Number of processes new files are parsed and years combined in, None uses one per cpu
 
+    Methods
+    -------
+    refresh()
+        Brings every stage up to date with the csv files and returns what was reprocessed
+    """
 
-    def birth_data(self):
+    def __init__(self, cache, directory=".aq_refresh", weights=None, workers=None):
         """
-        Creates list of BirthObjects 
-
         Parameters
         ----------
-        None
+        cache : FrameCache
+            Cache the frames of every stage are written to
+        directory : str
+            Directory of the partitions and the manifest
+        weights : dict or None
+            Weights for the air quality score keyed by kind of day, kinds not given keep the AQI_SCORE_WEIGHTS weight
+        workers : int or None
+            Number of processes new files are parsed and years combined in, None uses one per cpu
         """
-        self.data = []
-        Birth = namedtuple("Birth"," year, county_state, a,b,c,d,e, weight, f,g")
-
+        self.cache = cache
+        self.directory = directory
+        self.partitions = FrameCache(directory)
+        self.weights = _score_weights(weights)
+        self.workers = workers
 
-        with open("birth_data.csv","r") as f:
-            reader = csv.reader(f)
-            next(reader)
-            for row in reader:
-                birth = Birth(*[element for element in row])
+    def _read_manifest(self):
+        """
+        Returns the manifest of the last refresh, empty when there was none or it was written by another version
+        of the frames
 
-                b = BirthObject(birth.year.split("-")[0],
-                birth.county_state.split(',')[0],
-                birth.county_state.split(',')[1],
-                round(float(birth.weight)/453.592,2))
+        Parameters
+        ----------
+        None
+        """
+        try:
+            with open(os.path.join(self.directory, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
 
-                self.data.append(b)
+        if manifest.get("format") != CACHE_FORMAT_VERSION:
+            manifest = {}
 
+        return {"format": CACHE_FORMAT_VERSION, "air_quality": {}, "birth_weight": None, "combined": {}, **manifest}
 
-    def pandas_df(self):
+    def _write_manifest(self, manifest):
         """
-        Makes a pandas dataframe from the data and calculates summary statistics 
+        Writes the manifest, through a temporary file so a crash never leaves half of one
 
         Parameters
         ----------
-        None
+        manifest : dict
+            The processed files and partition keys
         """
-        data_frame = pd.DataFrame(self.data)
-        
-        data_frame["avg_birth_weight_by_state"] = data_frame.groupby(["state", "year"])["average_birth_weight"].transform("mean")
-        data_frame["min birth weight by state"] = data_frame.groupby(["state", "year"])["average_birth_weight"].transform("min")
-        data_frame["idx_county_with_lowest_birthweight"]= data_frame.groupby(["state", "year"])["average_birth_weight"].transform("idxmin")
-        data_frame["max birth weight by state"] = data_frame.groupby(["state", "year"])["average_birth_weight"].transform("max")
-        data_frame["idx_county_with_highest_birthweight"]= data_frame.groupby(["state", "year"])["average_birth_weight"].transform("idxmax")
-        
-        data_frame["min birth weight by county"] = data_frame.groupby(["state", "year"])["average_birth_weight"].transform("min")
-        data_frame["max birth weight by county"] = data_frame.groupby(["state", "year"])["average_birth_weight"].transform("max")
+        filename = os.path.join(self.directory, "manifest.json")
+        with open(filename + ".partial", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(filename + ".partial", filename)
 
-        county_lowest_list = []
-        for index, row in data_frame.iterrows():
-            county_lowest_list.append(data_frame.iloc[row["idx_county_with_lowest_birthweight"]]["county"])
-
-        data_frame["county_in_state_lowest_birthweight_by_year"] = county_lowest_list
+    def _prune(self, prefix, stages):
+        """
+        Removes the partitions starting with prefix whose stage is not in stages
 
-        county_highest_list = []
-        for index, row in data_frame.iterrows():
-            county_highest_list.append(data_frame.iloc[row["idx_county_with_highest_birthweight"]]["county"])
+        Parameters
+        ----------
+        prefix : str
+            Start of the stage names
+        stages : set of str
+            Stages kept
+        """
+        for entry in glob.glob(os.path.join(self.directory, f"{prefix}*")):
+            if os.path.basename(entry).rpartition("-")[0] not in stages:
+                shutil.rmtree(entry, ignore_errors=True)
 
-        data_frame["county_in_state_highest_birthweight_by_year"] = county_highest_list
+    def _refresh_air_quality(self, manifest):
+        """
+        Parses the new and changed air quality files, recomputes the years they hold and writes the air quality
+        stage to the cache. Returns the stage and the partition key of every year
 
-        return data_frame
+        Parameters
+        ----------
+        manifest : dict
+            Manifest of the last refresh, updated in place
+        """
+        csv_files = _find_air_quality_files()
+        files = manifest["air_quality"]
 
+        for removed in set(files) - set(csv_files):
+            del files[removed]
 
-    def birth_csv(self):
+        # Only new and changed files are parsed, in parallel when there is more than one
+        changed = [csv_file for csv_file in csv_files if _file_changed(csv_file, files.get(csv_file))]
+        if len(changed) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                parsed = dict(zip(changed, executor.map(_read_air_quality_file, changed)))
+        else:
+            parsed = {csv_file: _read_air_quality_file(csv_file) for csv_file in changed}
+
+        for csv_file, raw_dataframe in parsed.items():
+            files[csv_file] = {**_file_entry(csv_file), "years": sorted(raw_dataframe["Year"].unique().tolist())}
+            self.partitions.store(f"air_quality_file_{os.path.basename(csv_file)}", files[csv_file]["digest"][:16],
+                                  {"raw_dataframe": raw_dataframe})
+        self._prune("air_quality_file_", {f"air_quality_file_{os.path.basename(csv_file)}" for csv_file in csv_files})
+
+        # A year partition is keyed on the files holding the year and the weights, so it is only derived again when one changed
+        years = sorted({year for entry in files.values() for year in entry["years"]})
+        year_keys, year_frames, recomputed = {}, [], []
+        for year in years:
+            year_files = [csv_file for csv_file in csv_files if year in files[csv_file]["years"]]
+            year_keys[year] = hashlib.sha256(json.dumps([[files[csv_file]["digest"] for csv_file in year_files],
+                                                         self.weights], sort_keys=True).encode()).hexdigest()[:16]
+
+            frames = self.partitions.load(f"air_quality_year_{year}", year_keys[year])
+            if frames is None:
+                raw_parts = []
+                for csv_file in year_files:
+                    raw_dataframe = parsed[csv_file] if csv_file in parsed else self._stored_file(csv_file, files[csv_file])
+                    raw_parts.append(raw_dataframe[raw_dataframe["Year"] == year])
+
+                year_stage = Import_AirQuality_Data(weights=self.weights, raw_dataframe=_concat_categorical(raw_parts))
+                frames = {"raw_dataframe": year_stage.raw_dataframe, "dataframe": year_stage.dataframe,
+                          "state_dataframe": year_stage.state_dataframe}
+                self.partitions.store(f"air_quality_year_{year}", year_keys[year], frames)
+                recomputed.append(year)
+
+            year_frames.append(frames)
+        self._prune("air_quality_year_", {f"air_quality_year_{year}" for year in years})
+
+        # The county rows of each year are numbered from 0, they are shifted to their position in the whole data set
+        offsets = np.cumsum([0] + [len(frames["raw_dataframe"]) for frames in year_frames])
+        dataframes = [frames["dataframe"].set_axis(frames["dataframe"].index + offset)
+                      for frames, offset in zip(year_frames, offsets)]
+
+        frames = {"raw_dataframe": _concat_categorical([frames["raw_dataframe"] for frames in year_frames]),
+                  "dataframe": _concat_categorical(dataframes, ignore_index=False),
+                  "state_dataframe": pd.concat([frames["state_dataframe"] for frames in year_frames]).sort_index()}
+        self.cache.store("air_quality", self.cache.key(csv_files, weights=self.weights), frames)
+
+        logging.info(f"air quality: {len(parsed)} of {len(csv_files)} files parsed, years {recomputed} recomputed")
+        return recomputed, year_keys
+
+    def _stored_file(self, csv_file, entry):
         """
-        Out puts a csvfile of the Dataframe stored in the object
+        Returns the parsed rows of an unchanged air quality file from its partition, parsing the file again
+        when the partition is gone
 
         Parameters
         ----------
-        None
+        csv_file : str
+            Path of the csv file
+        entry : dict
+            Manifest entry of the file
         """
-        # Exports a csv of the dataframe
-        self.df.to_csv("Birth_data_by_county.csv")
-        logging.debug("Pandas dataframe created, and csv file created")
+        stored = self.partitions.load(f"air_quality_file_{os.path.basename(csv_file)}", entry["digest"][:16])
+        if stored is None:
+            stored = {"raw_dataframe": _read_air_quality_file(csv_file)}
+            self.partitions.store(f"air_quality_file_{os.path.basename(csv_file)}", entry["digest"][:16], stored)
+
+        return stored["raw_dataframe"]
 
-    def yearly_bw_state(self,output):
+    def _refresh_birth_weight(self, manifest):
         """
-        Creates a scatter plot breaking down average birthweight byt state
+        Brings the birth weight stage up to date and writes it to the cache. Rows appended to birth_data.csv since
+        the last refresh are parsed alone and merged, any other change rebuilds the stage. Returns the years
+        whose rows changed and the partition key of every year
 
         Parameters
         ----------
-        None
+        manifest : dict
+            Manifest of the last refresh, updated in place
         """
-        tst = self.df
-        fig = px.scatter(tst, x = "state", y = "avg_birth_weight_by_state", color ="year",
-            title = "2016-2018 Breakdown of Average Birthweight by State", labels={
-                "year" : "Year", "avg_birth_weight_by_state" : "Average Birth Weight (lbs)",
-                "state" : "State"
-            }) 
-       
-        if output == "web":
+        entry = manifest["birth_weight"]
+        stored = self.partitions.load("birth_weight", entry["digest"][:16]) if entry else None
+
+        # The cache entry is written again from the partition, it may have been cleared since the last refresh
+        if stored is not None and not _file_changed("birth_data.csv", entry):
+            self._store_birth_weight(stored["rows"], stored["aggregates"])
+            logging.info("birth weight: birth_data.csv unchanged")
+            return [], entry["years"]
+
+        # Rows were only appended when the file still starts with every byte processed last time, up to the end of a line
+        appended = stored is not None and os.stat("birth_data.csv").st_size > entry["size"] \
+                   and _file_digest("birth_data.csv", entry["size"]) == entry["digest"]
+
+        if appended:
+            with open("birth_data.csv", "rb") as f:
+                header = f.readline()
+                f.seek(entry["size"] - 1)
+                tail = f.read()
+            appended = tail.startswith(b"\n")
+
+        if appended:
+            new_rows = _parse_birth_chunk(pd.read_csv(io.BytesIO(header + tail[1:]), usecols=BIRTH_CSV_COLUMNS, dtype=BIRTH_CSV_DTYPES))
+
+            rows = _concat_categorical([stored["rows"], new_rows])
+            aggregates = _merge_birth_aggregates([stored["aggregates"], _birth_chunk_aggregates(new_rows, offset=len(stored["rows"]))],
+                                                 positions=True)
+            year_keys = dict(entry["years"])
+        else:
+            new_rows = rows = _read_birth_file()
+            aggregates = _merge_birth_aggregates([_birth_chunk_aggregates(rows)], positions=True)
+            year_keys = {}
 
-            fig.show()
-            logging.debug("yearly birth weight by state scatter plot to web")
+        manifest["birth_weight"] = entry = _file_entry("birth_data.csv")
+        self.partitions.store("birth_weight", entry["digest"][:16], {"rows": rows, "aggregates": aggregates})
 
-        elif output == "pdf":
-            fig.write_image("yearly_bw_state.pdf")
-            logging.debug("scatter chart output to pdf")
+        # Only the years with new rows get a new key, the combined merge of the other years stays valid
+        changed_years = sorted(int(year) for year in new_rows["year"].unique())
+        year_keys.update({str(year): entry["digest"][:16] for year in changed_years})
+        entry["years"] = year_keys
 
+        self._store_birth_weight(rows, aggregates)
 
-    def lowest_weight_in_state(self,output, year):
+        logging.info(f"birth weight: {len(new_rows)} of {len(rows)} rows parsed" + (", appended" if appended else ""))
+        return changed_years, year_keys
+
+    def _store_birth_weight(self, rows, aggregates):
         """
-        Outputs plot displaying the counties in the state with the minimum average birthweight
+        Writes the birth weight stage of an unstreamed run to the cache
 
         Parameters
         ----------
-        None
+        rows : pandas dataframe
+            Every parsed row of birth_data.csv
+        aggregates : pandas dataframe
+            The merged aggregates of the rows
         """
-        temp = self.df
-        temp_year = temp[temp["year"] == year]
-        temp_drop = temp_year.drop_duplicates(subset="state")
-        
-        fig = px.bar(temp_drop, x = "state", y ="min birth weight by county", title= "County with the Lowest Birth Weight in State", barmode='group',
-                        log_y=True, text="county_in_state_lowest_birthweight_by_year", labels={
-                            "average_birth_weight" : "Average Birth Weight in County (lbs)",
-                            "state" : "State"
-                        })
-       
-        if output == "web":
-
-            fig.show()
-            logging.debug("Lowest birth weight in state bar chart to web")
+        frames = {"df": _birth_county_frame(rows, aggregates), "state_df": aggregates[BIRTH_STATE_COLUMNS]}
+        self.cache.store("birth_weight", self.cache.key(["birth_data.csv"], chunksize=None), frames)
 
-        elif output == "pdf":
-            fig.write_image("lowest_weight_in_state.pdf")
-            logging.debug("Lowest weight in state bar chart output to pdf")
+    def _refresh_combined(self, manifest, air_quality_keys, birth_keys):
+        """
+        Combines the years whose air quality or birth data changed, reuses every other year and writes the
+        combined stage to the cache. Returns the years combined again
 
-    def highest_weight_in_state(self,output, year):
+        Parameters
+        ----------
+        manifest : dict
+            Manifest of the last refresh, updated in place
+        air_quality_keys : dict
+            Partition key of each air quality year
+        birth_keys : dict
+            Partition key of each birth year, keyed by the year as a string
         """
-        Outputs bar chart displaying the county in a state with the highest birthweight
+        # Both stages were just written to the cache, so they are read back rather than computed
+        air_quality = Import_AirQuality_Data(weights=self.weights, cache=self.cache)
+        birth_weight = BirthDataStats(cache=self.cache)
+        combined = BirthWeight_and_AirQuality(air_quality, birth_weight, cache=self.cache, workers=self.workers)
+
+        # A county added to the birth data can match air quality rows of any year, so a new crosswalk invalidates every year
+        crosswalk = birth_weight.fips_crosswalk
+        crosswalk_key = hashlib.sha256(pd.util.hash_pandas_object(crosswalk).to_numpy().tobytes()).hexdigest()[:16]
+
+        year_keys = {str(year): hashlib.sha256(f"{air_quality_keys[year]}:{birth_keys[str(year)]}:{crosswalk_key}".encode())
+                                       .hexdigest()[:16] for year in combined.years}
+        yearly_frames = {year: self.partitions.load(f"combined_year_{year}", year_keys[str(year)]) for year in combined.years}
+        yearly_frames = {year: frames and _restore_quadrants(frames) for year, frames in yearly_frames.items()}
+
+        recomputed = [year for year, frames in yearly_frames.items() if frames is None]
+        for year, frames in combined._yearly_frames(recomputed).items():
+            self.partitions.store(f"combined_year_{year}", year_keys[str(year)], frames)
+            yearly_frames[year] = frames
+        self._prune("combined_year_", {f"combined_year_{year}" for year in combined.years})
+        manifest["combined"] = year_keys
+
+        cache_key = self.cache.key(air_quality.csv_files + ["birth_data.csv"], weights=air_quality.weights, years=combined.years,
+                                   streamed=False)
+        self.cache.store("combined", cache_key, _concat_combined([yearly_frames[year] for year in combined.years]))
+
+        logging.info(f"combined: years {recomputed} of {combined.years} merged again")
+        return recomputed
+
+    @_profiled("refresh")
+    def refresh(self):
+        """
+        Brings the cached frames of every stage up to date with the csv files and returns a dictionary of the air
+        quality years, birth years and combined years that were recomputed
 
         Parameters
         ----------
         None
         """
-        temp = self.df
-        temp_year = temp[temp["year"] == year]
-        temp_drop = temp_year.drop_duplicates(subset="state")
-        
-        fig = px.bar(temp_drop, x = "state", y ="max birth weight by county", title= "County with the Highest Birth Weight in State", barmode='group',
-                        log_y=True, text="county_in_state_highest_birthweight_by_year", labels={
-                            "average_birth_weight" : "Average Birth Weight in County (lbs)",
-                            "state" : "State"
-                        })
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self._read_manifest()
+        manifest["weights"] = self.weights
 
-        if output == "web":
+        air_quality_years, air_quality_keys = self._refresh_air_quality(manifest)
+        birth_years, birth_keys = self._refresh_birth_weight(manifest)
+        combined_years = self._refresh_combined(manifest, air_quality_keys, birth_keys)
 
-            fig.show()
-            logging.debug("Highest birth weight in state bar chart to web")
+        self._write_manifest(manifest)
 
-        elif output == "pdf":
-            fig.write_image("highest_weight_in_state.pdf")
-            logging.debug("Highest weight in state bar chart output to pdf")   
+        return {"air_quality_years": air_quality_years, "birth_years": birth_years, "combined_years": combined_years}
 
-class BirthWeight_and_AirQuality():
+class AnalysisServer():
+    """
+    Serves the charts and data of the analysis over HTTP from data sets loaded once and kept in memory. Charts
+    are served under /charts/<name> as html, or as plotly json with ?format=json, and query results under
+    /data/<name> as json. Each response is cached by its path and query parameters. Requests are answered by an
+    asyncio server and computed one at a time on a worker thread, so a slow chart never blocks cached responses
 
-    def __init__(self, air_quality_obj, birth_obj):
-        self.air_quality_obj = air_quality_obj
-        self.birth_obj = birth_obj
-        self.merged_dataframe = self.combined_dataframe()
+    Attributes
+    ----------
+    stages : AnalysisStages
+        The stages the responses are computed from
+    responses : OrderedDict
+        Cached responses keyed by path and sorted query parameters, least recently used first
+    cache_size : int
+        Number of responses kept
+    hits : int
+        Number of requests answered from the cache
 
-    def combined_dataframe(self):
-        """
-        Combines the airQuality and BirthWeight data sets into a pandas dataframe for further 
-        analysis.
+    Methods
+    -------
+    warm()
+        Loads every data set and derived frame the routes use
+    respond(path, query)
+        Returns the status, content type and body of a request, from the cache when it was seen before
+    serve(host, port)
+        Serves requests until cancelled
+    """
 
+    def __init__(self, stages, cache_size=SERVER_CACHE_SIZE):
+        """
         Parameters
         ----------
-        None
+        stages : AnalysisStages
+            The stages the responses are computed from
+        cache_size : int
+            Number of responses kept
         """
+        self.stages = stages
+        self.responses = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+
+        # Figures built by the chart methods without showing or writing them
+        self.charts = {
+            "choropleth": lambda query: stages.air_quality.chloropleth_usa_map(query.get("column", "air_quality_score"), "figure"),
+            "sunburst": lambda query: stages.air_quality.extreme_aqi_values_sunburst("figure"),
+            "yearly_birth_weight": lambda query: stages.birth_weight.yearly_bw_state("figure"),
+            "lowest_birth_weight": lambda query: stages.birth_weight.lowest_weight_in_state("figure", query.get("year")),
+            "highest_birth_weight": lambda query: stages.birth_weight.highest_weight_in_state("figure", query.get("year")),
+            "quadrants": lambda query: stages.combined.state_air_quality_bw_breakdown("figure", year=self._year(query))[
+                f"quadrant_{query['quadrant']}" if "quadrant" in query else "all_quadrants"],
+        }
 
-        air_quality_df = self.air_quality_obj.dataframe
-        birth_df = self.birth_obj.df
-        birth_df = birth_df[birth_df["year"] == "2018"]
-        birth_df = birth_df.drop_duplicates(subset=["county", "state"])
-        
-
-        counties = birth_df["county"].tolist()
-        counties_list = [x[:x.find("County")-1] for x in counties]
+        # Data frames returned as json records
+        self.queries = {
+            "air_quality_by_state": lambda query: stages.air_quality.state_dataframe.reset_index(),
+            "extreme_values": lambda query: stages.air_quality.best_worst_dataframe,
+            "birth_weight_by_state": lambda query: stages.birth_weight.state_df,
+            "breakdown": lambda query: stages.combined.breakdown_dataframe if "year" not in query
+                                       else stages.combined.state_index.rows(int(query["year"])),
+            "county": lambda query: pd.DataFrame([stages.combined.county_data(query["state"], query["county"], self._year(query))]),
+            "state": lambda query: pd.DataFrame([stages.combined.state_data(query["state"], self._year(query))]),
+            "quadrant_statistics": lambda query: stages.combined.quadrant_statistics(self._count(query, "permutations", 1000),
+                                                                                     self._seed(query)),
+            "significance": lambda query: stages.combined.significance(query.get("method", "bootstrap"),
+                self._count(query, "replicates", 10000), query.get("level", "state"), self._seed(query),
+                year=self._year(query)).reset_index(),
+        }
 
-        birth_df["County"] = counties_list
+    @staticmethod
+    def _year(query):
+        return int(query["year"]) if "year" in query else None
 
-        abbrev = birth_df["state"].tolist()
-        abbrev_list = [x.strip() for x in abbrev]
-        birth_df["state_abbrev"] = abbrev_list
+    @staticmethod
+    def _seed(query):
+        return int(query["seed"]) if "seed" in query else None
 
-        merged_df = pd.merge(air_quality_df, birth_df, on=["County", "state_abbrev"])
+    # Replicates and permutations are bounded so one request cannot hold the worker thread for long
+    @staticmethod
+    def _count(query, name, default):
+        count = int(query.get(name, default))
+        if not 1 <= count <= SERVER_MAX_REPLICATES:
+            raise ValueError(f"{name} must be between 1 and {SERVER_MAX_REPLICATES}, not {count}")
+        return count
 
-        logging.debug("Data sets succesfully merged")
-        
-        return merged_df
 
-    def combined_csv(self):
+    def warm(self):
         """
-        Out puts a csvfile of the Dataframe stored in the object
+        Loads both data sets, combines them and derives the frames the routes use, so the first request of a
+        route only pays for its own chart or query
 
         Parameters
         ----------
         None
         """
-        # Exports a csv of the dataframe
-        self.merged_dataframe.to_csv("Combined.csv")
-        logging.debug("Pandas dataframe created, and csv file created") 
-     
-    def state_air_quality_bw_breakdown(self,output):
+        start = time.perf_counter()
+        self.stages.air_quality.best_worst_dataframe
+        self.stages.combined.breakdown_dataframe
+        logging.info(f"data sets loaded in {time.perf_counter() - start:.2f}s")
 
+    def _compute(self, path, query):
         """
-        this breaks stats into 4 bins based on median air quality and median average birth wieght by state
-        high ABW and high AQS quadratn 1, low ABW and high AQS, quadrant 2, low ABW and low ABW  quadrant 3, and high ABW and low AQS quadrant 4
-        The boudaries of the bins are the medians of ABW and AQs, we def find a a pattern where out of 46 states in our combined data set
-        we see 14 states in quadrant 2 (Low ABS High AQs) and 14 states in quadrant 4 (High ABS Low AQS).
+        Returns the status, content type and body of a request, computed from the stages
+
+        Parameters
+        ----------
+        path : str
+            Path of the request
+        query : dict
+            Query parameters of the request
         """
+        kind, _, name = path.strip("/").partition("/")
 
-        breakdown = self.merged_dataframe[["State","air_quality_score","avg_birth_weight_by_state"]].drop_duplicates()
-        breakdown["avg_birth_weight_by_state"] = breakdown["avg_birth_weight_by_state"].map(lambda x: round(x,3))
-        breakdown["air_quality_score"] = breakdown["air_quality_score"].map(lambda x: round(x,3))
+        if kind == "" and name == "":
+            routes = {"charts": sorted(self.charts), "data": sorted(self.queries)}
+            return 200, "application/json", json.dumps(routes).encode()
 
+        if kind == "charts" and name in self.charts:
+            fig = self.charts[name](query)
+            if query.get("format", "html") == "json":
+                return 200, "application/json", fig.to_json().encode()
+            return 200, "text/html; charset=utf-8", fig.to_html(include_plotlyjs="cdn").encode()
 
+        if kind == "data" and name in self.queries:
+            return 200, "application/json", self.queries[name](query).to_json(orient="records").encode()
 
-        # setting median values for quadrant boundaries
-        median_bw = breakdown["avg_birth_weight_by_state"].median()
-        median_aqs = breakdown["air_quality_score"].median()
+        return 404, "application/json", json.dumps({"error": f"no route {path}"}).encode()
 
-        #setting qadrant boundries
-        bw_below_median = breakdown["avg_birth_weight_by_state"] < round(median_bw,2)
-        aqs_below_median = breakdown["air_quality_score"] < round(median_aqs,2)
-        bw_above_median = breakdown["avg_birth_weight_by_state"] > round(median_bw,2)
-        aqs_above_median =  breakdown["air_quality_score"] > round(median_aqs,2)
+    def _answer(self, path, query):
+        """
+        Returns the status, content type and body of a request, a request the routes reject is answered with a 400.
+        Never touches the cached responses, so it can run on the worker thread
 
-        #building quandrant data sets
-        first_quadrant = breakdown.where(bw_above_median & aqs_above_median).dropna()
-        second_quadrant = breakdown.where(bw_below_median & aqs_above_median).dropna()
-        third_quadrant = breakdown.where(bw_below_median & aqs_below_median).dropna()
-        fourth_quadrant = breakdown.where(bw_above_median & aqs_below_median).dropna()
+        Parameters
+        ----------
+        path : str
+            Path of the request
+        query : dict
+            Query parameters of the request
+        """
+        try:
+            return self._compute(path, query)
+        except (KeyError, ValueError, TypeError) as e:
+            return 400, "application/json", json.dumps({"error": str(e)}).encode()
 
-        #chart that shows break down of all four quadrant
-        fig = px.scatter(breakdown, x = "avg_birth_weight_by_state", y ="air_quality_score", color= "State", size = "avg_birth_weight_by_state",
-        title ="Air Quality Score(AQS) and Average Birth Weight (ABW) by State. (median AQS = blue line, median ABW  = red line)",
-        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"})
-        fig.add_vline(x= breakdown["avg_birth_weight_by_state"].median(), line_width = 2, line_dash = 'dash', line_color = "red")
-        fig.add_hline(y= breakdown['air_quality_score'].median(),line_width = 2, line_dash = 'dash', line_color = "blue")
+    # The cached responses are only read and written by the thread calling respond, the event loop when serving
+    def _cached(self, key):
+        """
+        Returns the cached response of a key and marks it most recently used, or None when it is not cached
 
+        Parameters
+        ----------
+        key : tuple
+            Path and sorted query parameters of the request
+        """
+        response = self.responses.get(key)
+        if response is not None:
+            self.hits += 1
+            self.responses.move_to_end(key)
 
+        return response
 
-        #chart that shows the first quadrant breakdown, note it has 13 states
-        fig1 = px.scatter(first_quadrant,x ="avg_birth_weight_by_state" , y ="air_quality_score", color= "State",size = "avg_birth_weight_by_state",
-        title = "Quadrant 1 High ABW & High AQS (median AQS = blue line, median ABW = red line)",
-        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"})
-        fig1.add_vline(x= breakdown["avg_birth_weight_by_state"].median(), line_width = 5, line_dash = 'dash', line_color = "red")
-        fig1.add_hline(y= breakdown['air_quality_score'].median(),line_width = 5, line_dash = 'dash', line_color = "blue")
+    def _store(self, key, response):
+        """
+        Caches a successful response and drops the least recently used past cache_size
 
+        Parameters
+        ----------
+        key : tuple
+            Path and sorted query parameters of the request
+        response : tuple
+            Status, content type and body
+        """
+        if response[0] == 200:
+            self.responses[key] = response
+            self.responses.move_to_end(key)
+            if len(self.responses) > self.cache_size:
+                self.responses.popitem(last=False)
 
+    def respond(self, path, query):
+        """
+        Returns the status, content type and body of a request, from the cache when the same path and query
+        parameters were requested before. Only successful responses are cached
 
-        #chart that shows the breakdown of the second quadrant
-        fig2 = px.scatter(second_quadrant,x ="avg_birth_weight_by_state" , y ="air_quality_score", color= "State",size = "avg_birth_weight_by_state",
-        title = "Quadrant 2 Low ABW & High AQS  (median AQS = blue line, median ABW = red line)",
-        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"})
-        fig2.add_vline(x= breakdown["avg_birth_weight_by_state"].median(), line_width = 5, line_dash = 'dash', line_color = "red")
-        fig2.add_hline(y= breakdown['air_quality_score'].median(),line_width = 5, line_dash = 'dash', line_color = "blue")
+        Parameters
+        ----------
+        path : str
+            Path of the request
+        query : dict
+            Query parameters of the request
+        """
+        key = (path.rstrip("/"), tuple(sorted(query.items())))
 
+        response = self._cached(key)
+        if response is None:
+            response = self._answer(path, query)
+            self._store(key, response)
 
-        #chart that shows tbe breakdown of the third quadrant
-        fig3 = px.scatter(third_quadrant,x ="avg_birth_weight_by_state" , y ="air_quality_score", color= "State",size = "avg_birth_weight_by_state",
-        title = "Quadrant 3 Low ABW & Low AQS (median AQS = blue line, median ABW = red line)",
-        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"})
-        fig3.add_vline(x= breakdown["avg_birth_weight_by_state"].median(), line_width = 5, line_dash = 'dash', line_color = "red")
-        fig3.add_hline(y= breakdown['air_quality_score'].median(),line_width = 5, line_dash = 'dash', line_color = "blue")
+        return response
 
+    async def _handle(self, reader, writer, executor):
+        """
+        Answers one HTTP request and closes the connection
 
-        #chart that shows the breakdown of the fourth quadrant
-        fig4 = px.scatter(fourth_quadrant,x ="avg_birth_weight_by_state" , y ="air_quality_score", color= "State", size = "avg_birth_weight_by_state",
-        title = "Quadrant 4 High ABW & Low AQS (median air quality score = blue line, median average birth weight = red line)",
-        labels = {"avg_birth_weight_by_state" : 'Average Birth Weight(lbs)', 'air_quality_score': 'Air Quality Score', 'State':"State"})
-        fig4.add_vline(x= breakdown["avg_birth_weight_by_state"].median(), line_width = 5, line_dash = 'dash', line_color = "red")
-        fig4.add_hline(y= breakdown['air_quality_score'].median(),line_width = 5, line_dash = 'dash', line_color = "blue")
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            Stream of the request
+        writer : asyncio.StreamWriter
+            Stream of the response
+        executor : ThreadPoolExecutor
+            Thread responses that are not cached are computed on
+        """
+        request_line = []
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if len(request_line) < 2:
+                status, content_type, body = 400, "application/json", b'{"error": "malformed request"}'
+            elif request_line[0] != "GET":
+                status, content_type, body = 405, "application/json", b'{"error": "only GET is served"}'
+            else:
+                url = urlsplit(request_line[1])
+                query = dict(parse_qsl(url.query))
+                key = (url.path.rstrip("/"), tuple(sorted(query.items())))
+
+                # Cached responses are answered on the event loop, anything else is computed on the worker thread
+                # and cached back on the event loop, the only thread touching the cached responses
+                response = self._cached(key)
+                if response is None:
+                    response = await asyncio.get_running_loop().run_in_executor(executor, self._answer, url.path, query)
+                    self._store(key, response)
+                status, content_type, body = response
+        except Exception as e:
+            logging.exception("request failed")
+            status, content_type, body = 500, "application/json", json.dumps({"error": str(e)}).encode()
+
+        logging.debug(f"{' '.join(request_line[:2])} {status} {len(body)} bytes")
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8050, started=None):
+        """
+        Serves requests until cancelled
 
-        if output == "web":
+        Parameters
+        ----------
+        host : str
+            Address listened on
+        port : int
+            Port listened on, 0 picks a free port
+        started : asyncio.Future or None
+            Set to the address listened on once the server accepts connections
+        """
+        # One thread computes every uncached response, the stages build their frames lazily and are not thread safe
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            server = await asyncio.start_server(lambda reader, writer: self._handle(reader, writer, executor), host, port)
+            address = server.sockets[0].getsockname()[:2]
+            logging.info(f"serving the analysis on http://{address[0]}:{address[1]}/")
+            if started is not None:
+                started.set_result(address)
+
+            async with server:
+                await server.serve_forever()
+
+# Argument type of the counts given on the command line
+def _positive_int(value):
+    """
+    Returns the value as an int, argparse reports an error for anything that is not a whole number above zero
 
-            fig.show()
-            fig1.show()
-            fig2.show()
-            fig3.show()
-            fig4.show()
-            logging.debug("writng state AQS & ABW breakdown to web")
+    Parameters
+    ----------
+    value : str
+        Command line value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a whole number above zero")
 
-        elif output == "pdf":
-            fig.write_image("all_quadrants.pdf")
-            fig1.write_image("quadrant_1.pdf")
-            fig2.write_image("quadrant_2.pdf")
-            fig3.write_image("quadrant_3.pdf")
-            fig4.write_image("quadrant_4.pdf")
-            logging.debug("writng state AQS & ABW breakdown to pdf")
+    return number
 
-        
-    
 def main():
     # sets root logger to DEBUG
     rootLogger = logging.getLogger()
@@ -894,8 +4188,9 @@ def main():
         description="Analyze air quality data and birth rate data to find trends"
     )
 
-    #store is for pdf or csv, render is for web
-    parser.add_argument(choices =["store", "render"], dest='command',
+    #store is for pdf or csv, render is for web, significance resamples the combined data, snapshot converts the csv files,
+    #serve keeps the data sets loaded and serves the charts over http, refresh updates the cache with only the new data
+    parser.add_argument(choices =["store", "render", "significance", "snapshot", "serve", "refresh"], dest='command',
     action ="store", type =str, help= "required command to execute")
 
 
@@ -911,65 +4206,170 @@ def main():
     parser.add_argument("-p","--pdf", dest="PDF", metavar= '<pdf output', choices = ["air_quality",
     "birth_weight","combined","all"])
 
+    # options for store command, how the -c tables are written
+    parser.add_argument("--format", dest="FORMAT", default="csv", choices=["csv", "parquet"],
+    help="file format of the tables written by -c")
+    parser.add_argument("--compression", dest="COMPRESSION", default=None, choices=["gzip", "zstd"],
+    help="compression of the tables written by -c, zstd csv files need the zstandard package")
+    parser.add_argument("--partition-by", dest="PARTITION_BY", default=None, choices=EXPORT_PARTITIONS,
+    help="write one file per state or year into a directory named after each table")
+
+    # options for the cache of derived data frames
+    parser.add_argument("--cache-dir", dest="CACHE_DIR", default=".aq_cache", metavar="<cache directory>",
+    help="directory caching the derived data frames between runs")
+    parser.add_argument("--no-cache", dest="NO_CACHE", action="store_true", help="always re-read the csv files")
+
+    # option for store command, pdfs are rendered in parallel by this many processes
+    parser.add_argument("--workers", dest="WORKERS", type=int, default=None, metavar="<workers>",
+    help="number of processes exporting pdf figures or drawing replicates, defaults to one per cpu")
+
+    # option for the birth weight and combined charts, the combined csv always holds every year
+    parser.add_argument("-y", "--year", dest="YEAR", type=int, default=None, metavar="<year>",
+    help="year charted by the birth weight and combined choices or resampled, defaults to the latest year")
+
+    # options for significance command
+    parser.add_argument("--method", dest="METHOD", default="bootstrap", choices=["bootstrap", "permutation"],
+    help="bootstrap confidence intervals or permutation p-values")
+    parser.add_argument("--replicates", dest="REPLICATES", type=_positive_int, default=10000, metavar="<replicates>",
+    help="number of replicates drawn")
+    parser.add_argument("--level", dest="LEVEL", default="state", choices=["state", "county"],
+    help="resample states or counties")
+    parser.add_argument("--seed", dest="SEED", type=int, default=None, metavar="<seed>",
+    help="seed of the replicates")
+
+    # option for snapshot command, the other commands open the snapshot when it is current
+    parser.add_argument("--snapshot-dir", dest="SNAPSHOT_DIR", default=".aq_snapshot", metavar="<snapshot directory>",
+    help="directory of the binary snapshot of the parsed csv files")
+
+    # keeps only the birth state aggregates, the county rows, combined csv and county resampling are not available
+    parser.add_argument("--chunksize", dest="CHUNKSIZE", type=_positive_int, default=None, metavar="<rows>",
+    help="stream birth_data.csv this many rows at a time and keep only the state aggregates")
+
+    # parses both data sets at once before any choice uses them
+    parser.add_argument("--parallel-ingest", dest="PARALLEL_INGEST", action="store_true",
+    help="parse the air quality and birth csv files concurrently in two processes")
+
+    # option for refresh command
+    parser.add_argument("--refresh-dir", dest="REFRESH_DIR", default=".aq_refresh", metavar="<refresh directory>",
+    help="directory of the partitions and manifest of the files already processed by refresh")
+
+    # options for serve command
+    parser.add_argument("--host", dest="HOST", default="127.0.0.1", metavar="<host>", help="address the server listens on")
+    parser.add_argument("--port", dest="PORT", type=int, default=8050, metavar="<port>", help="port the server listens on")
+
+    # options timing every stage of the run
+    parser.add_argument("--profile", dest="PROFILE", nargs="?", const="profile.json", default=None, metavar="<report>",
+    help="write the time, rows and memory delta of every stage to a json report, profile.json by default")
+    parser.add_argument("--profile-dir", dest="PROFILE_DIR", default=None, metavar="<profile directory>",
+    help="also write a cProfile dump of every stage to this directory, used with --profile")
+
     # Parse the arguments given
     args = parser.parse_args()
+
+    # The county rows are not kept when the birth csv is streamed, refused before any stage runs or table is queued
+    if args.CHUNKSIZE and args.command == "store" and args.CSV in ["combined", "all"]:
+        parser.error(f"-c {args.CSV} writes the combined counties, which need the birth county rows --chunksize does not keep")
+    if args.CHUNKSIZE and args.command == "significance" and args.LEVEL == "county":
+        parser.error("--level county resamples the combined counties, which need the birth county rows --chunksize does not keep")
+
+    if args.PROFILE:
+        PROFILER.enable(args.PROFILE_DIR)
+
+    cache = None if args.NO_CACHE else FrameCache(args.CACHE_DIR)
     
-    # Creates objects of the air quality data, birth data and combined
-    air_quality_obj = Import_AirQuality_Data()
-   
-    
-    
+    # The air quality data, birth data and combined objects are only created if a choice below uses them
+    stages = AnalysisStages(cache, Snapshot(args.SNAPSHOT_DIR), args.CHUNKSIZE)
+    if args.PARALLEL_INGEST:
+        stages.ingest()
+
+    # Collects every pdf requested so they are exported together at the end
+    exporter = FigureExporter(args.WORKERS)
+
+    # Collects every table requested so they are written together at the end
+    try:
+        tables = TableExporter(args.WORKERS, args.FORMAT, args.COMPRESSION, args.PARTITION_BY)
+    except ImportError as e:
+        parser.error(f"--compression {args.COMPRESSION} is not available: {e}")
 
     # command line argument logic checks
     if (args.WEB == "air_quality" or args.WEB == "all")  and args.command == 'render':
-        air_quality_obj.chloropleth_usa_map("air_quality_score", "web")
-        air_quality_obj.extreme_aqi_values_sunburst("web")
+        stages.air_quality.chloropleth_usa_map("air_quality_score", "web")
+        stages.air_quality.extreme_aqi_values_sunburst("web")
   
     if (args.PDF == "air_quality" or args.PDF == "all") and args.command == 'store':
-        air_quality_obj.chloropleth_usa_map("air_quality_score", "pdf")
-        air_quality_obj.extreme_aqi_values_sunburst("pdf")
+        stages.air_quality.chloropleth_usa_map("air_quality_score", "pdf", exporter=exporter)
+        stages.air_quality.extreme_aqi_values_sunburst("pdf", exporter=exporter)
     
     if (args.CSV == "air_quality" or args.CSV == "all") and args.command == 'store':
-        air_quality_obj.air_quality_csv()
+        stages.air_quality.air_quality_csv(exporter=tables)
     
     ####################################################################################
     #birth weight data 
-    birth = BirthDataStats()
 
+    birth_year = None if args.YEAR is None else str(args.YEAR)
 
     if (args.WEB == "birth_weight" or args.WEB == "all") and args.command == 'render':
-        birth.yearly_bw_state("web")
-        birth.lowest_weight_in_state("web", "2018")
-        birth.highest_weight_in_state("web", "2018")
+        stages.birth_weight.yearly_bw_state("web")
+        stages.birth_weight.lowest_weight_in_state("web", birth_year)
+        stages.birth_weight.highest_weight_in_state("web", birth_year)
    
 
     if (args.PDF == "birth_weight" or args.PDF == "all") and args.command == 'store':
-        birth.yearly_bw_state("pdf")
-        birth.lowest_weight_in_state("pdf", "2018")
-        birth.highest_weight_in_state("pdf", "2018")
+        stages.birth_weight.yearly_bw_state("pdf", exporter=exporter)
+        stages.birth_weight.lowest_weight_in_state("pdf", birth_year, exporter=exporter)
+        stages.birth_weight.highest_weight_in_state("pdf", birth_year, exporter=exporter)
 
 
     if (args.CSV == "birth_weight" or args.CSV == "all") and args.command == 'store':
-        birth.birth_csv()
+        stages.birth_weight.birth_csv(exporter=tables)
     
    
 ####################################################################################
 #combined data
-    combined = BirthWeight_and_AirQuality(air_quality_obj, birth)
-
     if (args.WEB == "combined" or args.WEB == "all") and args.command == "render":
-        combined.state_air_quality_bw_breakdown("web")
+        stages.combined.state_air_quality_bw_breakdown("web", year=args.YEAR)
     
 
     if (args.PDF == "combined" or args.PDF == "all") and args.command == "store":
-        combined.state_air_quality_bw_breakdown("pdf")
+        stages.combined.state_air_quality_bw_breakdown("pdf", exporter=exporter, year=args.YEAR)
    
 
     if (args.CSV == "combined" or args.CSV == "all") and args.command == "store":
-        combined.combined_csv()
+        stages.combined.combined_csv(exporter=tables)
+
+    if args.command == "snapshot":
+        snapshot = Snapshot(args.SNAPSHOT_DIR)
+        csv_files = _find_air_quality_files()
+        snapshot.write("air_quality", _read_air_quality_files(csv_files), csv_files)
+        snapshot.write("birth_weight", _read_birth_file(), ["birth_data.csv"])
+
+    if args.command == "significance":
+        stages.combined.significance_csv(method=args.METHOD, replicates=args.REPLICATES, level=args.LEVEL,
+                                         seed=args.SEED, workers=args.WORKERS, year=args.YEAR)
+
+    exporter.export()
+    tables.export()
+
+    if args.command == "refresh":
+        if cache is None:
+            print(" refresh updates the cache, it cannot be used with --no-cache ")
+        else:
+            IncrementalRefresh(cache, args.REFRESH_DIR, workers=args.WORKERS).refresh()
+
+    if args.command == "serve":
+        server = AnalysisServer(stages)
+        server.warm()
+        try:
+            asyncio.run(server.serve(args.HOST, args.PORT))
+        except KeyboardInterrupt:
+            logging.info(f"server stopped, {server.hits} requests answered from the cache")
+
+    if args.PROFILE:
+        PROFILER.write_report(args.PROFILE)
   ##################################################################################
  #check for wrong options woth comand line args
-    if (args.CSV and args.command == "render") or (args.PDF and args.command == "render") or (args.WEB and args.command == "store"):
+    if (args.CSV and args.command == "render") or (args.PDF and args.command == "render") or (args.WEB and args.command == "store") \
+            or ((args.CSV or args.PDF or args.WEB) and args.command in ["significance", "snapshot", "serve", "refresh"]):
         print(" please use right option with required command 'render' -w --web, 'store' -p -- pdf or -c --csv ")
 
 
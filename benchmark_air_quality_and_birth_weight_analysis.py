@@ -0,0 +1,254 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import air_quality_and_birth_weight_analysis as analysis
+
+# Bundled data sets the synthetic data is scaled up from
+AIR_QUALITY_SOURCE = "annual_aqi_by_county_2018.csv"
+BIRTH_SOURCE = "birth_data.csv"
+
+# Scales benchmarked when none are given, 1000 writes about a million air quality and two million birth rows
+DEFAULT_SCALES = [10, 100]
+
+# Relative slow down of a stage over its baseline that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Copies the bundled rows once per replica, renaming the counties of every replica so they stay distinct
+def generate_data(directory, scale, seed=0):
+    """
+    Writes an annual AQI by county csv and a natality csv with scale times the rows of the bundled files.
+    Replica r adds " r" to every county name, before its "County", "city" etc, and offsets its FIPS code by
+    r * 100000, so the replicas join the same way the bundled counties do. Float columns get a little noise so
+    replicas are not identical
+
+    Parameters
+    ----------
+    directory : str
+        Directory the csv files are written to
+    scale : int
+        Number of replicas of the bundled rows
+    seed : int
+        Seed of the noise
+    """
+    rng = np.random.default_rng(seed)
+    air_quality = pd.read_csv(AIR_QUALITY_SOURCE, dtype={"State": str, "County": str})
+    birth = pd.read_csv(BIRTH_SOURCE, dtype={"Year": str, "County_of_Residence": str, "County_of_Residence_FIPS": str})
+
+    county_state = birth["County_of_Residence"].str.rpartition(", ")
+    fips = birth["County_of_Residence_FIPS"].astype(np.int64)
+    float_columns = birth.select_dtypes("float").columns
+
+    air_quality_replicas, birth_replicas = [], []
+    for replica in range(scale):
+        suffix = f" {replica}" if replica else ""
+
+        air_quality_replicas.append(air_quality.assign(County=_replica_names(air_quality["County"], suffix)))
+
+        names = _replica_names(county_state[0], suffix)
+        replica_birth = birth.assign(County_of_Residence=names + ", " + county_state[2],
+                                     County_of_Residence_FIPS=(fips + replica * 100000).map("{:05d}".format))
+        replica_birth[float_columns] = np.round(birth[float_columns] * rng.normal(1, 0.01, (len(birth), len(float_columns))), 2)
+        birth_replicas.append(replica_birth)
+
+    os.makedirs(directory, exist_ok=True)
+    pd.concat(air_quality_replicas).to_csv(os.path.join(directory, AIR_QUALITY_SOURCE), index=False)
+    pd.concat(birth_replicas).to_csv(os.path.join(directory, BIRTH_SOURCE), index=False)
+
+    logging.info(f"scale {scale}: {len(air_quality) * scale} air quality and {len(birth) * scale} birth rows written to {directory}")
+
+# Renames the counties of one replica the same way in both data sets, so their county keys still match
+def _replica_names(names, suffix):
+    """
+    Returns the county names with the replica suffix put before the "County", "Parish", "city", "(City)" etc,
+    eg: "Baltimore (City)" becomes "Baltimore 2 (City)" and "Baltimore city" becomes "Baltimore 2 city"
+
+    Parameters
+    ----------
+    names : pandas series of str
+        County names of the AQI or the natality csv
+    suffix : str
+        Suffix of the replica, empty for the first one
+    """
+    return names.str.replace(r"(?i)( County| Parish| Borough| Census Area| city| \(city\))?$", suffix + r"\1", n=1, regex=True)
+
+# Peak resident set size of this process so far
+def _peak_rss_mb():
+    """
+    Returns the high water mark of this process's resident memory in MB
+
+    Parameters
+    ----------
+    none
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+# Times one stage and records its rows per second and the peak memory after it
+def _measure(results, stage, rows, function):
+    """
+    Runs function and appends the stage timing to results, returning what function returns
+
+    Parameters
+    ----------
+    results : list
+        Stage results appended to
+    stage : str
+        Name of the stage
+    rows : int
+        Rows the stage processes
+    function : function
+        The stage, called without arguments
+    """
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+
+    results.append({"stage": stage, "seconds": seconds, "rows": rows, "rows_per_second": rows / seconds if seconds else None,
+                    "peak_rss_mb": _peak_rss_mb()})
+    logging.info(f"{stage}: {seconds:.3f}s for {rows} rows")
+
+    return value
+
+# Runs every stage on one generated data set, kept at module level so each scale runs in a fresh process
+def run_stages(directory):
+    """
+    Returns the timing of every stage on the data in directory, loading each data set, the birth state statistics,
+    the extreme values, the combined frame and the quadrant statistics. Nothing is cached, and each
+    scale is meant to run in its own process so peak_rss_mb, a process wide high water mark, starts fresh
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the generated csv files
+    """
+    os.chdir(directory)
+    results = []
+
+    with open(AIR_QUALITY_SOURCE) as f:
+        air_quality_rows = sum(1 for _ in f) - 1
+    with open(BIRTH_SOURCE) as f:
+        birth_rows = sum(1 for _ in f) - 1
+
+    air_quality = _measure(results, "air_quality_load", air_quality_rows, lambda: analysis.Import_AirQuality_Data(workers=1))
+    birth = _measure(results, "birth_weight_load", birth_rows, analysis.BirthDataStats)
+    _measure(results, "birth_weight_pandas_df", birth_rows, birth.pandas_df)
+    _measure(results, "extreme_values_data_frame", air_quality_rows, air_quality.extreme_values_data_frame)
+
+    combined = analysis.BirthWeight_and_AirQuality(air_quality, birth, workers=1)
+    _measure(results, "combined_dataframe", air_quality_rows + birth_rows, combined.combined_dataframe)
+    _measure(results, "quadrant_statistics", len(combined.breakdown_dataframe), combined.quadrant_statistics)
+
+    return results
+
+# Generates and benchmarks every scale
+def run_benchmarks(scales, seed=0):
+    """
+    Returns a report of every stage at every scale along with the versions it was measured with
+
+    Parameters
+    ----------
+    scales : list of int
+        Scales of the synthetic data
+    seed : int
+        Seed of the synthetic data
+    """
+    report = {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+              "machine": platform.machine(), "results": {}}
+
+    for scale in scales:
+        directory = tempfile.mkdtemp(prefix=f"aq_benchmark_{scale}x_")
+        try:
+            generate_data(directory, scale, seed)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                report["results"][str(scale)] = executor.submit(run_stages, directory).result()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return report
+
+# Finds the stages that got slower than the baseline by more than the tolerance
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns a list of regressions, one dictionary per stage and scale whose time grew by more than tolerance.
+    Stages or scales missing from the baseline are skipped
+
+    Parameters
+    ----------
+    report : dict
+        Report returned by run_benchmarks
+    baseline : dict
+        An earlier report
+    tolerance : float
+        Allowed relative slow down, 0.25 allows 25%
+    """
+    regressions = []
+
+    for scale, results in report["results"].items():
+        baseline_seconds = {result["stage"]: result["seconds"] for result in baseline["results"].get(scale, [])}
+        for result in results:
+            previous = baseline_seconds.get(result["stage"])
+            if previous and result["seconds"] > previous * (1 + tolerance):
+                regressions.append({"scale": int(scale), "stage": result["stage"], "baseline_seconds": previous,
+                                    "seconds": result["seconds"], "slowdown": result["seconds"] / previous})
+
+    return regressions
+
+def main():
+    # The analysis logs to the root logger, only warnings are shown so the table stays readable
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the analysis on synthetic scaled up data")
+    parser.add_argument("--scales", dest="SCALES", type=int, nargs="+", default=DEFAULT_SCALES, metavar="<scale>",
+    help="multiples of the bundled data sets to benchmark")
+    parser.add_argument("--seed", dest="SEED", type=int, default=0, metavar="<seed>", help="seed of the synthetic data")
+    parser.add_argument("--output", dest="OUTPUT", default=None, metavar="<report>", help="json file the report is written to")
+    parser.add_argument("--baseline", dest="BASELINE", default="benchmark_baseline.json", metavar="<baseline>",
+    help="json report the results are compared to")
+    parser.add_argument("--save-baseline", dest="SAVE_BASELINE", action="store_true",
+    help="store this run as the baseline instead of comparing to it")
+    parser.add_argument("--tolerance", dest="TOLERANCE", type=float, default=DEFAULT_TOLERANCE, metavar="<tolerance>",
+    help="relative slow down over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.SCALES, args.SEED)
+
+    for scale, results in report["results"].items():
+        for result in results:
+            print(f"{scale:>6}x  {result['stage']:<28} {result['seconds']:9.3f}s  {result['rows_per_second'] or 0:14,.0f} rows/s  "
+                  f"{result['peak_rss_mb']:8.1f} MB peak")
+
+    if args.OUTPUT:
+        with open(args.OUTPUT, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.SAVE_BASELINE:
+        with open(args.BASELINE, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline stored in {args.BASELINE}")
+    elif os.path.exists(args.BASELINE):
+        with open(args.BASELINE) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.TOLERANCE)
+        for regression in regressions:
+            logging.warning(f"{regression['stage']} at {regression['scale']}x took {regression['seconds']:.3f}s, "
+                            f"{regression['slowdown']:.2f} times the baseline {regression['baseline_seconds']:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print(f"no stage slower than the baseline in {args.BASELINE}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,51 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from air_quality_and_birth_weight_analysis import *
+import air_quality_and_birth_weight_analysis as analysis
+import benchmark_air_quality_and_birth_weight_analysis as benchmark
+
+# Milliseconds the modules imported by the analysis may take, plotly, pandas and numpy alone take several times this
+STARTUP_IMPORT_BUDGET_MS = 250
+
+# Modules only imported once a stage runs or a figure is made
+DEFERRED_MODULES = {"plotly.express", "pandas", "numpy", "asyncio"}
+
+# Runs python -X importtime and returns the self and cumulative microseconds of every module imported
+def import_times(arguments, cwd=None):
+    result = subprocess.run([sys.executable, "-X", "importtime"] + arguments, capture_output=True, text=True, cwd=cwd)
+    assert result.returncode == 0, result.stderr
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+class TestStartup(unittest.TestCase):
+
+    def test_heavy_modules_are_deferred(self):
+        module = "air_quality_and_birth_weight_analysis"
+        times = import_times(["-c", f"import {module}"])
+
+        # The module's own time is mostly compiling it when no bytecode is cached, only what it imports is budgeted
+        self_us, cumulative_us = times[module]
+        assert not DEFERRED_MODULES & set(times)
+        assert (cumulative_us - self_us) / 1000 < STARTUP_IMPORT_BUDGET_MS
+
+        # The proxies this file star imported keep the module rather than importing it again
+        pd.DataFrame, np.ndarray
+        assert pd.module is analysis.pd and np.module is analysis.np
+
+        tmp = tempfile.mkdtemp()
+        assert not DEFERRED_MODULES & set(import_times([os.path.abspath(f"{module}.py"), "--help"], cwd=tmp))
+        shutil.rmtree(tmp)
 
 class TestAirQuality_obj(unittest.TestCase):
     
@@ -34,7 +79,620 @@ class TestImport_AirQuality_Data(unittest.TestCase):
         self.assertRaises(ValueError, obj.best_air_quality_in_state, "Japan")
 
         assert best_air_washington == "Clark"
+
+    def test_ranked_counties_in_state(self):
+        obj = Import_AirQuality_Data()
+        worst_three = obj.ranked_counties_in_state("Washington", k=3)
+        best_three = obj.ranked_counties_in_state("Washington", k=3, worst=False)
+
+        self.assertRaises(ValueError, obj.ranked_counties_in_state, "Washington", 3, True, 1999)
+
+        assert worst_three[0] == obj.worst_air_quality_in_state("Washington", 2018) == "Chelan"
+        assert best_three[0] == "Clark"
+        assert len(obj.ranked_counties_in_state("Washington")) == len(obj.dataframe[obj.dataframe["State"] == "Washington"])
+
+    def test_rescore(self):
+        obj = Import_AirQuality_Data()
+        california = obj.dataframe[obj.dataframe["State"] == "California"].iloc[0]
+        expected = california["mean_hazardous_days_by_state"] * 100 + california["mean_very_unhealthy_days_by_state"] * 10 \
+                   + california["mean_unhealthy_days_by_state"] * 5 + california["mean_moderate_days_by_state"]
+
+        obj.rescore({"Hazardous Days": 100})
+        self.assertAlmostEqual(obj.dataframe[obj.dataframe["State"] == "California"]["air_quality_score"].iloc[0], expected)
+        self.assertRaises(ValueError, obj.rescore, {"Good Days": 1})
+
+    def test_structures_share_one_parse(self):
+        obj = Import_AirQuality_Data()
+
+        assert len(obj.obj_list) == obj.numpy_arrays.shape[0]
+        assert obj.numpy_arrays.shape[1] == len(AQI_NUMERIC_COLUMNS)
+        assert obj.obj_list[0].max_aqi == obj.numpy_arrays[0, AQI_NUMERIC_COLUMNS.index("Max AQI")]
+
+        # The records read the parsed columns in place, only numpy_arrays is a copy
+        assert np.shares_memory(obj.obj_list.column("max_aqi"), obj.raw_dataframe["Max AQI"].to_numpy())
+        assert not np.shares_memory(obj.numpy_arrays, obj.raw_dataframe["Max AQI"].to_numpy())
   
+class TestMultiYearAirQuality(unittest.TestCase):
+
+    def setUp(self):
+        # Copies the 2018 file into a second year so two annual files are found
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy("annual_aqi_by_county_2018.csv", self.tmp)
+        shutil.copy("birth_data.csv", self.tmp)
+        with open("annual_aqi_by_county_2018.csv") as f:
+            text = f.read().replace(",2018,", ",2017,")
+        with open(os.path.join(self.tmp, "annual_aqi_by_county_2017.csv"), "w") as f:
+            f.write(text)
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_every_year_is_loaded(self):
+        obj = Import_AirQuality_Data(workers=2)
+
+        assert sorted(obj.dataframe["Year"].unique()) == [2017, 2018]
+        assert obj.numpy_arrays.shape[0] == 2 * 1056
+        assert obj.indexed_dataframe.loc[("Washington", "Chelan", 2017), "Max AQI"] == \
+               obj.indexed_dataframe.loc[("Washington", "Chelan", 2018), "Max AQI"]
+
+    def test_every_common_year_is_combined(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(workers=1), BirthDataStats(), workers=2)
+        merged = combined.merged_dataframe
+        breakdown = combined.breakdown_dataframe
+
+        assert combined.years == [2017, 2018]
+        assert sorted(merged["Year"].unique()) == [2017, 2018]
+        assert (merged["year"].astype(int) == merged["Year"]).all()
+        assert sorted(breakdown["Year"].unique()) == [2017, 2018]
+        assert breakdown.groupby("Year")["State"].nunique().tolist() == breakdown.groupby("Year").size().tolist()
+
+class TestBirthDataStats(unittest.TestCase):
+
+    def test_pandas_df_state_statistics(self):
+        df = BirthDataStats().df
+        utah = df[(df["state"] == " UT") & (df["year"] == "2018")]
+
+        self.assertAlmostEqual(utah["avg_birth_weight_by_state"].iloc[0], utah["average_birth_weight"].mean())
+        assert utah["min birth weight by state"].iloc[0] == utah["average_birth_weight"].min()
+        assert utah["county_in_state_lowest_birthweight_by_year"].iloc[0] == \
+               utah.loc[utah["average_birth_weight"].idxmin(), "county"]
+        assert utah["county_in_state_highest_birthweight_by_year"].iloc[0] == \
+               utah.loc[utah["average_birth_weight"].idxmax(), "county"]
+
+    def test_streamed_state_aggregates_match(self):
+        loaded = BirthDataStats()
+        streamed = BirthDataStats(chunksize=100)
+
+        assert streamed.df is None
+        assert len(streamed.state_df) == len(loaded.state_df)
+        for column in ["avg_birth_weight_by_state", "min birth weight by state", "max birth weight by state"]:
+            self.assertTrue(np.allclose(streamed.state_df[column], loaded.state_df[column]))
+        assert streamed.state_df["county_in_state_lowest_birthweight_by_year"].tolist() == \
+               loaded.state_df["county_in_state_lowest_birthweight_by_year"].tolist()
+        for column in BIRTH_WEIGHTED_COLUMNS:
+            self.assertTrue(np.allclose(streamed.state_df[column], loaded.state_df[column]))
+
+    def test_births_weighted_state_statistics(self):
+        df = BirthDataStats().df
+        utah = df[(df["state"] == " UT") & (df["year"] == "2018")]
+        mean = np.average(utah["avg_age_of_mother"], weights=utah["births"])
+
+        assert df["births"].dtype == np.int32 and df["avg_age_of_mother"].dtype == np.float32
+        assert df["state"].dtype == "category" and df["county"].dtype == "category"
+        self.assertAlmostEqual(utah["weighted_avg_age_of_mother_by_state"].iloc[0], mean, places=5)
+        self.assertAlmostEqual(utah["weighted_var_avg_age_of_mother_by_state"].iloc[0],
+                               np.average((utah["avg_age_of_mother"] - mean) ** 2, weights=utah["births"]), places=5)
+
+class TestRecordStore(unittest.TestCase):
+
+    def test_row_views(self):
+        store = RecordStore(AirQuality_obj, {"state": np.array(["Washington", "California"], dtype=object),
+                                             "county": np.array(["Spokane", "LA"], dtype=object),
+                                             "year": np.array([2018, 2018]), "good_days": np.array([250, 100]),
+                                             "moderate_days": np.array([20, 100]), "unhealthy_days": np.array([5, 50]),
+                                             "very_unhealthy_days": np.array([0, 20]), "hazardous_days": np.array([0, 10]),
+                                             "max_aqi": np.array([100, 200])})
+
+        assert len(store) == 2
+        assert store[0] < store[1]
+        assert store[-1].county == "LA"
+        assert [obj.county for obj in store] == ["Spokane", "LA"]
+        assert not hasattr(store[0], "__dict__")
+
+    def test_birth_records_iterate_as_birth_objects(self):
+        birth = BirthDataStats()
+        records = list(birth)
+
+        assert len(records) == len(birth.df)
+        assert records[0] == BirthObject("2018", "Calhoun County", " AL", 6.98)
+        assert not hasattr(records[0], "__dict__")
+
+    def test_categorical_columns_keep_their_codes(self):
+        counties = pd.Series(["Davis", "Weber", "Davis"], dtype="category")
+        store = RecordStore(BirthObject, {"year": np.array(["2018"] * 3, dtype=object), "county": counties,
+                                          "state": np.array([" UT"] * 3, dtype=object),
+                                          "average_birth_weight": np.array([7.1, 7.2, 7.3])})
+
+        assert store.string_columns["county"][0].tolist() == counties.cat.codes.tolist()
+        assert store[1] == BirthObject("2018", "Weber", " UT", 7.2)
+        assert store.to_dataframe()["county"].equals(counties)
+
+class TestFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = FrameCache(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_key_changes_with_parameters(self):
+        key = self.cache.key(["birth_data.csv"], chunksize=None)
+
+        assert key == self.cache.key(["birth_data.csv"], chunksize=None)
+        assert key != self.cache.key(["birth_data.csv"], chunksize=100)
+
+    def test_unchanged_sources_are_hashed_once(self):
+        digest = analysis._file_digest
+        hashed = []
+        analysis._FILE_FINGERPRINTS.clear()
+        try:
+            analysis._file_digest = lambda path, length=None: hashed.append(path) or digest(path, length)
+            key = self.cache.key(["birth_data.csv"], chunksize=None)
+            assert key == self.cache.key(["birth_data.csv"], chunksize=None)
+            assert len(hashed) == 1
+
+            # a fresh process has no memo, but the cache's fingerprints.json still spares the hash
+            analysis._FILE_FINGERPRINTS.clear()
+            assert key == FrameCache(self.tmp).key(["birth_data.csv"], chunksize=None)
+            assert len(hashed) == 1
+        finally:
+            analysis._file_digest = digest
+            analysis._FILE_FINGERPRINTS.clear()
+
+    def test_cached_frames_match(self):
+        loaded = Import_AirQuality_Data(cache=self.cache)
+        cached = Import_AirQuality_Data(cache=self.cache)
+
+        pd.testing.assert_frame_equal(loaded.dataframe, cached.dataframe)
+        pd.testing.assert_frame_equal(loaded.best_worst_dataframe, cached.best_worst_dataframe)
+        assert cached.worst_air_quality_in_state("Washington") == "Chelan"
+        assert self.cache.load("air_quality", self.cache.key(loaded.csv_files, weights={"Hazardous Days": 1})) is None
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.snapshot = Snapshot(os.path.join(self.tmp, "snapshot"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stages_open_the_snapshot(self):
+        loaded = Import_AirQuality_Data()
+        self.snapshot.write("air_quality", loaded.raw_dataframe, loaded.csv_files)
+        self.snapshot.write("birth_weight", BirthDataStats().data.to_dataframe(), ["birth_data.csv"])
+
+        opened = self.snapshot.read("air_quality", loaded.csv_files)
+        assert isinstance(opened["Max AQI"].to_numpy().base, np.memmap)
+        assert opened.equals(loaded.raw_dataframe)
+
+        stages = AnalysisStages(snapshot=self.snapshot)
+        assert stages.air_quality.worst_air_quality_in_state("Washington") == "Chelan"
+        assert stages.birth_weight.df.equals(BirthDataStats().df)
+
+    def test_cold_cache_keys_on_the_snapshot_manifest(self):
+        self.snapshot.write("birth_weight", BirthDataStats().data.to_dataframe(), ["birth_data.csv"])
+
+        # A new process with a cold cache only stats the csv, the manifest holds its digest
+        digest = analysis._file_digest
+        analysis._FILE_FINGERPRINTS.clear()
+        analysis._file_digest = None
+        try:
+            cache = FrameCache(os.path.join(self.tmp, "cache"))
+            stats = BirthDataStats(cache=cache, snapshot=self.snapshot)
+        finally:
+            analysis._file_digest = digest
+            analysis._FILE_FINGERPRINTS.clear()
+
+        assert stats.df.equals(BirthDataStats().df)
+        assert cache.load("birth_weight", cache.key(["birth_data.csv"], chunksize=None)) is not None
+
+    def test_stale_snapshot_is_ignored(self):
+        source = os.path.join(self.tmp, "birth_data.csv")
+        shutil.copy("birth_data.csv", source)
+        self.snapshot.write("birth_weight", BirthDataStats().data.to_dataframe(), [source])
+
+        # Unchanged files are only stat-ed, a touched file is hashed and still matches
+        digest = analysis._file_digest
+        analysis._file_digest = None
+        try:
+            assert self.snapshot.read("birth_weight", [source]) is not None
+        finally:
+            analysis._file_digest = digest
+        os.utime(source, ns=(0, 0))
+        assert self.snapshot.read("birth_weight", [source]) is not None
+
+        with open(source, "a") as f:
+            f.write("\n")
+        assert self.snapshot.read("birth_weight", [source]) is None
+        assert self.snapshot.read("air_quality", [source]) is None
+
+class TestAnalysisStages(unittest.TestCase):
+
+    def test_stages_are_built_on_use(self):
+        stages = AnalysisStages()
+        air_quality = stages.air_quality
+
+        assert "birth_weight" not in stages.__dict__ and "combined" not in stages.__dict__
+        assert "obj_list" not in air_quality.__dict__ and "best_worst_dataframe" not in air_quality.__dict__
+
+        stages.combined.merged_dataframe
+        assert stages.combined.air_quality_obj is air_quality
+        assert "birth_weight" in stages.__dict__
+
+    def test_parallel_ingest_matches_sequential(self):
+        parallel = AnalysisStages()
+        parallel.ingest()
+        sequential = AnalysisStages()
+
+        assert parallel.air_quality.raw_dataframe.equals(sequential.air_quality.raw_dataframe)
+        assert parallel.birth_weight.df.equals(sequential.birth_weight.df)
+        assert parallel.combined.merged_dataframe.equals(sequential.combined.merged_dataframe)
+
+class TestIncrementalRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        for csv_file in ["annual_aqi_by_county_2018.csv", "birth_data.csv"]:
+            shutil.copy(csv_file, self.tmp)
+        os.chdir(self.tmp)
+
+        # Appends are only detected after a complete last line
+        with open("birth_data.csv", "a") as f:
+            f.write("\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_only_new_data_is_processed(self):
+        cache = FrameCache()
+        refresh = IncrementalRefresh(cache, workers=1)
+        assert refresh.refresh() == {"air_quality_years": [2018], "birth_years": [2016, 2017, 2018], "combined_years": [2018]}
+        assert refresh.refresh() == {"air_quality_years": [], "birth_years": [], "combined_years": []}
+
+        # A new year of air quality and a new year of births appended to the natality file
+        air_quality = pd.read_csv("annual_aqi_by_county_2018.csv")
+        air_quality.assign(Year=2017).to_csv("annual_aqi_by_county_2017.csv", index=False)
+        with open("birth_data.csv") as f:
+            rows = [line.rstrip("\n") for line in f if line.startswith("2017")]
+        with open("birth_data.csv", "a") as f:
+            f.write("\n".join(row.replace("2017", "2015", 1) for row in rows[:20]) + "\n")
+
+        assert refresh.refresh() == {"air_quality_years": [2017], "birth_years": [2015], "combined_years": [2017]}
+
+        refreshed = BirthWeight_and_AirQuality(Import_AirQuality_Data(cache=cache), BirthDataStats(cache=cache), cache=cache)
+        refreshed._combine_years = None # The refreshed cache entry is read, nothing is merged again
+        full = BirthWeight_and_AirQuality(Import_AirQuality_Data(workers=1), BirthDataStats(), workers=1)
+
+        assert refreshed.air_quality_obj.dataframe.equals(full.air_quality_obj.dataframe)
+        assert refreshed.birth_obj.df.equals(full.birth_obj.df)
+        assert refreshed.merged_dataframe.astype(str).equals(full.merged_dataframe.astype(str))
+
+    def test_streamed_runs_keep_the_refreshed_entries(self):
+        cache = FrameCache()
+        refresh = IncrementalRefresh(cache, workers=1)
+        refresh.refresh()
+        birth_key = cache.key(["birth_data.csv"], chunksize=None)
+
+        # A streamed run writes entries of its own next to the refreshed ones
+        streamed = BirthWeight_and_AirQuality(Import_AirQuality_Data(cache=cache), BirthDataStats(chunksize=100, cache=cache),
+                                              cache=cache)
+        streamed.breakdown_dataframe
+        assert cache.load("birth_weight", birth_key) is not None
+        assert cache.load("birth_weight_streamed", cache.key(["birth_data.csv"], chunksize=100)) is not None
+        assert glob.glob(os.path.join(cache.directory, "combined-*")) and glob.glob(os.path.join(cache.directory, "combined_streamed-*"))
+
+        # An unchanged csv still writes the birth weight entry back when it is gone
+        shutil.rmtree(glob.glob(os.path.join(cache.directory, "birth_weight-*"))[0])
+        assert refresh.refresh()["birth_years"] == []
+        assert cache.load("birth_weight", birth_key)["df"].equals(BirthDataStats().df)
+
+class TestFrameIndex(unittest.TestCase):
+
+    def test_lookups_match_scans(self):
+        df = pd.DataFrame({"Year": [2017, 2018, 2018, 2018], "State": ["A", "A", "B", "A"], "County": ["x", "x", "x", "y"],
+                           "value": [1, 2, 3, 4]})
+        index = FrameIndex(df, ["Year", "State", "County"])
+
+        assert index.record(2018, "B", "x")["value"] == 3
+        assert index.positions(2018, "A").tolist() == [1, 3]
+        assert index.rows(2018).equals(df[df["Year"] == 2018])
+        assert index.levels[0] == [2017, 2018]
+        assert (2017, "B") not in index and len(index.positions(2016)) == 0
+        self.assertRaises(ValueError, index.record, 2018, "C")
+
+    def test_query_api(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+        air_quality, birth = combined.air_quality_obj, combined.birth_obj
+
+        # Washington county exists in many states, the extreme values only use the one in the state ranked
+        extremes = air_quality.best_worst_dataframe
+        rhode_island = extremes[(extremes["State"] == "Rhode Island") & (extremes["County"] == "Washington")]
+        assert rhode_island["Max_AQI"].iloc[0] == air_quality.county_air_quality("Rhode Island", "Washington", 2018)["Max AQI"]
+
+        assert air_quality.state_air_quality("Alabama")["counties"] == 17
+        assert birth.state_birth_weight("AL", 2018)["county_in_state_lowest_birthweight_by_year"] == \
+               birth.ranked_counties_in_state("AL", k=1, year=2018)[0]
+        assert birth.ranked_counties_in_state("AL", worst=False, year="2018")[0] == birth.county_birth_weight("AL", "Shelby County")["county"]
+        assert combined.county_data("Alabama", "Baldwin")["fips"] == 1003
+        assert combined.state_data("Alabama")["quadrant"] == 2
+
+class TestAnalysisServer(unittest.TestCase):
+
+    def test_charts_and_queries_are_served_and_cached(self):
+        server = AnalysisServer(AnalysisStages())
+
+        async def get(path):
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            return int(head.split()[1]), body
+
+        async def session():
+            started = asyncio.get_running_loop().create_future()
+            serving = asyncio.create_task(server.serve(port=0, started=started))
+            self.port = (await started)[1]
+            try:
+                return [await get(path) for path in ["/data/breakdown?year=2018", "/charts/quadrants?quadrant=2&format=json",
+                                                     "/data/breakdown?year=2018", "/charts/missing"]]
+            finally:
+                serving.cancel()
+
+        (status, breakdown), (chart_status, chart), (_, cached), (missing, _) = asyncio.run(session())
+
+        assert status == 200 and chart_status == 200 and missing == 404
+        assert len(json.loads(breakdown)) == (server.stages.combined.breakdown_dataframe["Year"] == 2018).sum()
+        assert json.loads(chart)["layout"]["title"]["text"].startswith(QUADRANT_TITLES[2])
+        assert cached == breakdown and server.hits == 1
+
+        # Frames indexed by state and year keep their keys in the records
+        status, _, body = server.respond("/data/air_quality_by_state", {})
+        assert status == 200 and {"State", "Year", "mean_hazardous_days_by_state"} <= set(json.loads(body)[0])
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_generated_data_scales_and_joins(self):
+        matched = len(BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats()).merged_dataframe)
+        benchmark.generate_data(self.tmp, 3)
+        os.chdir(self.tmp)
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+
+        # Every replica joins as many counties as the bundled files, independent cities included
+        assert len(combined.air_quality_obj.raw_dataframe) == 3 * 1056
+        assert len(combined.birth_obj.df) == 3 * 1878
+        assert len(combined.merged_dataframe) == 3 * matched
+        assert {"Baldwin 2", "Baltimore 2 (City)", "St. Louis 2 City"} <= set(combined.merged_dataframe["County"])
+
+    def test_regressions_are_reported(self):
+        baseline = {"results": {"10": [{"stage": "air_quality_load", "seconds": 1.0},
+                                       {"stage": "combined_dataframe", "seconds": 1.0}]}}
+        report = {"results": {"10": [{"stage": "air_quality_load", "seconds": 1.1},
+                                     {"stage": "combined_dataframe", "seconds": 2.0}],
+                              "100": [{"stage": "air_quality_load", "seconds": 9.0}]}}
+
+        regressions = benchmark.compare_to_baseline(report, baseline, tolerance=0.25)
+        assert [(regression["scale"], regression["stage"]) for regression in regressions] == [(10, "combined_dataframe")]
+
+class TestStageProfiler(unittest.TestCase):
+
+    def test_stages_are_recorded_and_profiled(self):
+        tmp = tempfile.mkdtemp()
+        profiler = StageProfiler()
+
+        with profiler.stage("disabled"):
+            pass
+        assert profiler.stages == []
+
+        profiler.enable(os.path.join(tmp, "profiles"))
+        enabled = datetime.now().isoformat(timespec="seconds")
+        with profiler.stage("outer") as stage:
+            with profiler.stage("inner"):
+                pass
+            stage["rows"] = 10
+            time.sleep(1) # The report is written in a later second than the run started
+        profiler.write_report(os.path.join(tmp, "profile.json"))
+
+        with open(os.path.join(tmp, "profile.json")) as f:
+            report = json.load(f)
+        assert report["started"] <= enabled
+        assert [stage["stage"] for stage in report["stages"]] == ["inner", "outer"]
+        assert report["stages"][1]["rows"] == 10 and report["stages"][1]["seconds"] >= report["stages"][0]["seconds"]
+        assert os.listdir(os.path.join(tmp, "profiles")) == ["outer.prof"]
+        shutil.rmtree(tmp)
+
+class FakeFigure:
+    # Stands in for a plotly figure so exports can be tested without kaleido
+
+    def write_image(self, filename):
+        with open(filename, "w") as f:
+            f.write("figure")
+
+class TestFigureExporter(unittest.TestCase):
+
+    def test_export_writes_every_figure(self):
+        tmp = tempfile.mkdtemp()
+        filenames = [os.path.join(tmp, f"figure_{i}.pdf") for i in range(3)]
+
+        exporter = FigureExporter(workers=2)
+        for filename in filenames:
+            exporter.add(FakeFigure(), filename)
+
+        assert all(not os.path.exists(filename) for filename in filenames)
+        timings = exporter.export()
+
+        assert sorted(timings) == filenames
+        assert all(os.path.exists(filename) for filename in filenames)
+        assert exporter.figures == []
+        shutil.rmtree(tmp)
+
+class TestTableExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.frame = BirthDataStats().df
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_chunked_csv_matches_to_csv(self):
+        filename = os.path.join(self.tmp, "birth.csv")
+        exporter = TableExporter(workers=1, chunksize=100)
+        exporter.add(self.frame, filename)
+        exporter.export()
+
+        with open(filename) as f:
+            assert f.read() == self.frame.to_csv()
+
+    def test_partitions_are_compressed_and_complete(self):
+        table = os.path.join(self.tmp, "Birth.csv")
+
+        exporter = TableExporter(workers=2, compression="gzip", partition="year", chunksize=500)
+        exporter.add(self.frame, table)
+        timings = exporter.export()
+
+        assert sorted(timings) == [os.path.join(self.tmp, "Birth", f"year={year}.csv.gz") for year in ["2016", "2017", "2018"]]
+        written = pd.concat(pd.read_csv(filename, index_col=0) for filename in sorted(timings)).sort_index()
+        assert written.equals(pd.read_csv(io.StringIO(self.frame.to_csv()), index_col=0))
+
+        exporter = TableExporter(workers=1, file_format="parquet", compression="zstd")
+        exporter.add(self.frame, table)
+        exporter.export()
+        assert pd.read_parquet(os.path.join(self.tmp, "Birth.parquet")).equals(self.frame)
+
+class TestBirthWeight_and_AirQuality(unittest.TestCase):
+
+    def test_fips_join_matches_parishes_and_cities(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+        merged = combined.merged_dataframe
+
+        orleans = merged[(merged["State"] == "Louisiana") & (merged["County"] == "Orleans")]
+        assert orleans["county"].tolist() == ["Orleans Parish"]
+        assert merged.loc[merged["County"] == "Baltimore (City)", "county"].tolist() == ["Baltimore city"]
+        assert merged.loc[(merged["State"] == "Maryland") & (merged["County"] == "Baltimore"), "county"].tolist() == ["Baltimore County"]
+
+        assert (merged["County"].str.strip() != "").all()
+        assert "Unidentified Counties" in combined.unmatched_birth["county"].tolist()
+        assert len(combined.unmatched_air_quality) + len(merged) == len(combined.air_quality_obj.dataframe)
+
+    def test_streamed_birth_data_is_combined(self):
+        air_quality = Import_AirQuality_Data(workers=1)
+        streamed = BirthWeight_and_AirQuality(air_quality, BirthDataStats(chunksize=500), workers=1)
+        loaded = BirthWeight_and_AirQuality(air_quality, BirthDataStats(), workers=1)
+
+        assert streamed.years == loaded.years
+        both = loaded.breakdown_dataframe.merge(streamed.breakdown_dataframe, on=["State", "Year"])
+        assert len(both) == len(loaded.breakdown_dataframe)
+        assert (both["avg_birth_weight_by_state_x"] == both["avg_birth_weight_by_state_y"]).all()
+        assert (both["air_quality_score_x"] == both["air_quality_score_y"]).all()
+        assert streamed.quadrant_statistics()["states"].tolist() == [len(streamed.breakdown_dataframe)]
+
+        with self.assertRaises(ValueError):
+            streamed.merged_dataframe
+        with self.assertRaises(ValueError):
+            streamed.birth_obj.ranked_counties_in_state("AL")
+
+        # The command line refuses the county outputs before writing anything
+        tmp = tempfile.mkdtemp()
+        script = os.path.abspath("air_quality_and_birth_weight_analysis.py")
+        for arguments in [["store", "-c", "all"], ["significance", "--level", "county"]]:
+            result = subprocess.run([sys.executable, script, *arguments, "--chunksize", "500"], capture_output=True, text=True, cwd=tmp)
+            assert result.returncode == 2 and "--chunksize" in result.stderr
+        assert os.listdir(tmp) == ["air_quality.log"]
+        shutil.rmtree(tmp)
+
+    def test_quadrant_statistics(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+        breakdown = combined.breakdown_dataframe
+        statistics = combined.quadrant_statistics(permutations=200, seed=0).iloc[0]
+
+        assert breakdown["quadrant"].dtype == "category"
+        assert statistics["states"] == len(breakdown)
+        assert [statistics[f"quadrant_{quadrant}"] for quadrant in range(5)] == \
+               [(breakdown["quadrant"] == quadrant).sum() for quadrant in range(5)]
+        self.assertAlmostEqual(statistics["pearson_r"],
+                               np.corrcoef(breakdown["avg_birth_weight_by_state"], breakdown["air_quality_score"])[0, 1])
+        self.assertAlmostEqual(statistics["spearman_rho"],
+                               breakdown["avg_birth_weight_by_state"].rank().corr(breakdown["air_quality_score"].rank()))
+        assert 0 < statistics["pearson_p"] <= 1 and 0 < statistics["spearman_p"] <= 1
+
+    def test_missing_years_are_reported(self):
+        air_quality, birth = Import_AirQuality_Data(), BirthDataStats()
+
+        with self.assertRaisesRegex(ValueError, r"\[2016, 2017, 2018\]"):
+            birth.lowest_weight_in_state("figure", year=1999)
+        with self.assertRaisesRegex(ValueError, r"\[2018\]"):
+            BirthWeight_and_AirQuality(air_quality, birth).state_air_quality_bw_breakdown("figure", year=1999)
+        with self.assertRaisesRegex(ValueError, "No year is in both"):
+            BirthWeight_and_AirQuality(air_quality, birth, years=[]).significance(replicates=10)
+
+        server = AnalysisServer(AnalysisStages())
+        assert server.respond("/charts/quadrants", {"year": "1999"})[0] == 400
+        assert server.respond("/data/significance", {"replicates": "0"})[0] == 400
+        assert server.respond("/data/quadrant_statistics", {"permutations": str(SERVER_MAX_REPLICATES + 1)})[0] == 400
+
+    def test_cached_quadrants_keep_their_columns(self):
+        tmp = tempfile.mkdtemp()
+        cache = FrameCache(tmp)
+        BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats(), cache=cache).breakdown_dataframe
+        cached = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats(), cache=cache)
+
+        assert list(cached.breakdown_dataframe["quadrant"].cat.categories) == list(QUADRANT_TITLES)
+        statistics = cached.quadrant_statistics(permutations=10, seed=0)
+        assert [column for column in statistics if column.startswith("quadrant_")] == [f"quadrant_{q}" for q in QUADRANT_TITLES]
+
+        # A quadrant no state falls in still reads 0
+        cached._combined_frames["breakdown_dataframe"] = cached.breakdown_dataframe.assign(quadrant=1).astype({"quadrant": "int64"})
+        statistics = cached.quadrant_statistics(permutations=10, seed=0).iloc[0]
+        assert [statistics[f"quadrant_{q}"] for q in QUADRANT_TITLES] == [statistics["states"], 0, 0, 0, 0]
+        shutil.rmtree(tmp)
+
+    def test_significance(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+        bootstrap = combined.significance("bootstrap", replicates=2500, level="county", seed=7, workers=1)
+        permutation = combined.significance("permutation", replicates=2500, seed=7, workers=1)
+
+        assert bootstrap.loc["pearson_r", "observations"] == len(combined.merged_dataframe)
+        assert (bootstrap["ci_low"] <= bootstrap["observed"]).all() and (bootstrap["observed"] <= bootstrap["ci_high"]).all()
+        assert permutation["p_value"].between(0, 1).all()
+        self.assertAlmostEqual(permutation.loc["pearson_r", "observed"], combined.quadrant_statistics(permutations=10).loc[0, "pearson_r"])
+        assert combined.significance("permutation", replicates=2500, seed=7, workers=2).equals(permutation)
+        self.assertRaises(ValueError, combined.significance, "jackknife")
+        self.assertRaises(ValueError, combined.significance, replicates=0)
+        self.assertRaises(ValueError, combined.significance, replicates=-5)
+
+    def test_observed_share_matches_the_quadrants(self):
+        combined = BirthWeight_and_AirQuality(Import_AirQuality_Data(), BirthDataStats())
+        observed = combined.significance("permutation", replicates=10, seed=0, workers=1).loc["quadrant_2_4_share", "observed"]
+        statistics = combined.quadrant_statistics(permutations=10, seed=0).iloc[0]
+
+        self.assertAlmostEqual(observed, (statistics["quadrant_2"] + statistics["quadrant_4"]) / statistics["states"])
+
 class TestBirthObj(unittest.TestCase):
 
     def test_lt(self):